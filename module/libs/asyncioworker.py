@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains an experimental SNMP worker built on an asyncio
+event loop (trollius on python 2)
+
+The event loop of the worker thread owns the SNMP transports and timers:
+responses, timeouts and retries are handled by loop callbacks, and each
+finished task sends the next ones. The task queue is still read by a
+thread of the loop executor, and the Poller loop and Redis requests are
+not run by the event loop
+"""
+
+from Queue import Empty
+import time
+
+from shinken.log import logger
+
+# No log here: the poller uses the asyncore engine without this module
+import trollius as asyncio
+from trollius import From
+from pysnmp.hlapi.asyncio import UdpTransportTarget
+
+from snmpworker import SNMPEngine, SNMPWorker, TIMEOUT_STEP
+
+
+# Max time (seconds) the task reader waits for a task, before checking
+# if the worker must stop
+TASK_WAIT = 1
+
+
+class AsyncioSNMPEngine(SNMPEngine):
+    """ SNMP engine whose transports and timers run on the asyncio event
+    loop of the current thread
+    Requests are sent on the loop as soon as they are prepared: dispatch
+    is never called
+    """
+    # pysnmp creates an asyncio dispatcher for asyncio transports
+    target_class = UdpTransportTarget
+
+    def dispatch(self, timeout):
+        """ Nothing to do: the event loop handles the responses and the
+        timeouts of the transports as they come
+        """
+        pass
+
+
+class AsyncioSNMPWorker(SNMPWorker):
+    """ SNMP worker thread which runs its SNMP engine on an asyncio event
+    loop (see SNMPWorker for the tasks and the options)
+
+    The SNMP requests are always made in the worker thread by pysnmp:
+    `use_process' and `use_templates' are not supported (the poller
+    refuses them)
+    """
+    def __init__(self, mapping_queue, max_prepared_tasks, shard=0,
+                 use_process=False, max_device_in_flight=0,
+                 adaptive_timeout=False, min_timeout=TIMEOUT_STEP,
+                 use_templates=False, profiles=None):
+        SNMPWorker.__init__(self, mapping_queue, max_prepared_tasks, shard,
+                            False, max_device_in_flight, adaptive_timeout,
+                            min_timeout, False, profiles)
+        self.loop = None
+        # True when send_tasks is scheduled on the loop
+        self.send_scheduled = False
+        # Start time of the current busy period (tasks in flight)
+        self.busy_start = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.engine = AsyncioSNMPEngine()
+            self.loop.run_until_complete(self.read_tasks())
+        except Exception as err:
+            logger.error("[SnmpBooster] [code 1403] SNMP worker %d got "
+                         "error: %s" % (self.shard, str(err)))
+        finally:
+            if self.engine is not None:
+                self.engine.stop()
+            self.loop.close()
+
+    @asyncio.coroutine
+    def read_tasks(self):
+        """ Queue the new tasks by device and send them, until the worker
+        is stopped
+        The task queue is read by a thread of the loop executor
+        """
+        self.must_run = True
+        logger.info("[SnmpBooster] [code 1401] SNMP worker %d is "
+                    "starting with an asyncio event loop" % self.shard)
+        while self.must_run:
+            try:
+                snmp_task = yield From(self.loop.run_in_executor(
+                    None, self.mapping_queue.get, True, TASK_WAIT))
+            except Empty:
+                continue
+            self.scheduler.push(snmp_task)
+            self.mapping_queue.task_done()
+            # Take the other waiting tasks
+            while not self.mapping_queue.empty():
+                self.scheduler.push(self.mapping_queue.get())
+                self.mapping_queue.task_done()
+            self.send_tasks()
+
+        logger.info("[SnmpBooster] [code 1402] SNMP worker %d is "
+                    "stopped" % self.shard)
+
+    def send_tasks(self):
+        """ Send tasks of devices with a free window, see
+        SNMPWorker.send_tasks
+        """
+        self.send_scheduled = False
+        self.engine.recycle()
+        SNMPWorker.send_tasks(self)
+        if self.busy_start is None and self.in_flight > 0:
+            self.busy_start = time.time()
+
+    def task_finished(self, snmp_task):
+        """ Called once for each task, when its last response is handled
+        The freed slots are used once pysnmp callbacks are done
+        """
+        SNMPWorker.task_finished(self, snmp_task)
+        if self.in_flight == 0 and self.busy_start is not None:
+            self.stats['busy'] += time.time() - self.busy_start
+            self.busy_start = None
+        if not self.send_scheduled:
+            self.send_scheduled = True
+            self.loop.call_soon(self.send_tasks)
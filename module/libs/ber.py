@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains a minimal BER codec for SNMP v1/v2c messages
+
+GET requests are encoded once as templates, where only the request id
+changes. Responses are decoded to normalized python values, the same as
+normalize_value in snmpworker gives for pysnmp values
+"""
+
+import random
+import struct
+
+
+# Normalized values of the SNMP exceptions
+# Tuples are never SNMP values
+NO_SUCH_OBJECT = ("noSuchObject",)
+NO_SUCH_INSTANCE = ("noSuchInstance",)
+END_OF_MIB_VIEW = ("endOfMibView",)
+
+# Request ids are always encoded on 4 bytes, so templates keep their size
+MIN_REQUEST_ID = 0x800000
+MAX_REQUEST_ID = 0x7fffffff
+
+# BER tags
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_GET_REQUEST = 0xa0
+TAG_RESPONSE = 0xa2
+# Integer types: Integer32, Counter32, Gauge32, TimeTicks, Counter64
+INTEGER_TAGS = (TAG_INTEGER, 0x41, 0x42, 0x43, 0x46)
+# String types: OctetString, IpAddress, Opaque
+STRING_TAGS = (TAG_OCTET_STRING, 0x40, 0x44)
+EXCEPTION_VALUES = {0x80: NO_SUCH_OBJECT,
+                    0x81: NO_SUCH_INSTANCE,
+                    0x82: END_OF_MIB_VIEW,
+                    }
+# Estimated size (bytes) of a value whose size is unknown
+UNKNOWN_VALUE_SIZE = 16
+
+
+def encode_length(length):
+    """ Encode a BER length """
+    if length < 0x80:
+        return chr(length)
+    octets = ""
+    while length:
+        octets = chr(length & 0xff) + octets
+        length >>= 8
+    return chr(0x80 | len(octets)) + octets
+
+
+def encode_tlv(tag, value):
+    """ Encode a BER tag, length and value """
+    return chr(tag) + encode_length(len(value)) + value
+
+
+def encode_oid(oid):
+    """ Encode the value of an oid: '1.3.6.1...' """
+    arcs = [int(arc) for arc in oid.strip(".").split(".")]
+    octets = []
+    for sub_id in [arcs[0] * 40 + arcs[1]] + arcs[2:]:
+        sub_octets = [sub_id & 0x7f]
+        sub_id >>= 7
+        while sub_id:
+            sub_octets.insert(0, 0x80 | (sub_id & 0x7f))
+            sub_id >>= 7
+        octets.extend(sub_octets)
+    return "".join([chr(octet) for octet in octets])
+
+
+def var_bind_size(oid, value=None):
+    """ Estimate the encoded size of a response var bind, from its oid and
+    its normalized value (None if unknown)
+    """
+    if isinstance(value, (int, long)):
+        value_size = len("%x" % abs(value)) // 2 + 1
+    elif isinstance(value, str):
+        value_size = len(value)
+    else:
+        value_size = UNKNOWN_VALUE_SIZE
+    try:
+        oid_size = len(encode_oid(oid))
+    except (ValueError, IndexError):
+        # Bad oids get an error from the SNMP engine
+        oid_size = len(oid)
+    # Headers of the var bind, oid and value
+    return oid_size + value_size + 6
+
+
+def encode_get_template(version, community, oids):
+    """ Encode a GET request with a null request id
+
+    Return
+    * (message head, message tail): the request id, on 4 bytes, goes
+      between them
+    """
+    var_binds = "".join([encode_tlv(TAG_SEQUENCE,
+                                    encode_tlv(TAG_OID, encode_oid(oid)) +
+                                    "\x05\x00")
+                         for oid in oids])
+    # request id, error status, error index, var binds
+    pdu_value = ("\x02\x04\x00\x00\x00\x00\x02\x01\x00\x02\x01\x00" +
+                 encode_tlv(TAG_SEQUENCE, var_binds))
+    pdu = encode_tlv(TAG_GET_REQUEST, pdu_value)
+    message = encode_tlv(TAG_SEQUENCE,
+                         encode_tlv(TAG_INTEGER, chr(version)) +
+                         encode_tlv(TAG_OCTET_STRING, community) + pdu)
+    offset = len(message) - len(pdu_value) + 2
+    return message[:offset], message[offset + 4:]
+
+
+def encode_request_id(request_id):
+    """ Encode a request id for a template """
+    return struct.pack(">I", request_id)
+
+
+def random_request_id():
+    """ Return a random request id, see MIN_REQUEST_ID """
+    return random.randint(MIN_REQUEST_ID, MAX_REQUEST_ID)
+
+
+def decode_tlv(data, pos, tag=None):
+    """ Decode the BER tag and length at `pos'
+
+    Return
+    * (tag, value start, value end)
+    """
+    found_tag = ord(data[pos])
+    if tag is not None and found_tag != tag:
+        raise ValueError("Unexpected BER tag: %#x" % found_tag)
+    length = ord(data[pos + 1])
+    pos += 2
+    if length & 0x80:
+        nb_octets = length & 0x7f
+        if nb_octets == 0 or nb_octets > 4:
+            raise ValueError("Bad BER length")
+        length = 0
+        for octet in data[pos:pos + nb_octets]:
+            length = (length << 8) | ord(octet)
+        pos += nb_octets
+    end = pos + length
+    if end > len(data):
+        raise ValueError("Truncated BER value")
+    return found_tag, pos, end
+
+
+def decode_integer(data, start, end):
+    """ Decode a signed BER integer value """
+    if start == end:
+        raise ValueError("Empty BER integer")
+    value = 0
+    for octet in data[start:end]:
+        value = (value << 8) | ord(octet)
+    if ord(data[start]) & 0x80:
+        value -= 1 << (8 * (end - start))
+    return value
+
+
+def decode_oid(data, start, end):
+    """ Decode an oid value: '1.3.6.1...' """
+    sub_ids = []
+    sub_id = 0
+    for octet in data[start:end]:
+        octet = ord(octet)
+        sub_id = (sub_id << 7) | (octet & 0x7f)
+        if not octet & 0x80:
+            sub_ids.append(sub_id)
+            sub_id = 0
+    if not sub_ids or sub_id:
+        raise ValueError("Bad BER oid")
+    first = min(sub_ids[0] // 40, 2)
+    arcs = [first, sub_ids[0] - first * 40] + sub_ids[1:]
+    return ".".join([str(arc) for arc in arcs])
+
+
+def decode_value(data, tag, start, end):
+    """ Decode a var bind value to a normalized value """
+    if tag in INTEGER_TAGS:
+        return decode_integer(data, start, end)
+    elif tag in STRING_TAGS:
+        return data[start:end]
+    elif tag in EXCEPTION_VALUES:
+        return EXCEPTION_VALUES[tag]
+    elif tag == TAG_OID:
+        return decode_oid(data, start, end)
+    elif tag == TAG_NULL:
+        return ""
+    raise ValueError("Unsupported SNMP value type: %#x" % tag)
+
+
+def decode_response(data):
+    """ Decode the header of a SNMP v1/v2c response
+
+    Return
+    * (version, community, request id, error status, error index,
+      (var binds start, var binds end))
+    """
+    _, pos, _ = decode_tlv(data, 0, TAG_SEQUENCE)
+    _, start, pos = decode_tlv(data, pos, TAG_INTEGER)
+    version = decode_integer(data, start, pos)
+    _, start, pos = decode_tlv(data, pos, TAG_OCTET_STRING)
+    community = data[start:pos]
+    _, pos, _ = decode_tlv(data, pos, TAG_RESPONSE)
+    header = []
+    for _ in range(3):
+        _, start, pos = decode_tlv(data, pos, TAG_INTEGER)
+        header.append(decode_integer(data, start, pos))
+    _, start, end = decode_tlv(data, pos, TAG_SEQUENCE)
+    return (version, community, header[0], header[1], header[2],
+            (start, end))
+
+
+def decode_var_binds(data, var_binds):
+    """ Decode the var binds of a response, see decode_response
+
+    Return
+    * list of (oid, value), oids start with a dot
+    """
+    pos, end = var_binds
+    results = []
+    while pos < end:
+        _, pos, var_bind_end = decode_tlv(data, pos, TAG_SEQUENCE)
+        _, start, pos = decode_tlv(data, pos, TAG_OID)
+        oid = "." + decode_oid(data, start, pos)
+        tag, start, pos = decode_tlv(data, pos)
+        results.append((oid, decode_value(data, tag, start, pos)))
+        pos = var_bind_end
+    return results
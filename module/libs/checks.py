@@ -27,30 +27,56 @@
 
 
 import time
+from copy import deepcopy
 from functools import partial
 from collections import namedtuple
 
 from shinken.log import logger
 
-try:
-    from pysnmp.entity.rfc3413.oneliner import cmdgen
-except ImportError as exp:
-    logger.error("[SnmpBooster] [code 0201] Import error. Pysnmp is missing")
-    raise ImportError(exp)
-
 from snmpworker import callback_mapping_next, callback_mapping_bulk
-from snmpworker import callback_get
+from snmpworker import callback_get, callback_walk, new_completion
+from ber import var_bind_size
+from utils import merge_dicts
 
 
 __all__ = ("check_cache", "check_snmp")
 
 
-def check_cache(check, arguments, db_client):
-    """ Get data from database """
+# Oids of table columns end with the instance
+INSTANCE_SUFFIX = ".%(instance)s"
+# Min number of needed rows of a table column to walk it
+MIN_WALK_ROWS = 8
+
+
+def merge_pending(service, pending_writes):
+    """ Return the service data with the collected data not written
+    in the database yet
+    `pending_writes' is a dict {(host, service): data}, or None
+    """
+    if service is None or not pending_writes:
+        return service
+    pending = pending_writes.get((service.get('host'), service.get('service')))
+    if pending is None:
+        return service
+    # Copies: the service can be in the Poller service cache and the
+    # pending data can be merged again
+    return merge_dicts(deepcopy(service), deepcopy(pending))
+
+
+def check_cache(check, arguments, db_client, pending_writes=None):
+    """ Get data from database, or from the Poller service cache
+    `pending_writes' are the collected data waiting to be written
+    """
     start_time = time.time()
     # Get current service
-    current_service = db_client.get_service(arguments.get('host'),
-                                            arguments.get('service'))
+    current_service = db_client.get_cached_service(arguments.get('host'),
+                                                   arguments.get('service'))
+    current_service = merge_pending(current_service, pending_writes)
+    return set_cache_result(check, arguments, current_service, start_time)
+
+
+def set_cache_result(check, arguments, current_service, start_time):
+    """ Prepare the check result from the service found in database """
     # Check if the service is in the database
     if current_service is None:
         error_message = ("[SnmpBooster] [code 0202] [%s, %s] Not found in "
@@ -86,20 +112,34 @@ def check_cache(check, arguments, db_client):
     return current_service
 
 
-def check_snmp(check, arguments, db_client, task_queue, result_queue):
-    """ Prepare snmp requests """
-    # Get current service
-    current_service = check_cache(check, arguments, db_client)
+def check_snmp(check, arguments, db_client, task_queue, result_queue,
+               profiles=None, walk_ratio=0, pending_writes=None):
+    """ Prepare snmp requests
+    `profiles' is the DeviceProfiles giving the request limits of the
+    devices, or None
+    Table columns whose needed rows are at least `walk_ratio' of their
+    rows are walked with GETBULK requests (0 disables walks, which also
+    need the device profiles)
+    `pending_writes' are the collected data waiting to be written
+    """
+    start_time = time.time()
+    # Get current service and all services with this host and check_interval
+    current_service, services = db_client.get_host_snapshot(
+        arguments.get('host'),
+        arguments.get('service'))
+    current_service = merge_pending(current_service, pending_writes)
+    current_service = set_cache_result(check, arguments, current_service,
+                                       start_time)
 
     if current_service is None:
         return None
+    services = [merge_pending(serv, pending_writes)
+                for serv in services or []]
 
-    # Get check_interval
-    check_interval = current_service.get('check_interval')
+    profile = None
+    if profiles is not None:
+        profile = profiles.load(arguments.get('address'))
 
-    # Get all services with this host and check_interval
-    services = db_client.get_services(arguments.get('host'),
-                                      current_service.get('check_interval'))
     # Mapping needed ?
     # Get all services which need mapping
     mappings = [serv for serv in services
@@ -113,12 +153,14 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
         snmp_info = namedtuple("snmp_info",
                                ['community',
                                 'version',
+                                'usm',
                                 'address',
                                 'port',
                                 'mapping',
                                 'use_getbulk'])
         snmp_infos = list(set([snmp_info(serv['community'],
                                          serv['version'],
+                                         get_usm(serv),
                                          serv['address'],
                                          serv['port'],
                                          serv['mapping'],
@@ -137,34 +179,31 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
             mapping_task['host'] = snmp_info.address
             # Get concurrency
             mapping_task['no_concurrency'] = serv.get('no_concurrency', False)
-            mapping_task['data'] = {"authData": cmdgen.CommunityData(communityIndex=snmp_info.community,
-                                                                     communityName=snmp_info.community,
-                                                                     mpModel=int(snmp_info.version)-1
-                                                                     ),
-                                    "transportTarget": cmdgen.UdpTransportTarget((snmp_info.address,
-                                                                                  snmp_info.port),
-                                                                                 timeout=serv['timeout'],
-                                                                                 retries=serv['retry'],
-                                                                                 ),
-                                    "varNames": (str(snmp_info.mapping[1:]), ),
-                                    }
-            if snmp_info.use_getbulk:
+            # Add community, address, port and oid
+            mapping_task['community'] = snmp_info.community
+            mapping_task['version'] = snmp_info.version
+            mapping_task['usm'] = snmp_info.usm
+            mapping_task['address'] = snmp_info.address
+            mapping_task['port'] = snmp_info.port
+            mapping_task['timeout'] = serv['timeout']
+            mapping_task['retries'] = serv['retry']
+            mapping_task['oids'] = [str(snmp_info.mapping[1:])]
+            if snmp_info.use_getbulk and (profile is None or
+                                          profile.bulk is not False):
                 # Add snmp request type
                 mapping_task['type'] = 'bulk'
-                mapping_task['data']["nonRepeaters"] = 0
-                mapping_task['data']["maxRepetitions"] = serv.get('max_rep_map',
-                                                                  64)
-                mapping_task['data']['cbInfo'] = (callback_mapping_bulk,
-                                                  (serv['mapping'],
-                                                   check.result,
-                                                   result))
+                mapping_task['max_repetitions'] = serv.get('max_rep_map', 64)
+                mapping_task['callback'] = (callback_mapping_bulk,
+                                            (serv['mapping'],
+                                             check.result,
+                                             result))
             else:
                 # Add snmp request type
                 mapping_task['type'] = 'next'
-                mapping_task['data']['cbInfo'] = (callback_mapping_next,
-                                                  (serv['mapping'],
-                                                   check.result,
-                                                   result))
+                mapping_task['callback'] = (callback_mapping_next,
+                                            (serv['mapping'],
+                                             check.result,
+                                             result))
             task_queue.put(mapping_task, block=False)
 
         # Handle result
@@ -176,69 +215,172 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
             time.sleep(0.1)
 
         # Todo: What if there is the same iname for 2 serv => override one, not good
-        map_inst_serv = dict([(serv['instance_name'], serv['service']) for serv in mappings])
+        map_inst_serv = dict([(serv['instance_name'], serv) for serv in mappings])
 
         # Write to database
         for instance_name, instance in result['data'].items():
             if instance is None:
                 # Don't save instances which are not mapped
                 continue
-            service = map_inst_serv[instance_name]
-            db_client.update_service(arguments.get('host'), service, {"instance": instance})
-        # refresh all services list
-        # NOTE Is this refresh mandatory ????
-        services = db_client.get_services(arguments.get('host'),
-                                          current_service.get('check_interval'))
+            mapped_serv = map_inst_serv[instance_name]
+            db_client.update_service(arguments.get('host'),
+                                     mapped_serv['service'],
+                                     {"instance": instance})
+            # Update services list instead of reading it again
+            mapped_serv['instance'] = instance
+            if mapped_serv['service'] == current_service['service']:
+                current_service['instance'] = instance
         # MAPPING DONE
 
     # Prepare oids
     # TODO CHANGE all serv for current_service
     serv = current_service
 
-    fnc = partial(prepare_oids,
-                  group_size=serv.get('request_group_size', 64))
+    group_size = serv.get('request_group_size', 64)
+    max_size = None
+    if profile is not None:
+        group_size, max_size = profile.get_limits(group_size)
+    walk_columns = set()
+    if (walk_ratio > 0 and profile is not None and profile.bulk is not False
+            and str(arguments.get('version', 2)) != '1'):
+        walk_columns = get_walk_columns(services, profile, walk_ratio)
+    # Estimated response size of each request
+    sizes = [0]
+    # Oids of the walked columns, by column
+    walk_oids = {}
+    fnc = partial(prepare_oids, group_size=group_size, max_size=max_size,
+                  sizes=sizes, walk_columns=walk_columns, walk_oids=walk_oids)
     splitted_oids_list = reduce(fnc, services, [{}, ])
 
+    # Put all oid in the same list
+    oids_list = {}
+    # Merge oids lists in one list
+    _ = [oids_list.update(oid_list) for oid_list in splitted_oids_list]
+    _ = [oids_list.update(oid_list) for oid_list in walk_oids.values()]
+    # Completion state of the results, shared by the tasks
+    completion = new_completion(oids_list, check.result)
+
+    # Prepare walk tasks
+    for column, oids in walk_oids.items():
+        walk_task = {}
+        walk_task['community'] = arguments.get('community')
+        walk_task['version'] = arguments.get('version', 2)
+        walk_task['usm'] = get_usm(arguments)
+        walk_task['address'] = arguments.get('address')
+        walk_task['port'] = arguments.get('port')
+        walk_task['timeout'] = serv['timeout']
+        walk_task['retries'] = arguments.get('retry')
+        walk_task['oids'] = [str(column[1:])]
+        walk_task['type'] = 'bulk'
+        walk_task['max_repetitions'] = serv.get('max_rep_map', 64)
+        walk_task['no_concurrency'] = arguments.get('no_concurrency', False)
+        walk_task['host'] = arguments.get('address')
+        walk = {'column': column,
+                'needed': set(oids),
+                'rows': 0,
+                'profiles': profiles,
+                'address': arguments.get('address'),
+                }
+        walk_task['callback'] = (callback_walk,
+                                 (oids_list,
+                                  check.result,
+                                  result_queue,
+                                  completion,
+                                  walk))
+        task_queue.put(walk_task, block=False)
+
     # Prepare get task
-    for oids in splitted_oids_list:
+    for oids, size in zip(splitted_oids_list, sizes):
+        if not oids and walk_oids:
+            # All oids are walked
+            continue
         get_task = {}
         # Add community, address, port and oids
-        get_task['data'] = {"authData": cmdgen.CommunityData(communityIndex=arguments.get('community'),
-                                                             communityName=arguments.get('community'),
-                                                             mpModel=int(arguments.get('version', 2))-1
-                                                             ),
-                            "transportTarget": cmdgen.UdpTransportTarget((arguments.get('address'),
-                                                                          arguments.get('port')),
-                                                                          timeout=serv['timeout'],
-                                                                          retries=arguments.get('retry'),
-                                                                          ),
-                            "varNames": [str(oid[1:]) for oid in oids.keys()],
-                            }
+        get_task['community'] = arguments.get('community')
+        get_task['version'] = arguments.get('version', 2)
+        get_task['usm'] = get_usm(arguments)
+        get_task['address'] = arguments.get('address')
+        get_task['port'] = arguments.get('port')
+        get_task['timeout'] = serv['timeout']
+        get_task['retries'] = arguments.get('retry')
+        get_task['oids'] = [str(oid[1:]) for oid in oids.keys()]
+        # Request limit and size, to learn the device profile
+        get_task['max_oids'] = group_size
+        get_task['size'] = size
         # Add snmp request type
         get_task['type'] = 'get'
         # Get concurrency
         get_task['no_concurrency'] = arguments.get('no_concurrency', False)
         # Add address
         get_task['host'] = arguments.get('address')
-        # Put all oid in the same list
-        oids_list = {}
-        # Merge oids lists in one list
-        _ = [oids_list.update(oid_list) for oid_list in splitted_oids_list]
         # Add Callback and callback args
-        get_task['data']['cbInfo'] = (callback_get,
-                                      (oids_list,
-                                       check.result,
-                                       result_queue))
+        get_task['callback'] = (callback_get,
+                                (oids_list,
+                                 check.result,
+                                 result_queue,
+                                 completion))
         task_queue.put(get_task, block=False)
 
     # NOTE Is it useful ?
     del services
 
 
-def prepare_oids(ret, service, group_size=64):
+def get_usm(data):
+    """ Return the SNMPv3 user of a service or of its arguments:
+    (user, auth protocol, auth key, priv protocol, priv key), or None
+    for SNMP v1 and v2c
+    """
+    if str(data.get('version')) != '3':
+        return None
+    return (data.get('user'),
+            data.get('auth_protocol', 'MD5'), data.get('auth_key'),
+            data.get('priv_protocol', 'DES'), data.get('priv_key'))
+
+
+def get_column(oid, service):
+    """ Return the table column of an oid (before its instance), or None """
+    if oid.endswith(INSTANCE_SUFFIX) and service.get('instance') is not None:
+        return oid[:-len(INSTANCE_SUFFIX)] % service
+    return None
+
+
+def get_walk_columns(services, profile, walk_ratio):
+    """ Return the table columns to walk instead of getting their rows:
+    columns with at least MIN_WALK_ROWS needed rows, which are at least
+    `walk_ratio' of the rows found by the last walk. Columns never walked
+    are walked once to count their rows
+    """
+    instances = {}
+    for service in services:
+        for ds_data in service['ds'].values():
+            for oid_type in ['ds_oid', 'ds_min_oid', 'ds_max_oid']:
+                if ds_data.get(oid_type) is None:
+                    continue
+                column = get_column(ds_data[oid_type], service)
+                if column is not None:
+                    instances.setdefault(column, set()).add(service['instance'])
+    walk_columns = set()
+    for column, column_instances in instances.items():
+        rows = profile.table_rows.get(column)
+        if len(column_instances) >= MIN_WALK_ROWS and (
+                rows is None or len(column_instances) >= walk_ratio * rows):
+            walk_columns.add(column)
+    return walk_columns
+
+
+def prepare_oids(ret, service, group_size=64, max_size=None, sizes=None,
+                 walk_columns=None, walk_oids=None):
     """ This function, is in a reduce function,
     groups oids to launch grouped SNMP requests
+
+    Groups have at most `group_size' oids and, if `max_size' is set, an
+    estimated response size (from the last values) of `max_size' bytes.
+    The estimated size of each group is added to `sizes'
+    Oids of the `walk_columns' table columns are added to `walk_oids', by
+    column, instead of a group
     """
+    if sizes is None:
+        sizes = [0]
     # For each ds_name
     for ds_name, ds_data in service['ds'].items():
         # For each ds_oid, min and max
@@ -249,19 +391,32 @@ def prepare_oids(ret, service, group_size=64):
                     # Pass oid when it needs instance and
                     # the mapping is not done
                     continue
+                # Construct oid
+                oid = ds_data[oid_type] % service
+                column = None
+                if walk_columns:
+                    column = get_column(ds_data[oid_type], service)
+                size = var_bind_size(oid, ds_data.get(oid_type + "_value"))
+                if column is not None and column in walk_columns:
+                    # The oid is read from the walk of its column
+                    tmp_dict = walk_oids.setdefault(column, {})
+                    size = 0
                 # Split requests in group of 'group_size'
-                if len(ret[-1]) < group_size:
+                elif len(ret[-1]) < group_size and (
+                        max_size is None or not ret[-1] or
+                        sizes[-1] + size <= max_size):
                     tmp_dict = ret[-1]
                 else:
                     tmp_dict = {}
                     ret.append(tmp_dict)
-                # Construct oid
-                oid = ds_data[oid_type] % service
+                    sizes.append(0)
                 if oid in tmp_dict:
                     # If we have already added the oid
                     # We only add the ds_name
                     tmp_dict[oid]['key']['ds_names'].append(ds_name)
+                    tmp_dict[oid]['db_values'][ds_name] = ds_data
                 else:
+                    sizes[-1] += size
                     # Check if we have a ds_max and get the oid
                     ds_max_oid = None
                     if ds_data.get('ds_max_oid'):
@@ -298,5 +453,9 @@ def prepare_oids(ret, service, group_size=64):
                                      'ds_max_oid': ds_max_oid,
                                      # Get min oid
                                      'ds_min_oid': ds_min_oid,
+                                     # We put the datasource values found
+                                     # in database (to save only changed
+                                     # values)
+                                     'db_values': {ds_name: ds_data},
                                      }
     return ret
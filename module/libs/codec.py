@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the codecs used to serialize services
+in the database
+
+Each encoded value starts with a version byte which tells which codec
+wrote it, so values written by different codecs can live in the same
+database. Values written by older SNMP Booster versions don't have this
+byte: they are python dict reprs (``str(dict)``) and are still decoded,
+so the database can be migrated lazily.
+"""
+
+
+import marshal
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ("get_codec", "decode", "CodecError", "CODECS", "DEFAULT_CODEC")
+
+
+DEFAULT_CODEC = "marshal"
+
+_CONTAINERS = (dict, list, tuple)
+
+# Reserved key of the dicts which replace OrderedDicts in marshal values
+ORDERED_KEY = "__ordered__"
+
+
+class CodecError(Exception):
+    """ Raised when a value can not be decoded """
+    pass
+
+
+def pack_ordered(obj):
+    """ Replace OrderedDicts by dicts with the reserved key ORDERED_KEY,
+    mapped to the list of [key, value] pairs
+
+    Marshal does not know OrderedDict, and the ds order of a service
+    must be kept to build the output. Tuples are kept as they are.
+
+    >>> pack_ordered({'ds': OrderedDict([('b', 1), ('a', 2)])})
+    {'ds': {'__ordered__': [['b', 1], ['a', 2]]}}
+    """
+    if isinstance(obj, OrderedDict):
+        return {ORDERED_KEY: [[key, pack_ordered(value)
+                               if isinstance(value, _CONTAINERS) else value]
+                              for key, value in obj.iteritems()]}
+    elif isinstance(obj, dict):
+        packed = {}
+        for key, value in obj.iteritems():
+            if isinstance(value, _CONTAINERS):
+                value = pack_ordered(value)
+            packed[key] = value
+        return packed
+    elif isinstance(obj, (list, tuple)):
+        packed = [pack_ordered(value) if isinstance(value, _CONTAINERS)
+                  else value for value in obj]
+        return tuple(packed) if isinstance(obj, tuple) else packed
+    return obj
+
+
+def unpack_ordered(obj):
+    """ Reverse function of pack_ordered
+
+    >>> unpack_ordered({'ds': {'__ordered__': [['b', 1], ['a', 2]]}})
+    {'ds': OrderedDict([('b', 1), ('a', 2)])}
+    >>> unpack_ordered({'oids': ('a', 'b')})
+    {'oids': ('a', 'b')}
+    """
+    if isinstance(obj, dict):
+        if len(obj) == 1 and ORDERED_KEY in obj:
+            return OrderedDict([(key, unpack_ordered(value)
+                                 if isinstance(value, _CONTAINERS)
+                                 else value)
+                                for key, value in obj[ORDERED_KEY]])
+        for key, value in obj.iteritems():
+            if isinstance(value, _CONTAINERS):
+                obj[key] = unpack_ordered(value)
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        unpacked = [unpack_ordered(value) if isinstance(value, _CONTAINERS)
+                    else value for value in obj]
+        return tuple(unpacked) if isinstance(obj, tuple) else unpacked
+    return obj
+
+
+def unpack_legacy_ordered(obj):
+    """ Decode OrderedDicts of the first marshal format, which used
+    tuples of (key, value) pairs
+
+    >>> unpack_legacy_ordered({'ds': (('b', 1), ('a', 2))})
+    {'ds': OrderedDict([('b', 1), ('a', 2)])}
+    """
+    if isinstance(obj, tuple):
+        return OrderedDict([(key, unpack_legacy_ordered(value)
+                             if isinstance(value, _CONTAINERS) else value)
+                            for key, value in obj])
+    elif isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            if isinstance(value, _CONTAINERS):
+                obj[key] = unpack_legacy_ordered(value)
+        return obj
+    elif isinstance(obj, list):
+        return [unpack_legacy_ordered(value)
+                if isinstance(value, _CONTAINERS)
+                else value for value in obj]
+    return obj
+
+
+class MarshalCodec(object):
+    """ Codec based on the marshal module (always available) """
+    name = "marshal"
+    version = "\x03"
+
+    def encode(self, data):
+        """ Encode data, version byte included """
+        return self.version + marshal.dumps(pack_ordered(data), 2)
+
+    @staticmethod
+    def decode(payload):
+        """ Decode data, version byte excluded """
+        return unpack_ordered(marshal.loads(payload))
+
+
+class LegacyMarshalCodec(object):
+    """ First marshal format, where tuples marked OrderedDicts
+
+    Only used to read values written before the ORDERED_KEY marker.
+    """
+    name = "marshal-legacy"
+    version = "\x01"
+
+    @staticmethod
+    def decode(payload):
+        """ Decode data, version byte excluded """
+        return unpack_legacy_ordered(marshal.loads(payload))
+
+
+class MsgpackCodec(object):
+    """ Codec based on msgpack (needs the msgpack python module) """
+    name = "msgpack"
+    version = "\x02"
+    # msgpack extension types used for OrderedDicts and tuples
+    ext_ordered = 1
+    ext_tuple = 2
+
+    def __init__(self):
+        if msgpack is None:
+            raise CodecError("msgpack codec needs the msgpack python module")
+
+    def _default(self, obj):
+        """ Encode OrderedDict and tuple as extension types """
+        if isinstance(obj, OrderedDict):
+            return msgpack.ExtType(self.ext_ordered,
+                                   self.encode([list(item) for item
+                                                in obj.iteritems()])[1:])
+        elif isinstance(obj, tuple):
+            return msgpack.ExtType(self.ext_tuple,
+                                   self.encode(list(obj))[1:])
+        raise TypeError("Unknown type: %r" % (obj,))
+
+    def encode(self, data):
+        """ Encode data, version byte included """
+        return self.version + msgpack.packb(data,
+                                            use_bin_type=True,
+                                            strict_types=True,
+                                            default=self._default)
+
+    def _ext_hook(self, code, data):
+        """ Decode OrderedDict and tuple extension types """
+        if code == self.ext_ordered:
+            return OrderedDict(self.decode(data))
+        elif code == self.ext_tuple:
+            return tuple(self.decode(data))
+        return msgpack.ExtType(code, data)
+
+    def decode(self, payload):
+        """ Decode data, version byte excluded """
+        return msgpack.unpackb(payload, raw=False, use_list=True,
+                               ext_hook=self._ext_hook)
+
+
+class ReprCodec(object):
+    """ Legacy codec: python repr of the data
+
+    Only used to read values written by older SNMP Booster versions
+    and to compare with the new codecs.
+    """
+    name = "repr"
+    version = None
+
+    @staticmethod
+    def encode(data):
+        """ Encode data """
+        return str(data)
+
+    @staticmethod
+    def decode(payload):
+        """ Decode data """
+        return eval(payload, {"OrderedDict": OrderedDict})
+
+
+CODECS = {MarshalCodec.name: MarshalCodec,
+          MsgpackCodec.name: MsgpackCodec,
+          }
+
+_CODECS_BY_VERSION = {}
+
+
+def get_codec(name=DEFAULT_CODEC):
+    """ Return an instance of the codec named `name` """
+    if name not in CODECS:
+        raise CodecError("Unknown codec '%s'. Must be in "
+                         "%s" % (name, ", ".join(CODECS.keys())))
+    return CODECS[name]()
+
+
+def decode(raw):
+    """ Decode a value written by any codec
+
+    Return a tuple (data, legacy), legacy is True if the value was
+    written with the old repr format and needs to be rewritten
+    """
+    if raw is None:
+        return None, False
+    version = raw[:1]
+    if version == "{":
+        return ReprCodec.decode(raw), True
+    codec = _CODECS_BY_VERSION.get(version)
+    if codec is None:
+        for codec_class in CODECS.values() + [LegacyMarshalCodec]:
+            if codec_class.version == version:
+                codec = _CODECS_BY_VERSION[version] = codec_class()
+                break
+        else:
+            raise CodecError("Unknown codec version byte: %r" % version)
+    return codec.decode(raw[1:]), False
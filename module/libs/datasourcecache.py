@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the Arbiter compiled datasource cache """
+
+
+import os
+import time
+import hashlib
+import cPickle
+from multiprocessing import Pool
+
+from shinken.log import logger
+
+try:
+    from configobj import ConfigObj
+except ImportError as exp:
+    logger.error("[SnmpBooster] [code 0901] Import error. Maybe one of this "
+                 "module is missing: ConfigObj")
+    raise ImportError(exp)
+
+
+__all__ = ("DatasourceCache", "DatasourceFileError")
+
+
+# Changed when the cache file format changes
+CACHE_VERSION = 1
+
+
+class DatasourceFileError(Exception):
+    """ Error while reading a datasource file """
+    def __init__(self, path, error):
+        Exception.__init__(self, error)
+        self.path = path
+
+
+def file_signature(path):
+    """ Return the (path, mtime, sha1) signature of a datasource file """
+    with open(path, "rb") as ini_file:
+        content_hash = hashlib.sha1(ini_file.read()).hexdigest()
+    return path, os.path.getmtime(path), content_hash
+
+
+def parse_file(path):
+    """ Parse a datasource file
+    Values are interpolated with the DEFAULT sections of the file, as
+    they are when the file is merged with the others
+
+    Return
+    * (path, datasource dict, error message)
+    """
+    try:
+        return path, ConfigObj(path,
+                                   interpolation='template').dict(), None
+    except Exception as exp:
+        return path, None, str(exp)
+
+
+class DatasourceCache(object):
+    """ Merged datasource, compiled in a pickle file
+
+    The cache is keyed by the signatures (path, mtime, content hash) of
+    the datasource files. It also keeps each parsed file, so only the
+    changed files are parsed again, with a process pool
+    """
+
+    def __init__(self, cache_file, nb_processes=1):
+        self.cache_file = cache_file
+        self.nb_processes = nb_processes
+
+    def read(self):
+        """ Read the cache file
+
+        Return
+        * cache: dict or None
+        """
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, "rb") as cache_file:
+                cache = cPickle.load(cache_file)
+            if cache.get('version') != CACHE_VERSION:
+                return None
+            return cache
+        except Exception as exp:
+            logger.warning("[SnmpBooster] [code 0915] Can not read the "
+                           "datasource cache %s: %s" % (self.cache_file,
+                                                        str(exp)))
+            return None
+
+    def write(self, cache):
+        """ Write the cache file
+        The file is replaced atomically, so a broken write never leaves
+        a truncated cache
+        """
+        if not self.cache_file:
+            return
+        tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, "wb") as cache_file:
+                cPickle.dump(cache, cache_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, self.cache_file)
+        except Exception as exp:
+            logger.warning("[SnmpBooster] [code 0915] Can not write the "
+                           "datasource cache %s: %s" % (self.cache_file,
+                                                        str(exp)))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def parse_files(self, paths):
+        """ Parse datasource files, with a process pool if there are
+        several files
+
+        Return
+        * parsed: dict {path: datasource dict}
+        """
+        results = None
+        if self.nb_processes > 1 and len(paths) > 1:
+            pool = None
+            try:
+                pool = Pool(min(self.nb_processes, len(paths)))
+                results = pool.map(parse_file, paths)
+            except Exception as exp:
+                logger.warning("[SnmpBooster] [code 0915] Can not parse the "
+                               "datasource files with processes, they are "
+                               "parsed by the Arbiter: %s" % str(exp))
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+        if results is None:
+            results = [parse_file(path) for path in paths]
+
+        parsed = {}
+        for path, datasource, error in results:
+            if error is not None:
+                raise DatasourceFileError(path, error)
+            parsed[path] = datasource
+        return parsed
+
+    def load(self, paths):
+        """ Return the merged datasource dict of the files, in this order
+        The cache is used if no file changed, else it is updated
+        """
+        start_time = time.time()
+        signatures = [file_signature(path) for path in paths]
+        cache = self.read()
+        if cache is not None and cache['signatures'] == signatures:
+            logger.info("[SnmpBooster] [code 0914] Datasource loaded from "
+                        "the cache %s in %.3fs" % (self.cache_file,
+                                                   time.time() - start_time))
+            return cache['datasource']
+
+        # Parse only new and changed files
+        old_files = cache['files'] if cache is not None else {}
+        changed = [path for path, mtime, content_hash in signatures
+                   if old_files.get(path, (None,))[0] != (mtime,
+                                                          content_hash)]
+        parsed = self.parse_files(changed)
+        files = {}
+        for path, mtime, content_hash in signatures:
+            if path not in parsed:
+                parsed[path] = old_files[path][1]
+            files[path] = ((mtime, content_hash), parsed[path])
+
+        # Merge with interpolation, in the files order
+        merged = ConfigObj(interpolation='template')
+        for path in paths:
+            merged.merge(files[path][1])
+        try:
+            datasource = merged.dict()
+        except Exception as exp:
+            error_message = ("[SnmpBooster] [code 0906] Error during the "
+                             "config conversion: %s" % (str(exp)))
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        self.write({'version': CACHE_VERSION,
+                    'signatures': signatures,
+                    'files': files,
+                    'datasource': datasource,
+                    })
+        logger.info("[SnmpBooster] [code 0914] Datasource compiled in "
+                    "%.3fs: %d/%d files parsed" % (time.time() - start_time,
+                                                   len(changed), len(paths)))
+        return datasource
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the compiled datasource index used to serialize
+services """
+
+
+import re
+from collections import OrderedDict
+
+
+__all__ = ("DatasourceIndex",)
+
+
+REGEX_OID = re.compile('\.\d+(\.\d+)*')
+REGEX_DS_ATTRIBUTE = re.compile('ds_*')
+
+
+class DatasourceIndex(object):
+    """ Datasource compiled once for all services
+
+    The datasource is validated, DS default values are set and each
+    DSTEMPLATE and TRIGGERGROUP is resolved to its DS and trigger data.
+    Errors are kept and raised for each service which uses the faulty
+    part of the datasource, as when it was validated for each service.
+
+    The datasource is never modified: DS and trigger data are copies,
+    shared by all the services which use them, so they must not be
+    modified
+    """
+
+    def __init__(self, datasource):
+        # Error raised for all services
+        self.error = None
+        self.mappings = {}
+        # {ds_name: (ds_data without computed values, ds_data, error)}
+        self.datasources = {}
+        # {dstemplate: (ds name list, error)}
+        self.dstemplates = {}
+        # {triggergroup: (trigger dict, error)}
+        self.triggergroups = {}
+        try:
+            self.compile(datasource)
+        except Exception as exp:
+            self.error = str(exp)
+
+    def compile(self, datasource):
+        """ Validate the datasource and compile all its parts """
+        for section in ('MAP', 'DSTEMPLATE', 'DATASOURCE', 'TRIGGERGROUP'):
+            if section not in datasource:
+                raise Exception("%s section is missing in the datasource "
+                                "files" % section)
+        for mapping_name, mapping in datasource['MAP'].items():
+            if isinstance(mapping, dict):
+                self.mappings[mapping_name] = mapping.get('base_oid')
+
+        the_datasource = datasource['DATASOURCE']
+        for key, value in the_datasource.items():
+            if isinstance(value, (str, unicode)):
+                if not REGEX_OID.match(value) and not REGEX_DS_ATTRIBUTE.match(key):
+                    raise Exception("OID for %s isn't valid: %r" % (key, value))
+
+            if isinstance(value, dict):
+                if '-' in key:
+                    raise Exception("Ds_name  %s isn't valid (contain -)" % key)
+
+        default_ds_type = the_datasource.get("ds_type", "TEXT")
+        default_ds_min_oid_value = the_datasource.get("ds_min_oid_value", None)
+        for ds_name, ds_data in the_datasource.items():
+            if not isinstance(ds_data, dict):
+                continue
+            ds_data = dict(ds_data)
+            # Set default values
+            # If no ds name set, we use the ds key as name
+            # ie: `dot3StatsExcessiveCollisions`
+            ds_data.setdefault("ds_name", ds_name)
+            ds_data.setdefault("ds_type", default_ds_type)
+            ds_data.setdefault("ds_min_oid_value", default_ds_min_oid_value)
+            for name in ["ds_unit", ]:
+                ds_data.setdefault(name, "")
+            # Set default ds datas
+            for name in ["ds_calc",
+                         "ds_max_oid",
+                         "ds_min_oid",
+                         ]:
+                ds_data.setdefault(name, None)
+            try:
+                self.datasources[ds_name] = (ds_data,
+                                             self.compute_ds(ds_name, ds_data),
+                                             None)
+            except Exception as exp:
+                self.datasources[ds_name] = (ds_data, None, str(exp))
+
+        for dstemplate, ds_list in datasource['DSTEMPLATE'].items():
+            try:
+                self.dstemplates[dstemplate] = (self.compile_dstemplate(ds_list),
+                                                None)
+            except Exception as exp:
+                self.dstemplates[dstemplate] = (None, str(exp))
+
+        triggers = datasource.get('TRIGGER')
+        for triggergroup, trigger_list in datasource['TRIGGERGROUP'].items():
+            try:
+                self.triggergroups[triggergroup] = (
+                    self.compile_triggergroup(trigger_list, triggers), None)
+            except Exception as exp:
+                self.triggergroups[triggergroup] = (None, str(exp))
+
+    @staticmethod
+    def compute_ds(ds_name, ds_data):
+        """ Return a copy of ds_data with its computed values """
+        ds_data = dict(ds_data)
+        # Add computed_value for max and min
+        for max_min in ['ds_max_oid_value', 'ds_min_oid_value']:
+            if ds_data.get(max_min) is not None:
+                try:
+                    ds_data[max_min + '_computed'] = float(ds_data.get(max_min))
+                except Exception:
+                    raise Exception("Bad format: %s value "
+                                    "(must be a float/int)" % max_min)
+
+        # Check if ds_oid is set
+        if "ds_oid" not in ds_data:
+            raise Exception("ds_oid is not defined in %s" % ds_name)
+        return ds_data
+
+    def compile_dstemplate(self, dstemplate):
+        """ Return the DS names of a DSTEMPLATE """
+        # Get DSs in the dstemplate
+        ds_list = dstemplate.get('ds') if isinstance(dstemplate, dict) else None
+        # The 2 following must be useless, but I will let it
+        # In case of the datasource files are not clean ...
+        if isinstance(ds_list, str):
+            # Handle if ds_list is a str and not a list.
+            ds_list = [ds_name.strip() for ds_name in ds_list.split(',')]
+        elif not isinstance(ds_list, list):
+            raise Exception("Bad format: DS %s in datasource files" % str(ds_list))
+        for ds_name in ds_list:
+            if ds_name not in self.datasources:
+                raise Exception("ds %s is missing in datasource filess" % ds_name)
+        return ds_list
+
+    @staticmethod
+    def compile_triggergroup(trigger_list, triggers):
+        """ Return the trigger data of a TRIGGERGROUP """
+        # Check if it's a string, if yes we transform it into a list
+        if isinstance(trigger_list, str):
+            trigger_list = [trigger_list]
+        compiled = {}
+        # Browse all triggers in the triggergroup
+        for trigger_name in trigger_list:
+            if triggers is None:
+                raise Exception("TRIGGER section is not define in the "
+                                "datasource")
+            # Get trigger data
+            trigger_data = triggers.get(trigger_name)
+            if trigger_data is None:
+                raise Exception("TRIGGER %s is not define in the "
+                                "datasource" % trigger_name)
+            trigger_data = dict(trigger_data)
+            # Get critical trigger (list)
+            trigger_data.setdefault("critical", None)
+            # Get warning trigger (list)
+            trigger_data.setdefault("warning", None)
+            # Get default trigger (int)
+            try:
+                trigger_data.setdefault("default_status", int(triggers.get("default_status", 3)))
+            except:
+                raise Exception("Bad format: default_status value "
+                                "(must be a float/int)")
+            # Add trigger in trigger list
+            compiled[trigger_name] = trigger_data
+        return compiled
+
+    def check(self):
+        """ Raise the error of the whole datasource, if any """
+        if self.error is not None:
+            raise Exception(self.error)
+
+    def get_mapping(self, mapping_name):
+        """ Return the base OID of a mapping """
+        base_oid = self.mappings.get(mapping_name)
+        if base_oid is None:
+            raise Exception("mapping %s is not defined in the "
+                            "datasource" % mapping_name)
+        return base_oid
+
+    def get_ds(self, dstemplate, dict_max=None):
+        """ Return the DS data of a DSTEMPLATE, as an OrderedDict
+        `dict_max' gives the max values of maximised datasources
+        """
+        if dstemplate not in self.dstemplates:
+            raise Exception("DSTEMPLATE %s is empty" % dstemplate)
+        ds_list, error = self.dstemplates[dstemplate]
+        if error is not None:
+            raise Exception(error)
+        ds_dict = OrderedDict()
+        for ds_name in ds_list:
+            ds_data, computed_ds_data, error = self.datasources[ds_name]
+            # If we have 'maximise-datasources-value' for the current
+            # ds_name, we set ds_max_oid to None
+            # And we set our max value to ds_max_oid_value
+            if dict_max and dict_max.get(ds_name, None):
+                ds_data = dict(ds_data)
+                ds_data["ds_max_oid"] = None
+                ds_data['ds_max_oid_value'] = dict_max[ds_name]
+                computed_ds_data = self.compute_ds(ds_name, ds_data)
+            elif error is not None:
+                raise Exception(error)
+            # add ds in ds list
+            ds_dict[ds_name] = computed_ds_data
+        return ds_dict
+
+    def get_triggers(self, triggergroup):
+        """ Return the trigger data of a TRIGGERGROUP """
+        if triggergroup not in self.triggergroups:
+            return {}
+        triggers, error = self.triggergroups[triggergroup]
+        if error is not None:
+            raise Exception(error)
+        return triggers
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the SNMP capability profiles of the devices,
+learned from their responses by the SNMP workers and used to prepare
+the SNMP requests
+"""
+
+import json
+from threading import Lock
+
+# Max number of oids in a GET request, whatever the device accepts
+MAX_REQUEST_OIDS = 128
+# SNMP error status of the responses too big for the device
+TOO_BIG = 1
+
+
+class DeviceProfile(object):
+    """ SNMP capabilities of a device
+
+    * max_oids: max number of oids in a GET request, up to the
+      configured one (None: not learned)
+    * ok_oids, ok_size: largest GET request (number of oids) and
+      response (size of the var binds, in bytes) answered by the device
+    * too_big_oids, too_big_size: smallest GET request and expected
+      response size which got tooBig, or timed out while smaller
+      requests work (0: none)
+    * bulk: GETBULK works (True), does not work (False), unknown (None)
+    * table_rows: number of rows of the walked table columns, by column
+      oid
+    """
+    def __init__(self, data=None):
+        self.max_oids = None
+        self.ok_oids = 0
+        self.ok_size = 0
+        self.too_big_oids = 0
+        self.too_big_size = 0
+        self.bulk = None
+        self.table_rows = {}
+        if data:
+            self.load(data)
+
+    def load(self, data):
+        """ Read a profile stored by dump """
+        if data.get('max_oids'):
+            self.max_oids = int(data['max_oids'])
+        for name in ('ok_oids', 'ok_size', 'too_big_oids', 'too_big_size'):
+            self.__dict__[name] = int(data.get(name) or 0)
+        if data.get('bulk'):
+            self.bulk = data['bulk'] == '1'
+        if data.get('table_rows'):
+            self.table_rows = json.loads(data['table_rows'])
+
+    def dump(self):
+        """ Return the profile as a dict of strings """
+        return {'max_oids': self.max_oids or '',
+                'ok_oids': self.ok_oids,
+                'ok_size': self.ok_size,
+                'too_big_oids': self.too_big_oids,
+                'too_big_size': self.too_big_size,
+                'bulk': '' if self.bulk is None else int(self.bulk),
+                'table_rows': json.dumps(self.table_rows),
+                }
+
+    def get_limits(self, group_size):
+        """ Return the max number of oids and response size of a GET
+        request, `group_size' is the configured number of oids: the
+        learned number of oids can only lower it
+
+        Return
+        * (max oids, max size in bytes or None)
+        """
+        max_oids = min(self.max_oids or group_size, group_size)
+        max_size = None
+        if self.too_big_size:
+            # Sizes are estimated: a response which was too big can be
+            # bigger than an accepted one
+            max_size = max(self.too_big_size - 1, self.ok_size)
+        return max_oids, max_size
+
+    def request_ok(self, nb_oids, size, max_oids):
+        """ A GET request got a response. `max_oids' is the limit used to
+        prepare it: the limit grows when full requests work
+
+        Return True if the profile changed
+        """
+        changed = False
+        if nb_oids > self.ok_oids:
+            self.ok_oids = nb_oids
+            changed = True
+        if size > self.ok_size:
+            self.ok_size = size
+            changed = True
+        if nb_oids >= max_oids:
+            new_max_oids = min(max_oids + max(max_oids // 4, 1),
+                               MAX_REQUEST_OIDS)
+            if self.too_big_oids:
+                new_max_oids = min(new_max_oids, self.too_big_oids - 1)
+            if new_max_oids > (self.max_oids or 0):
+                self.max_oids = new_max_oids
+                changed = True
+        return changed
+
+    def request_too_big(self, nb_oids, size):
+        """ A GET request got tooBig, or its response was lost while
+        smaller requests work: its limits are lowered
+
+        Return True (the profile changed)
+        """
+        if not self.too_big_oids or nb_oids < self.too_big_oids:
+            self.too_big_oids = nb_oids
+        if size and (not self.too_big_size or size < self.too_big_size):
+            self.too_big_size = size
+        max_oids = max(nb_oids // 2, 1)
+        if self.ok_oids < nb_oids:
+            # Smaller requests work
+            max_oids = max(max_oids, self.ok_oids)
+        self.max_oids = min(self.max_oids or nb_oids, max_oids)
+        return True
+
+    def bulk_result(self, success):
+        """ A GETBULK request got a response (success) or an error
+
+        Return True if the profile changed
+        """
+        if self.bulk == success:
+            return False
+        self.bulk = success
+        return True
+
+    def table_walked(self, column, rows):
+        """ A table column was walked to its end
+
+        Return True if the profile changed
+        """
+        if self.table_rows.get(column) == rows:
+            return False
+        self.table_rows[column] = rows
+        return True
+
+
+class DeviceProfiles(object):
+    """ Profiles of the devices, by address
+
+    Profiles are read from the database by load, when a device is
+    checked, before its SNMP tasks are queued. The SNMP workers update
+    the loaded profiles with update, and changed profiles are written
+    by flush. Changes and dumps are made under a lock: they run in
+    different threads
+    """
+    def __init__(self, db_client):
+        self.db_client = db_client
+        self.profiles = {}
+        self.changed = set()
+        self.lock = Lock()
+
+    def load(self, address):
+        """ Return the profile of a device, read from the database the
+        first time
+        """
+        profile = self.profiles.get(address)
+        if profile is None:
+            data = self.db_client.get_device_profile(address)
+            with self.lock:
+                profile = self.profiles.setdefault(address,
+                                                   DeviceProfile(data))
+        return profile
+
+    def update(self, address, function, *args):
+        """ Call function(profile, *args) on the loaded profile of a
+        device, which is marked to be written if it returns True
+        Devices without loaded profile are ignored
+        """
+        with self.lock:
+            profile = self.profiles.get(address)
+            if profile is not None and function(profile, *args):
+                self.changed.add(address)
+
+    def flush(self):
+        """ Write the changed profiles """
+        with self.lock:
+            if not self.changed:
+                return
+            changed, self.changed = self.changed, set()
+            profiles = dict([(address, self.profiles[address].dump())
+                             for address in changed])
+        self.db_client.write_device_profiles(profiles)
@@ -23,34 +23,440 @@
 """ This module contains database/cache abstraction class """
 
 
+import hashlib
+import json
+import os
+import random
 import re
-
+import socket
+import time
 from collections import OrderedDict
+from threading import Thread
 
 from shinken.log import logger
 
 try:
     from redis import StrictRedis
+    from redis.client import PubSub
+    from redis.connection import (BlockingConnectionPool, Connection,
+                                  ConnectionPool, UnixDomainSocketConnection)
+    from redis.exceptions import ResponseError, ConnectionError, TimeoutError
 except ImportError as exp:
     logger.error("[SnmpBooster] [code 1301] Import error. "
                  "Python Redis seems missing.")
     raise ImportError(exp)
 
+try:
+    from rediscluster import StrictRedisCluster
+    from rediscluster.exceptions import RedisClusterException
+except ImportError:
+    StrictRedisCluster = None
+    RedisClusterException = ConnectionError
+
+from codec import get_codec, decode as decode_value, DEFAULT_CODEC, \
+    pack_ordered
+from servicecache import ServiceCache
 from utils import merge_dicts
 
 
+# Service key layout
+# Each host:service key is a hash:
+# * CONFIG_FIELD holds the service configuration written by the Arbiter,
+#   without its template
+# * TEMPLATE_FIELD holds the hash of the service template (not encoded):
+#   the datasource definitions ('ds') and the triggers, shared by all
+#   services which use the same dstemplate and triggergroup. Templates
+#   are stored once, in TEMPLATE_KEY
+# * HASH_FIELD holds the hash of this configuration (not encoded), used
+#   by the Arbiter to write only changed services
+# * Each value written by the Poller is stored in its own field:
+#   top level values (check_time, instance, ...) use their name and
+#   datasource values use "ds.<ds_name>.<attribute>"
+# Fields override the values found in CONFIG_FIELD.
+# All values are encoded with the codec.
+CONFIG_FIELD = "_config"
+TEMPLATE_FIELD = "_template"
+HASH_FIELD = "_hash"
+TEMPLATE_ATTRIBUTES = ('ds', 'triggers')
+DS_FIELD_PREFIX = "ds."
+
+# Keys used internally by SNMP Booster (indexes, ...) start with this prefix
+# Indexes are sets:
+# * index:hosts and index:services list all host and service names
+# * index:host:<host> lists the services of a host
+# * index:service:<service> lists the hosts which have this service
+# * index:intervals:<host> lists the check intervals of a host
+INTERNAL_PREFIX = "__booster__:"
+# Service templates are strings named after the hash of their content,
+# so they never change
+TEMPLATE_KEY = INTERNAL_PREFIX + "template:%s"
+# Changed when the way services are stored changes: the Arbiter rewrites
+# all services once
+LAYOUT_VERSION = 2
+REGEX_INTERVAL_KEY = re.compile(":[0-9]+$")
+# Number of keys asked by each SCAN request
+SCAN_COUNT = 1000
+# Number of services read by each pipelined request
+READ_BATCH_SIZE = 500
+# Keyspace notification classes needed to invalidate the service cache:
+# keyspace events (K), generic commands like DEL (g), hash commands (h),
+# expired (x) and evicted (e) keys
+NOTIFY_FLAGS = "Kghxe"
+# Time (seconds) between two replica lag measures
+REPLICA_CHECK_INTERVAL = 1
+# Heartbeat key (time of the primary) written on the primary every
+# REPLICA_CHECK_INTERVAL by each process which uses replicas, and read
+# on the replicas to measure their lag
+HEARTBEAT_KEY = INTERNAL_PREFIX + "heartbeat"
+# FLUSHALL does not send keyspace notifications: clear_cache publishes
+# on this channel to empty the service caches
+CLEAR_CHANNEL = INTERNAL_PREFIX + "cache:clear"
+# SNMP capability profile of a device (see DeviceProfile), a hash of
+# strings, by device address
+PROFILE_KEY = INTERNAL_PREFIX + "profile:%s"
+
+# Convert a service stored in a string (written by older versions)
+# to a hash, only if nobody wrote the key since we read it
+MIGRATE_SCRIPT = """
+if redis.call('TYPE', KEYS[1])['ok'] == 'string' and
+   redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+end
+return 0
+"""
+
+# Get a service (KEYS[1]) and, if the host:interval key (KEYS[2]) is
+# given, all services of this set. ARGV[1] is the "host:" key prefix
+# Each service is returned as its hash fields (flat list) or as a string
+# if it was written by an older version
+SNAPSHOT_SCRIPT = """
+local function get_service(key)
+    if redis.call('TYPE', key)['ok'] == 'string' then
+        return redis.call('GET', key)
+    end
+    return redis.call('HGETALL', key)
+end
+local result = {get_service(KEYS[1])}
+if KEYS[2] then
+    local services = redis.call('SMEMBERS', KEYS[2])
+    for _, service in ipairs(services) do
+        result[#result + 1] = service
+        result[#result + 1] = get_service(ARGV[1] .. service)
+    end
+end
+return result
+"""
+
+
+class Backoff(object):
+    """ Exponential backoff between connection attempts
+
+    After each failed attempt, the delay before the next attempt is
+    doubled, from `base' up to `maximum' seconds. A successful
+    connection resets it.
+    """
+    def __init__(self, base=0.5, maximum=30):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+        self.delay = 0
+        self.next_attempt = 0
+        self.last_error = None
+
+    def check(self):
+        """ Raise ConnectionError if we must wait before the next attempt """
+        wait = self.next_attempt - time.time()
+        if wait > 0:
+            raise ConnectionError("%s (%d failures, next attempt in "
+                                  "%.1fs)" % (self.last_error, self.failures,
+                                              wait))
+
+    def failed(self, error):
+        """ Record a failed attempt """
+        self.last_error = error
+        self.failures += 1
+        self.delay = min(self.base * 2 ** (self.failures - 1), self.maximum)
+        self.next_attempt = time.time() + self.delay
+
+    def succeeded(self):
+        """ Record a successful attempt """
+        self.failures = 0
+        self.delay = 0
+        self.next_attempt = 0
+        self.last_error = None
+
+
+class BackoffMixin(object):
+    """ Connection which does not try to reconnect before the delay
+    given by the Backoff object of its pool
+
+    Without it, each command sent while Redis is down would wait for
+    the connect timeout
+    """
+    backoff = None
+
+    def connect(self):
+        """ Connect to Redis, unless we must wait """
+        if self._sock is not None:
+            return
+        if self.backoff is None:
+            return super(BackoffMixin, self).connect()
+        self.backoff.check()
+        try:
+            super(BackoffMixin, self).connect()
+        except (ConnectionError, TimeoutError) as exp:
+            self.backoff.failed(str(exp))
+            raise
+        self.backoff.succeeded()
+
+
+class BackoffConnection(BackoffMixin, Connection):
+    """ TCP connection with reconnect backoff """
+    pass
+
+
+class BackoffUnixConnection(BackoffMixin, UnixDomainSocketConnection):
+    """ Unix socket connection with reconnect backoff """
+    pass
+
+
+class TimedConnectionPool(BlockingConnectionPool):
+    """ Connection pool which keeps statistics about the time spent
+    waiting for a free connection
+
+    When all connections are used, the caller waits up to `timeout'
+    seconds, then gets a ConnectionError
+    """
+    def __init__(self, backoff=None, **kwargs):
+        self.backoff = backoff
+        self.wait_stats = {}
+        self.reset_wait_stats()
+        BlockingConnectionPool.__init__(self, **kwargs)
+
+    def make_connection(self):
+        """ Create a new connection sharing the pool backoff """
+        connection = BlockingConnectionPool.make_connection(self)
+        connection.backoff = self.backoff
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        """ Get a connection and record how long we waited for it """
+        start_time = time.time()
+        try:
+            return BlockingConnectionPool.get_connection(self, command_name,
+                                                         *keys, **options)
+        except ConnectionError:
+            self.wait_stats['timeouts'] += 1
+            raise
+        finally:
+            wait = time.time() - start_time
+            self.wait_stats['count'] += 1
+            self.wait_stats['total'] += wait
+            self.wait_stats['max'] = max(self.wait_stats['max'], wait)
+
+    def reset_wait_stats(self):
+        """ Reset connection wait statistics """
+        self.wait_stats = {'count': 0,
+                           'total': 0.0,
+                           'max': 0.0,
+                           'timeouts': 0,
+                           }
+
+    def get_wait_stats(self):
+        """ Return connection wait statistics and reset them """
+        stats = self.wait_stats
+        free = len([conn for conn in list(self.pool.queue)
+                    if conn is not None])
+        stats['in_use'] = len(self._connections) - free
+        stats['created'] = len(self._connections)
+        self.reset_wait_stats()
+        return stats
+
+
+class InvalidationPubSub(PubSub):
+    """ PubSub which remembers it was reconnected to Redis:
+    the notifications sent while it was disconnected are lost
+    """
+    reconnected = False
+
+    def on_connect(self, connection):
+        """ Subscribe again after a reconnection """
+        if self.channels or self.patterns:
+            self.reconnected = True
+        PubSub.on_connect(self, connection)
+
+
+def is_wrong_type(exp):
+    """ Is the Redis error due to a service stored in a string ? """
+    return isinstance(exp, ResponseError) and "WRONGTYPE" in str(exp)
+
+
+def server_time(conn):
+    """ Return the time of a Redis server, in seconds """
+    seconds, microseconds = conn.time()
+    return seconds + microseconds / 1000000.0
+
+
 class DBClient(object):
     """ Class used to abstract the use of the database/cache """
 
-    def __init__(self, db_host, db_port=6379, db_name=None):
+    def __init__(self, db_host, db_port=6379, db_name=None,
+                 codec=DEFAULT_CODEC, db_socket=None, max_connections=10,
+                 pool_timeout=5, connect_timeout=5, socket_timeout=10,
+                 keepalive=True, connect_retries=5, retry_backoff=0.5,
+                 retry_backoff_max=30, cluster_nodes=None, replicas=None,
+                 max_replica_lag=5):
         self.db_host = db_host
         self.db_port = db_port
+        # Redis Cluster startup nodes ("host:port" list)
+        self.cluster_nodes = cluster_nodes or []
+        if self.cluster_nodes and StrictRedisCluster is None:
+            raise ImportError("Redis Cluster support needs the "
+                              "redis-py-cluster python module")
+        # db_name is the Redis database number, if it is one
+        # (older configurations use a name which was never used)
+        if str(db_name).isdigit() and not self.cluster_nodes:
+            self.db_number = int(db_name)
+        else:
+            self.db_number = 0
+        self.db_socket = db_socket
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self.keepalive = keepalive
+        self.connect_retries = connect_retries
+        self.backoff = Backoff(retry_backoff, retry_backoff_max)
+        self.db_pool = None
         self.db_conn = None
+        # Poller local service cache, see enable_cache
+        self.cache = None
+        self.pubsubs = None
+        self.pubsub_nodes = None
+        self.keyspace_prefix = "__keyspace@%d__:" % self.db_number
+        # Number of our own writes of cached services for which we will
+        # get a notification, by key
+        self.own_writes = {}
+        # Read only replicas ("host:port" list), used by get_service and
+        # get_services if their lag is lower than max_replica_lag seconds
+        self.replica_nodes = replicas or []
+        self.max_replica_lag = max_replica_lag
+        self.replicas = []
+        self.last_replica_check = 0
+        # Process which writes the heartbeat
+        self.heartbeat_pid = None
+        self.replica_stats = {}
+        self.reset_replica_stats()
+        self.codec = get_codec(codec)
+        self.migrate_script = None
+        self.snapshot_script = None
+        # Check interval of the services seen by get_host_snapshot
+        self.check_intervals = {}
+        # Decoded templates, by hash. Templates never change, so this
+        # cache is never invalidated
+        self.templates = {}
+        # Hashes of the templates written by this client
+        self.written_templates = set()
+
+    def build_pool(self, host=None, port=None, backoff=None):
+        """ Create the connection pool, using the unix socket if set
+        `host' and `port' are used for replicas
+        """
+        kwargs = {'db': self.db_number,
+                  'socket_timeout': self.socket_timeout,
+                  }
+        if self.db_socket and host is None:
+            kwargs['path'] = self.db_socket
+            connection_class = BackoffUnixConnection
+        else:
+            kwargs['host'] = host or self.db_host
+            kwargs['port'] = port or self.db_port
+            kwargs['socket_connect_timeout'] = self.connect_timeout
+            kwargs['socket_keepalive'] = self.keepalive
+            if self.keepalive and hasattr(socket, 'TCP_KEEPIDLE'):
+                # Detect dead Redis servers in about one minute
+                kwargs['socket_keepalive_options'] = {
+                    socket.TCP_KEEPIDLE: 30,
+                    socket.TCP_KEEPINTVL: 10,
+                    socket.TCP_KEEPCNT: 3,
+                    }
+            connection_class = BackoffConnection
+        return TimedConnectionPool(backoff=backoff or self.backoff,
+                                   max_connections=self.max_connections,
+                                   timeout=self.pool_timeout,
+                                   connection_class=connection_class,
+                                   **kwargs)
+
+    def build_cluster_client(self):
+        """ Create the Redis Cluster client
+        The cluster client manages its own connection pools
+        """
+        startup_nodes = []
+        for node in self.cluster_nodes:
+            host, port = node.rsplit(":", 1)
+            startup_nodes.append({'host': host, 'port': int(port)})
+        return StrictRedisCluster(startup_nodes=startup_nodes,
+                                  max_connections=self.max_connections,
+                                  max_connections_per_node=True,
+                                  skip_full_coverage_check=True,
+                                  socket_timeout=self.socket_timeout,
+                                  socket_connect_timeout=self.connect_timeout,
+                                  socket_keepalive=self.keepalive)
 
     def connect(self):
-        """ This function inits the connection to the database """
+        """ This function inits the connection to the database
+        Failed connections are retried `connect_retries' times
+        with an exponential backoff
+        """
         try:
-            self.db_conn = StrictRedis(host=self.db_host, port=self.db_port)
+            if not self.cluster_nodes:
+                self.db_pool = self.build_pool()
+                self.db_conn = StrictRedis(connection_pool=self.db_pool)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1302] Redis Connection error:"
+                         " %s" % str(exp))
+            return False
+        for attempt in range(self.connect_retries + 1):
+            try:
+                if self.db_conn is None:
+                    # The cluster client connects to get the slot map
+                    self.db_conn = self.build_cluster_client()
+                self.db_conn.ping()
+                break
+            except (ConnectionError, TimeoutError,
+                    RedisClusterException) as exp:
+                if attempt == self.connect_retries:
+                    logger.error("[SnmpBooster] [code 1302] Redis Connection "
+                                 "error: %s" % str(exp))
+                    return False
+                if self.backoff.next_attempt <= time.time():
+                    # Not recorded by the connection (cluster client)
+                    self.backoff.failed(str(exp))
+                delay = self.backoff.next_attempt - time.time()
+                logger.warning("[SnmpBooster] [code 1313] Redis connection "
+                               "failed (%s), retrying in "
+                               "%.1fs" % (str(exp), delay))
+                time.sleep(delay)
+        if self.replica_nodes and self.cluster_nodes:
+            logger.warning("[SnmpBooster] [code 1316] Replicas are not "
+                           "used with Redis Cluster")
+        elif self.replica_nodes:
+            self.replicas = []
+            for node in self.replica_nodes:
+                host, port = node.rsplit(":", 1)
+                pool = self.build_pool(host, int(port),
+                                       Backoff(self.backoff.base,
+                                               self.backoff.maximum))
+                self.replicas.append({'name': node,
+                                      'conn': StrictRedis(connection_pool=pool),
+                                      'lag': None,
+                                      'down': False,
+                                      })
+        try:
+            self.migrate_script = self.db_conn.register_script(MIGRATE_SCRIPT)
+            self.snapshot_script = self.db_conn.register_script(
+                SNAPSHOT_SCRIPT)
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1302] Redis Connection error:"
                          " %s" % str(exp))
@@ -59,40 +465,617 @@ class DBClient(object):
 
     def disconnect(self):
         """ This function kills the connection to the database """
-        pass
+        self.heartbeat_pid = None
+        if self.db_conn is not None:
+            self.db_conn.connection_pool.disconnect()
+
+    def start_heartbeat(self):
+        """ Start the thread which writes the heartbeat in this process
+        (threads do not survive a fork)
+        """
+        if self.heartbeat_pid == os.getpid():
+            return
+        self.heartbeat_pid = os.getpid()
+        thread = Thread(target=self.write_heartbeat,
+                        args=(self.heartbeat_pid,),
+                        name="snmpbooster-heartbeat")
+        thread.daemon = True
+        thread.start()
+
+    def write_heartbeat(self, pid):
+        """ Write the time of the primary in the heartbeat key every
+        REPLICA_CHECK_INTERVAL, until the client is disconnected
+        """
+        while self.heartbeat_pid == pid:
+            try:
+                self.db_conn.set(HEARTBEAT_KEY, repr(server_time(self.db_conn)),
+                                 ex=max(REPLICA_CHECK_INTERVAL * 60, 60))
+            except Exception:
+                pass
+            time.sleep(REPLICA_CHECK_INTERVAL)
+
+    def check_replicas(self):
+        """ Measure the lag of each replica, at most once per
+        REPLICA_CHECK_INTERVAL
+
+        The lag of a replica is the age of the heartbeat it has, measured
+        with the time of the primary: an upper bound of how late its data
+        can be (heartbeats are REPLICA_CHECK_INTERVAL apart).
+        Without a recent heartbeat (no process writes it yet), a replica
+        whose replication offset has reached the offset of the primary
+        has all the writes done before the check: its lag is 0
+        """
+        now = time.time()
+        if now - self.last_replica_check < REPLICA_CHECK_INTERVAL:
+            return
+        self.last_replica_check = now
+        self.start_heartbeat()
+        primary_offset = None
+        try:
+            primary_time = server_time(self.db_conn)
+        except Exception:
+            for replica in self.replicas:
+                replica['lag'] = None
+            return
+        for replica in self.replicas:
+            try:
+                heartbeat = replica['conn'].get(HEARTBEAT_KEY)
+                lag = None
+                if heartbeat is not None:
+                    lag = max(primary_time - float(heartbeat), 0)
+                if lag is None or lag > self.max_replica_lag:
+                    if primary_offset is None:
+                        primary_offset = self.db_conn.info(
+                            'replication').get('master_repl_offset', -1)
+                    offset = replica['conn'].info('replication').get(
+                        'slave_repl_offset', -1)
+                    if primary_offset >= 0 and offset >= primary_offset:
+                        lag = 0
+            except Exception as exp:
+                if not replica['down']:
+                    logger.warning("[SnmpBooster] [code 1316] Replica %s "
+                                   "is not used: %s" % (replica['name'],
+                                                        str(exp)))
+                replica['down'] = True
+                replica['lag'] = None
+                continue
+            replica['down'] = False
+            replica['lag'] = lag
+
+    def get_read_connection(self):
+        """ Return a replica, with a lag lower than max_replica_lag,
+        or None if no replica can be used
+        """
+        if not self.replicas:
+            return None
+        self.check_replicas()
+        replicas = [replica for replica in self.replicas
+                    if replica['lag'] is not None
+                    and replica['lag'] <= self.max_replica_lag]
+        if not replicas:
+            return None
+        return random.choice(replicas)
 
     @staticmethod
-    def build_key(part1, part2):
+    def is_stale(data):
+        """ Is the service read on a replica older than one check
+        interval ? The replica can miss the last collected data
+        """
+        if data is None:
+            return True
+        check_time = data.get('check_time')
+        check_interval = data.get('check_interval')
+        if check_time is None or check_interval is None:
+            return False
+        return time.time() - check_time > int(check_interval) * 60
+
+    def reset_replica_stats(self):
+        """ Reset replica read statistics """
+        self.replica_stats = {'replica': 0,
+                              'primary': 0,
+                              'stale': 0,
+                              'errors': 0,
+                              }
+
+    def get_replica_stats(self):
+        """ Return replica read statistics since the last call
+        and the current replica lags
+        """
+        if not self.replicas:
+            return None
+        stats = self.replica_stats
+        stats['lags'] = dict([(replica['name'], replica['lag'])
+                              for replica in self.replicas])
+        self.reset_replica_stats()
+        return stats
+
+    def enable_cache(self, max_size):
+        """ Enable the local service cache used by get_cached_service
+
+        Cached services are invalidated by Redis keyspace notifications,
+        so the cache is not enabled if they can not be enabled.
+        The notifications use one connection of the pool (one connection
+        to each master node with Redis Cluster).
+        Must be called in the process which uses the cache
+        """
+        try:
+            for pool in self.notification_pools():
+                self.enable_notifications(StrictRedis(connection_pool=pool))
+        except Exception as exp:
+            logger.warning("[SnmpBooster] [code 1314] Can not enable Redis "
+                           "keyspace notifications, the service cache is "
+                           "disabled: %s" % str(exp))
+            return False
+        self.cache = ServiceCache(max_size)
+        self.subscribe_invalidations()
+        return True
+
+    @staticmethod
+    def enable_notifications(conn):
+        """ Enable the keyspace notifications needed by the cache """
+        current = conn.config_get('notify-keyspace-events')
+        flags = current.get('notify-keyspace-events', '')
+        missing = [flag for flag in NOTIFY_FLAGS if flag not in flags]
+        if 'A' in flags:
+            missing = [flag for flag in missing if flag not in 'ghxe']
+        if missing:
+            conn.config_set('notify-keyspace-events',
+                            flags + "".join(missing))
+
+    def get_master_nodes(self):
+        """ List (host, port) of the Redis Cluster master nodes """
+        return sorted((node['host'], node['port']) for node
+                      in self.db_conn.connection_pool.nodes.all_masters())
+
+    def notification_pools(self):
+        """ Return the connection pools used to get keyspace notifications
+        Notifications are sent by the node which holds the key, so with
+        Redis Cluster we need one connection to each master node
+        """
+        if not self.cluster_nodes:
+            return [self.db_pool]
+        return [ConnectionPool(host=host, port=port,
+                               socket_timeout=self.socket_timeout,
+                               socket_connect_timeout=self.connect_timeout,
+                               socket_keepalive=self.keepalive)
+                for host, port in self.get_master_nodes()]
+
+    def subscribe_invalidations(self):
+        """ Subscribe to the keyspace notifications """
+        pubsubs = []
+        try:
+            if self.cluster_nodes:
+                self.pubsub_nodes = self.get_master_nodes()
+            for pool in self.notification_pools():
+                pubsub = InvalidationPubSub(pool)
+                pubsubs.append(pubsub)
+                pubsub.psubscribe(self.keyspace_prefix + "*")
+                pubsub.subscribe(CLEAR_CHANNEL)
+        except Exception as exp:
+            logger.warning("[SnmpBooster] [code 1315] Service cache "
+                           "invalidation error: %s" % str(exp))
+            self.close_pubsubs(pubsubs)
+            return False
+        self.pubsubs = pubsubs
+        return True
+
+    @staticmethod
+    def close_pubsubs(pubsubs):
+        """ Close keyspace notification connections """
+        for pubsub in pubsubs:
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+
+    def process_invalidations(self):
+        """ Remove from the cache the services changed in Redis
+        The notifications of our own writes (see update_services)
+        are skipped, the cache is already up to date
+
+        Return False if the cache can not be used
+        """
+        if self.pubsubs is None and not self.subscribe_invalidations():
+            return False
+        try:
+            for pubsub in self.pubsubs:
+                self.read_invalidations(pubsub)
+            if self.cluster_nodes and \
+                    self.get_master_nodes() != self.pubsub_nodes:
+                # Keys moved to nodes we don't listen to
+                raise ConnectionError("Redis Cluster nodes changed")
+        except Exception as exp:
+            # Notifications can be lost, forget everything
+            logger.warning("[SnmpBooster] [code 1315] Service cache "
+                           "invalidation error, cache cleared: %s" % str(exp))
+            self.cache.clear()
+            self.own_writes = {}
+            self.close_pubsubs(self.pubsubs)
+            self.pubsubs = None
+            return False
+        return True
+
+    def read_invalidations(self, pubsub):
+        """ Read the waiting notifications of one Redis node """
+        while True:
+            message = pubsub.get_message()
+            if message is None:
+                break
+            if message['type'] not in ('message', 'pmessage'):
+                # Subscription confirmations
+                continue
+            if message['type'] == 'message':
+                # Database flushed
+                self.cache.clear()
+                self.own_writes = {}
+                continue
+            key = message['channel'][len(self.keyspace_prefix):]
+            if message['data'] == 'hset' and key in self.own_writes:
+                self.own_writes[key] -= 1
+                if self.own_writes[key] == 0:
+                    del self.own_writes[key]
+                continue
+            self.cache.invalidate(key)
+            self.own_writes.pop(key, None)
+        if pubsub.reconnected:
+            raise ConnectionError("Reconnected to Redis")
+
+    def invalidate(self, key):
+        """ Remove a service from the cache after we changed it """
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    def get_cache_stats(self):
+        """ Return service cache statistics since the last call """
+        if self.cache is None:
+            return None
+        stats = self.cache.get_stats()
+        stats['templates'] = len(self.templates)
+        return stats
+
+    def get_pool_stats(self):
+        """ Return connection pool wait statistics since the last call """
+        if self.db_pool is None:
+            return None
+        return self.db_pool.get_wait_stats()
+
+    def build_key(self, part1, part2):
         """ Build Redis key
+        With Redis Cluster, the host (part1) is a hash tag, so all keys
+        of a host are in the same slot
 
-        >>> build_key("part1", "part2")
-        'part1:part2'
+        >>> DBClient("localhost").build_key("myhost", "ifInOctets")
+        'myhost:ifInOctets'
+        >>> DBClient(None, cluster_nodes=["localhost:7000"]).build_key(
+        ...     "myhost", "ifInOctets")
+        '{myhost}:ifInOctets'
         """
+        if self.cluster_nodes:
+            return "".join(("{", str(part1), "}:", str(part2)))
         return ":".join((str(part1), str(part2)))
 
+    def split_key(self, key):
+        """ Reverse function of build_key """
+        if self.cluster_nodes and key.startswith("{"):
+            part1, part2 = key[1:].split("}:", 1)
+            return part1, part2
+        return tuple(key.split(":", 1))
+
+    def pipeline(self, transaction=True):
+        """ Return a pipeline
+        Redis Cluster has no transaction between keys of different slots,
+        so cluster pipelines are never transactions
+        """
+        if self.cluster_nodes:
+            return self.db_conn.pipeline(transaction=False)
+        return self.db_conn.pipeline(transaction=transaction)
+
+    def pack_fields(self, data):
+        """ Convert service data to hash fields
+        Each value, and each value of each datasource, has its own field:
+        {'check_time': 1, 'ds': {'ifInOctets': {'error': None}}} gives
+        the fields 'check_time' and 'ds.ifInOctets.error'
+        """
+        fields = {}
+        for name, value in data.iteritems():
+            if name == 'ds':
+                for ds_name, ds_data in value.iteritems():
+                    for attr, ds_value in ds_data.iteritems():
+                        field = "".join((DS_FIELD_PREFIX, ds_name, ".", attr))
+                        fields[field] = self.codec.encode(ds_value)
+            else:
+                fields[name] = self.codec.encode(value)
+        return fields
+
+    def unpack_fields(self, fields, conn=None):
+        """ Convert hash fields to service data
+        Return None if the service configuration is missing
+        `conn' is the connection used to read the template, if it is
+        not in the template cache
+        """
+        raw_config = fields.pop(CONFIG_FIELD, None)
+        template_hash = fields.pop(TEMPLATE_FIELD, None)
+        fields.pop(HASH_FIELD, None)
+        if raw_config is None:
+            return None
+        data = decode_value(raw_config)[0]
+        if template_hash is not None:
+            template = self.get_template(template_hash, conn)
+            # Datasources get the Poller values: they are copied
+            data['ds'] = OrderedDict([(ds_name, dict(ds_data))
+                                      for ds_name, ds_data
+                                      in template['ds'].iteritems()])
+            data['triggers'] = template['triggers']
+        ds_list = data.setdefault('ds', {})
+        for field, raw in fields.iteritems():
+            value = decode_value(raw)[0]
+            if field.startswith(DS_FIELD_PREFIX):
+                ds_name, attr = field[len(DS_FIELD_PREFIX):].rsplit(".", 1)
+                # Skip datasources removed from the configuration
+                if ds_name in ds_list:
+                    ds_list[ds_name][attr] = value
+            else:
+                data[field] = value
+        return data
+
+    def get_template(self, template_hash, conn=None):
+        """ Get a template from the template cache, or from the database
+        Cached templates are shared by services: they must not be modified
+        """
+        template = self.templates.get(template_hash)
+        if template is None:
+            raw = (conn or self.db_conn).get(TEMPLATE_KEY % template_hash)
+            if raw is None:
+                raise Exception("template %s is missing" % template_hash)
+            template = decode_value(raw)[0]
+            self.templates[template_hash] = template
+        return template
+
+    def split_template(self, data):
+        """ Split a service configuration into its own configuration and
+        its template
+
+        Return
+        * (configuration, template, template hash)
+        """
+        config = dict([(name, value) for name, value in data.iteritems()
+                       if name not in TEMPLATE_ATTRIBUTES])
+        template = {'ds': data.get('ds', OrderedDict()),
+                    'triggers': data.get('triggers', {})}
+        return config, template, self.service_hash(template)
+
+    def write_templates(self, templates, pipe=None):
+        """ Write templates not written yet by this client
+        `templates' is a dict {template hash: template}
+        If `pipe' is given, templates are written with this pipeline
+        """
+        execute = pipe is None
+        if pipe is None:
+            pipe = self.db_conn.pipeline(transaction=False)
+        nb_written = 0
+        for template_hash, template in templates.iteritems():
+            if template_hash in self.written_templates:
+                continue
+            # SET is used even if the template exists: the codec may
+            # have changed
+            pipe.set(TEMPLATE_KEY % template_hash,
+                     self.codec.encode(template))
+            nb_written += 1
+        if execute and nb_written:
+            pipe.execute()
+            self.written_templates.update(templates)
+        return nb_written
+
+    def config_fields(self, data):
+        """ List fields overridden by a new service configuration """
+        fields = [name for name in data if name != 'ds']
+        for ds_name, ds_data in data.get('ds', {}).iteritems():
+            fields.extend("".join((DS_FIELD_PREFIX, ds_name, ".", attr))
+                          for attr in ds_data)
+        return fields
+
+    def migrate_service(self, key, raw=None):
+        """ Convert a service stored in a string by an older version to a
+        hash and return its data
+        """
+        if raw is None:
+            raw = self.db_conn.get(key)
+            if raw is None:
+                return None
+        data = decode_value(raw)[0]
+        try:
+            self.migrate_script(keys=[key],
+                                args=[raw, CONFIG_FIELD,
+                                      self.codec.encode(data)])
+        except Exception as exp:
+            logger.warning("[SnmpBooster] [code 1309] [%s] Can not "
+                           "migrate legacy value: %s" % (key, str(exp)))
+        return data
+
+    def read_service(self, key, raw=None, conn=None):
+        """ Get a service from its key
+        `raw' is the service as returned by the snapshot script,
+        `conn' is the connection used to read it (a replica)
+        """
+        if raw is None:
+            try:
+                raw = (conn or self.db_conn).hgetall(key)
+            except ResponseError as exp:
+                if not is_wrong_type(exp):
+                    raise
+                return self.migrate_service(key)
+        elif isinstance(raw, list):
+            raw = dict(zip(raw[::2], raw[1::2]))
+        else:
+            # String written by an older version
+            return self.migrate_service(key, raw)
+        return self.unpack_fields(raw, conn)
+
+    def write_fields(self, key, fields, to_delete=None, index=None):
+        """ Write hash fields in one transaction
+        `to_delete' is a field list to remove,
+        `index' is a tuple (host, service, check_interval) used to add
+        the service in its host:interval set and in the indexes
+        """
+        for _ in range(2):
+            pipe = self.pipeline()
+            if index is not None:
+                host, service, check_interval = index
+                pipe.sadd(self.build_key(host, check_interval), service)
+                self.add_to_indexes(pipe, host, service, check_interval)
+            if to_delete:
+                pipe.hdel(key, *to_delete)
+            pipe.hmset(key, fields)
+            try:
+                pipe.execute()
+                return
+            except ResponseError as exp:
+                if not is_wrong_type(exp):
+                    raise
+                # Convert old string service and try again
+                self.migrate_service(key)
+        raise ResponseError("Can not convert %s to a hash" % key)
+
     def update_service_init(self, host, service, data):
         """ Insert/Update/Upsert service information in Redis by Arbiter """
         # We need to generate key for redis :
         # Like host:3 => ['service', 'service2'] that link
         # check interval to a service list
-        key_ci = self.build_key(host, data["check_interval"])
-        # Add service in host:interval list
+        key = self.build_key(host, service)
+        # Add service in host:interval list and in indexes
+        # and save its configuration
+        # Values set by the configuration replace values from the Poller
+        config, template, template_hash = self.split_template(data)
         try:
-            self.db_conn.sadd(key_ci, service)
+            # The template is written first: services never reference
+            # a missing template
+            self.write_templates({template_hash: template})
+            self.write_fields(key,
+                              {CONFIG_FIELD: self.codec.encode(config),
+                               TEMPLATE_FIELD: template_hash,
+                               HASH_FIELD: self.service_hash(data)},
+                              self.config_fields(data),
+                              (host, service, data["check_interval"]))
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1303] [%s, %s] "
                          "%s" % (host,
                                  service,
                                  str(exp)))
             return (None, True)
-        # Then update propely host:service key
-        self.update_service(host, service, data)
+        return (None, False)
+
+    @staticmethod
+    def service_hash(data):
+        """ Return the hash of a service configuration, or of a template
+        The datasource order is part of the configuration, and the
+        layout version is part of the hash
+        """
+        return hashlib.sha1("%d:%s" % (LAYOUT_VERSION,
+                                       json.dumps(pack_ordered(data),
+                                                  sort_keys=True))
+                            ).hexdigest()
+
+    def get_config_hashes(self, keys):
+        """ Get the configuration hashes of services, with a pipelined
+        request
+
+        Return
+        :query_result: list of hashes, None for unknown services
+        """
+        pipe = self.db_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, HASH_FIELD)
+        # Services stored by an older version give WRONGTYPE errors
+        return [None if isinstance(result, Exception) else result
+                for result in pipe.execute(raise_on_error=False)]
+
+    def update_services_init(self, services, hashes=None):
+        """ Insert/Update several services in one pipelined request,
+        like update_service_init
+        `services' is a list of service data, as given to
+        update_service_init, `hashes' the list of their service_hash
+        Set and index members are grouped: one SADD per set
+
+        Return
+        * nb_errors: int
+        """
+        pipe = self.pipeline(transaction=False)
+        splitted = [self.split_template(data) for data in services]
+        # Templates are written first: services never reference a
+        # missing template
+        templates = dict([(template_hash, template)
+                          for _, template, template_hash in splitted])
+        nb_templates = self.write_templates(templates, pipe)
+        sets = {}
+        for data in services:
+            host, service = data['host'], data['service']
+            check_interval = data["check_interval"]
+            for key, member in ((self.build_key(host, check_interval),
+                                 service),
+                                (self.index_key("hosts"), host),
+                                (self.index_key("services"), service),
+                                (self.index_key("host", host), service),
+                                (self.index_key("service", service), host),
+                                (self.index_key("intervals", host),
+                                 check_interval)):
+                sets.setdefault(key, set()).add(member)
+        for key, members in sets.iteritems():
+            pipe.sadd(key, *members)
+        if hashes is None:
+            hashes = [self.service_hash(data) for data in services]
+        for data, (config, _, template_hash), config_hash in zip(services,
+                                                                 splitted,
+                                                                 hashes):
+            key = self.build_key(data['host'], data['service'])
+            pipe.hdel(key, *self.config_fields(data))
+            pipe.hmset(key, {CONFIG_FIELD: self.codec.encode(config),
+                             TEMPLATE_FIELD: template_hash,
+                             HASH_FIELD: config_hash})
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1303] Can not write %d "
+                         "services: %s" % (len(services), str(exp)))
+            return len(services)
+
+        nb_errors = 0
+        for error in results[:nb_templates]:
+            if isinstance(error, Exception):
+                logger.error("[SnmpBooster] [code 1303] Can not write "
+                             "templates: %s" % str(error))
+                # Services would reference missing templates
+                return len(services)
+        self.written_templates.update(templates)
+        results = results[nb_templates:]
+        for error in results[:len(sets)]:
+            if isinstance(error, Exception):
+                logger.error("[SnmpBooster] [code 1303] Can not update "
+                             "host:interval keys or indexes: %s" % str(error))
+                nb_errors += 1
+        results = results[len(sets):]
+        for index, data in enumerate(services):
+            errors = [result for result in results[index * 2:index * 2 + 2]
+                      if isinstance(result, Exception)]
+            if not errors:
+                continue
+            if all(is_wrong_type(error) for error in errors):
+                # Service stored by an older version
+                if not self.update_service_init(data['host'],
+                                                data['service'],
+                                                data)[1]:
+                    continue
+            else:
+                logger.error("[SnmpBooster] [code 1303] [%s, %s] "
+                             "%s" % (data['host'],
+                                     data['service'],
+                                     str(errors[0])))
+            nb_errors += 1
+        return nb_errors
 
     def update_service(self, host, service, data, force=False):
         """ This function updates/inserts a service
-        * It used by Arbiter in hook_late_configuration
-          to put the configuration in the database
         * It used by Poller to put collected data in the database
+          Only fields in data are written, in one atomic request.
         The 'force' is used to overwrite the service datas (used in
         cache manager)
 
@@ -103,19 +1086,20 @@ class DBClient(object):
 
         # Get key
         key = self.build_key(host, service)
-        if not force:
-            old_dict = self.db_conn.get(key)
-            if old_dict is not None:
-                old_dict = eval(old_dict)
-            # Merge old data and new data
-            data = merge_dicts(old_dict, data)
 
         if data is None:
             return (None, True)
 
         # Save in redis
+        self.invalidate(key)
         try:
-            self.db_conn.set(key, data)
+            if force:
+                pipe = self.pipeline()
+                pipe.delete(key)
+                pipe.hset(key, CONFIG_FIELD, self.codec.encode(data))
+                pipe.execute()
+            elif data:
+                self.write_fields(key, self.pack_fields(data))
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1304] [%s, %s] "
                          "%s" % (host,
@@ -125,132 +1109,659 @@ class DBClient(object):
 
         return (None, False)
 
-    def get_service(self, host, service):
+    def update_services(self, services):
+        """ This function updates several services with one pipelined
+        request. Each service update is atomic.
+        `services' is a list of tuples (host, service, data)
+
+        Return
+        * nb_errors: int
+        """
+        pipe = self.db_conn.pipeline(transaction=False)
+        writes = []
+        data_by_key = {}
+        for host, service, data in services:
+            fields = self.pack_fields(data)
+            if fields:
+                key = self.build_key(host, service)
+                pipe.hmset(key, fields)
+                writes.append((host, service, key, fields))
+                data_by_key[key] = data
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1312] Can not write %d "
+                         "services: %s" % (len(writes), str(exp)))
+            for key in data_by_key:
+                self.invalidate(key)
+            return len(writes)
+
+        nb_errors = 0
+        for (host, service, key, fields), result in zip(writes, results):
+            if not isinstance(result, Exception):
+                self.update_cache(key, data_by_key[key])
+                continue
+            self.invalidate(key)
+            if is_wrong_type(result):
+                # Service stored by an older version
+                try:
+                    self.write_fields(key, fields)
+                    continue
+                except Exception as exp:
+                    result = exp
+            logger.error("[SnmpBooster] [code 1304] [%s, %s] "
+                         "%s" % (host,
+                                 service,
+                                 str(result)))
+            nb_errors += 1
+        return nb_errors
+
+    def update_cache(self, key, data):
+        """ Merge data we wrote in Redis in the cached service
+        The keyspace notification of this write must not invalidate it
+        """
+        if self.cache is None:
+            return
+        cached = self.cache.peek(key)
+        if cached is None:
+            return
+        merge_dicts(cached, data)
+        self.own_writes[key] = self.own_writes.get(key, 0) + 1
+
+    def get_cached_service(self, host, service):
+        """ This function gets one service from the local cache,
+        or from the database if it is not cached
+
+        Return
+        :query_result: dict
+        """
+        if self.cache is None or not self.process_invalidations():
+            return self.get_service(host, service)
+        key = self.build_key(host, service)
+        data = self.cache.get(key)
+        if data is None:
+            # A replica can give an older version whose invalidation is
+            # already received: it is replaced at the next write of the
+            # service, like the replica data accepted by is_stale
+            data = self.get_service(host, service)
+            if data is not None:
+                self.cache.set(key, data)
+        return data
+
+    def get_service(self, host, service, use_replica=True):
         """ This function gets one service from the database
+        The service is read from a replica if possible, and from the
+        primary if the replica data seem older than the check interval
 
         Return
         :query_result: dict
         """
         # Get key
         key = self.build_key(host, service)
+        replica = self.get_read_connection() if use_replica else None
+        if replica is not None:
+            try:
+                data = self.read_service(key, conn=replica['conn'])
+            except Exception:
+                self.replica_stats['errors'] += 1
+                replica['lag'] = None
+                data = None
+            else:
+                if not self.is_stale(data):
+                    self.replica_stats['replica'] += 1
+                    return data
+                self.replica_stats['stale'] += 1
+        self.replica_stats['primary'] += 1
         # Get service
         try:
-            data = self.db_conn.get(key)
+            data = self.read_service(key)
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1305] [%s, %s] "
                          "%s" % (host,
                                  service,
                                  str(exp)))
             return None
-        return eval(data) if data is not None else None
+        return data
 
-    def get_services(self, host, check_interval):
+    def get_services(self, host, check_interval, use_replica=True):
         """ This function Gets all services with the same host
         and check_interval
+        The services are read from a replica if possible, and from the
+        primary if the replica data seem older than the check interval
 
         Return
         :query_result: list of dicts
         """
-        # Get key
-        key_ci = self.build_key(host, check_interval)
-        # Get services
+        replica = self.get_read_connection() if use_replica else None
+        if replica is not None:
+            try:
+                dict_list = self.read_host_interval(host, check_interval,
+                                                    replica['conn'])
+            except Exception:
+                self.replica_stats['errors'] += 1
+                replica['lag'] = None
+                dict_list = None
+            if dict_list and not any(self.is_stale(data)
+                                     for data in dict_list):
+                self.replica_stats['replica'] += 1
+                return dict_list
+            self.replica_stats['stale'] += 1
+        self.replica_stats['primary'] += 1
         try:
-            servicelist = self.db_conn.smembers(key_ci)
-
+            return self.read_host_interval(host, check_interval)
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1306] [%s] "
                          "%s" % (host,
                                  str(exp)))
             return None
 
-        if servicelist is None:
-            # TODO : Bailout properly
-            return None
+    def read_host_interval(self, host, check_interval, conn=None):
+        """ Read all services of a host:interval key
+        Errors on one service are logged and the service is skipped
+        """
+        # Get key
+        key_ci = self.build_key(host, check_interval)
+        # Get services
+        servicelist = (conn or self.db_conn).smembers(key_ci)
 
         dict_list = []
         for service in servicelist:
             try:
                 key = self.build_key(host, service)
-                data = self.db_conn.get(key)
+                data = self.read_service(key, conn=conn)
                 if data is None:
                     logger.error("[SnmpBooster] [code 1307] [%s] "
                                  "Unknown service %s", host, service)
                     continue
-                dict_list.append(eval(data))
+                dict_list.append(data)
             except Exception as exp:
                 logger.error("[SnmpBooster] [code 1308] [%s] "
                              "%s" % (host,
                                      str(exp)))
         return dict_list
 
-    def show_keys(self):
-        """ Get all database keys """
-        return self.db_conn.keys()
+    def get_host_snapshot(self, host, service, use_replica=True):
+        """ This function gets one service and all services with the same
+        host and check_interval in one Redis request
+        They are read from a replica if possible, and from the primary if
+        the replica data seem older than the check interval
 
-    def get_hosts_from_service(self, service):
-        """ List hosts with a service which match with the pattern """
-        results = []
-        for key in self.db_conn.keys():
-            if re.search(":.*"+service, key) is None:
-                # Look for service
+        Return
+        :query_result: tuple (dict, list of dicts)
+        """
+        replica = self.get_read_connection() if use_replica else None
+        if replica is not None:
+            try:
+                current_service, dict_list = self.read_snapshot(
+                    host, service, replica['conn'])
+            except Exception:
+                self.replica_stats['errors'] += 1
+                replica['lag'] = None
+                current_service = None
+            if current_service is not None and not any(
+                    self.is_stale(data)
+                    for data in [current_service] + dict_list):
+                self.replica_stats['replica'] += 1
+                return self.cache_snapshot(host, current_service, dict_list)
+            self.replica_stats['stale'] += 1
+        self.replica_stats['primary'] += 1
+        try:
+            current_service, dict_list = self.read_snapshot(host, service)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1310] [%s, %s] "
+                         "%s" % (host,
+                                 service,
+                                 str(exp)))
+            return (None, None)
+        if current_service is None:
+            return (None, None)
+        return self.cache_snapshot(host, current_service, dict_list)
+
+    def read_snapshot(self, host, service, conn=None):
+        """ Read one service and all services with the same host and
+        check_interval with the snapshot script
+        `conn' is the connection used to read them (a replica)
+
+        The check_interval of the service is only known once the service
+        is read, so the first snapshot of a service needs a second request
+
+        Return
+        :query_result: tuple (dict or None, list of dicts)
+        """
+        key = self.build_key(host, service)
+        check_interval = self.check_intervals.get(key)
+        while True:
+            keys = [key]
+            if check_interval is not None:
+                keys.append(self.build_key(host, check_interval))
+            raw_list = self.snapshot_script(keys=keys,
+                                            args=[self.build_key(host, "")],
+                                            client=conn or self.db_conn)
+            current_service = self.read_service(key, raw_list[0], conn=conn)
+            if current_service is None:
+                self.check_intervals.pop(key, None)
+                return (None, [])
+            if current_service.get('check_interval') == check_interval:
+                break
+            # Unknown or changed check_interval
+            check_interval = current_service.get('check_interval')
+            self.check_intervals[key] = check_interval
+
+        dict_list = []
+        for index in range(1, len(raw_list), 2):
+            service_key = self.build_key(host, raw_list[index])
+            try:
+                data = self.read_service(service_key, raw_list[index + 1],
+                                         conn=conn)
+            except Exception as exp:
+                logger.error("[SnmpBooster] [code 1308] [%s] "
+                             "%s" % (host,
+                                     str(exp)))
                 continue
-            results.append(eval(self.db_conn.get(key)))
+            if data is None:
+                logger.error("[SnmpBooster] [code 1307] [%s] "
+                             "Unknown service %s", host, raw_list[index])
+                continue
+            dict_list.append(data)
+        return (current_service, dict_list)
 
-        return results
+    def cache_snapshot(self, host, current_service, dict_list):
+        """ Put the services of a snapshot in the local cache
 
-    def get_services_from_host(self, host):
-        """ List all services from hosts which match the pattern """
+        Return
+        :query_result: tuple (dict, list of dicts)
+        """
+        if self.cache is not None and self.process_invalidations():
+            for data in dict_list:
+                self.cache.set(self.build_key(host, data['service']), data)
+        return (current_service, dict_list)
+
+    def index_key(self, kind, name=None):
+        """ Build index key
+        Index keys have no hash tag, even with Redis Cluster
+
+        >>> DBClient("localhost").index_key("hosts")
+        '__booster__:index:hosts'
+        >>> DBClient(None, cluster_nodes=["localhost:7000"]).index_key(
+        ...     "host", "myhost")
+        '__booster__:index:host:myhost'
+        """
+        if name is None:
+            return "".join((INTERNAL_PREFIX, "index:", kind))
+        return "".join((INTERNAL_PREFIX, "index:", kind, ":", str(name)))
+
+    def add_to_indexes(self, pipe, host, service, check_interval):
+        """ Add a service to host, service name and interval indexes """
+        pipe.sadd(self.index_key("hosts"), host)
+        pipe.sadd(self.index_key("services"), service)
+        pipe.sadd(self.index_key("host", host), service)
+        pipe.sadd(self.index_key("service", service), host)
+        pipe.sadd(self.index_key("intervals", host), check_interval)
+
+    def read_services(self, keys, conn=None):
+        """ Get services from a key list with pipelined requests
+        `conn' is the connection used to read them (a replica)
+
+        Return
+        :query_result: list of dicts
+        """
         results = []
-        for key in self.db_conn.keys():
-            if re.search(host+".*:", key)is None:
-                # Look for host
+        keys = list(keys)
+        for start in range(0, len(keys), READ_BATCH_SIZE):
+            batch = keys[start:start + READ_BATCH_SIZE]
+            pipe = (conn or self.db_conn).pipeline(transaction=False)
+            for key in batch:
+                pipe.hgetall(key)
+            for key, raw in zip(batch, pipe.execute(raise_on_error=False)):
+                if isinstance(raw, Exception):
+                    if not is_wrong_type(raw):
+                        logger.error("[SnmpBooster] [code 1311] [%s] "
+                                     "%s" % (key, str(raw)))
+                        continue
+                    data = self.migrate_service(key)
+                else:
+                    data = self.unpack_fields(raw)
+                if data is not None:
+                    results.append(data)
+        return results
+
+    def get_device_profile(self, address):
+        """ Read the SNMP profile of a device
+
+        Return
+        * dict of strings, or None
+        """
+        try:
+            return self.db_conn.hgetall(PROFILE_KEY % address) or None
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1317] [%s] Can not read the "
+                         "device profile: %s" % (address, str(exp)))
+            return None
+
+    def write_device_profiles(self, profiles):
+        """ Write SNMP device profiles in one pipelined request
+        `profiles' is a dict {address: dict of strings}
+        """
+        pipe = self.db_conn.pipeline(transaction=False)
+        for address, profile in profiles.items():
+            pipe.hmset(PROFILE_KEY % address, profile)
+        try:
+            pipe.execute()
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1318] Can not write %d device "
+                         "profiles: %s" % (len(profiles), str(exp)))
+
+    def iter_service_keys(self):
+        """ List all host:service keys, with incremental SCAN """
+        for key in self.db_conn.scan_iter(count=SCAN_COUNT):
+            if key.startswith(INTERNAL_PREFIX):
                 continue
-            if re.search(":[0-9]+$", key) is not None:
+            if REGEX_INTERVAL_KEY.search(key) is not None:
                 # we skip host:interval
                 continue
-            results.append(eval(self.db_conn.get(key)))
+            yield key
 
-        return results
+    def get_index_members(self, kind, pattern, conn=None):
+        """ List names of the index `kind' (hosts or services) which
+        match the pattern """
+        regex = re.compile(pattern)
+        return [name for name in (conn or self.db_conn).sscan_iter(
+                    self.index_key(kind), count=SCAN_COUNT)
+                if regex.search(name) is not None]
+
+    def show_keys(self):
+        """ Get all database keys """
+        return list(self.db_conn.scan_iter(count=SCAN_COUNT))
+
+    def read_on_replica(self, read, use_replica=True):
+        """ Return read(connection), called with a replica if possible,
+        and with the primary if no replica can be used or if the replica
+        read fails
+        """
+        replica = self.get_read_connection() if use_replica else None
+        if replica is not None:
+            try:
+                result = read(replica['conn'])
+            except Exception:
+                self.replica_stats['errors'] += 1
+                replica['lag'] = None
+            else:
+                self.replica_stats['replica'] += 1
+                return result
+        self.replica_stats['primary'] += 1
+        return read(self.db_conn)
+
+    def get_hosts_from_service(self, service, use_replica=True):
+        """ List hosts with a service which match with the pattern """
+        def read(conn):
+            """ Read the services on `conn' """
+            services = self.get_index_members("services", service, conn)
+            pipe = conn.pipeline(transaction=False)
+            for service_name in services:
+                pipe.smembers(self.index_key("service", service_name))
+            keys = [self.build_key(host, service_name)
+                    for service_name, hosts in zip(services, pipe.execute())
+                    for host in hosts]
+            return self.read_services(keys, conn)
+        return self.read_on_replica(read, use_replica)
+
+    def get_services_from_host(self, host, use_replica=True):
+        """ List all services from hosts which match the pattern """
+        def read(conn):
+            """ Read the services on `conn' """
+            hosts = self.get_index_members("hosts", host, conn)
+            pipe = conn.pipeline(transaction=False)
+            for host_name in hosts:
+                pipe.smembers(self.index_key("host", host_name))
+            keys = [self.build_key(host_name, service)
+                    for host_name, services in zip(hosts, pipe.execute())
+                    for service in services]
+            return self.read_services(keys, conn)
+        return self.read_on_replica(read, use_replica)
 
     def clear_cache(self):
         """ Clear all datas in database """
         self.db_conn.flushall()
+        self.db_conn.publish(CLEAR_CHANNEL, "flushall")
 
     def get_all_services(self):
         """ List all services """
         results = []
-        for key in self.db_conn.keys():
-            if re.search(":[0-9]*$", key) is None:
-                host, service = key.split(":", 1)
-                results.append(self.get_service(host, service))
-
+        batch = []
+        for key in self.iter_service_keys():
+            batch.append(key)
+            if len(batch) >= READ_BATCH_SIZE:
+                results.extend(self.read_services(batch))
+                batch = []
+        results.extend(self.read_services(batch))
         return results
 
+    def get_host_interval_keys(self, hosts):
+        """ List host:interval keys of each host in the list """
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            pipe.smembers(self.index_key("intervals", host))
+        return dict([(host, [self.build_key(host, interval)
+                             for interval in intervals])
+                     for host, intervals in zip(hosts, pipe.execute())])
+
     def get_all_interval_keys(self):
-        """ List all host:interval keys which match interval pattern """
-        results = []
-        for key in self.db_conn.keys():
-            if re.search(":[0-9]*$", key) is not None:
-                results.append(key)
+        """ List all host:interval keys """
+        hosts = list(self.db_conn.sscan_iter(self.index_key("hosts"),
+                                             count=SCAN_COUNT))
+        return [key for keys in self.get_host_interval_keys(hosts).values()
+                for key in keys]
 
-        return results
+    def get_indexed_services(self):
+        """ List (host, service) of all indexed services """
+        hosts = list(self.db_conn.sscan_iter(self.index_key("hosts"),
+                                             count=SCAN_COUNT))
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            pipe.smembers(self.index_key("host", host))
+        return [(host, service)
+                for host, services in zip(hosts, pipe.execute())
+                for service in services]
+
+    def get_owned_services(self, owner):
+        """ List (host, service) of the services configured by the
+        Arbiter `owner' at its last startup """
+        return [self.split_key(key) for key in self.db_conn.sscan_iter(
+            self.index_key("arbiter", owner), count=SCAN_COUNT)]
+
+    def update_owned_services(self, owner, added, removed):
+        """ Add and remove (host, service) in the services of the
+        Arbiter `owner' """
+        key = self.index_key("arbiter", owner)
+        pipe = self.db_conn.pipeline(transaction=False)
+        for keys, command in ((list(added), pipe.sadd),
+                              (list(removed), pipe.srem)):
+            for start in range(0, len(keys), READ_BATCH_SIZE):
+                command(key, *[self.build_key(host, service)
+                               for host, service
+                               in keys[start:start + READ_BATCH_SIZE]])
+        pipe.execute()
+
+    def remove_unused_templates(self):
+        """ Delete the templates which no indexed service uses
+
+        Return
+        :query_result: number of deleted templates
+        """
+        used = set()
+        services = self.get_indexed_services()
+        for start in range(0, len(services), READ_BATCH_SIZE):
+            pipe = self.db_conn.pipeline(transaction=False)
+            for host, service in services[start:start + READ_BATCH_SIZE]:
+                pipe.hget(self.build_key(host, service), TEMPLATE_FIELD)
+            # Services stored by an older version give WRONGTYPE errors
+            used.update([template_hash for template_hash
+                         in pipe.execute(raise_on_error=False)
+                         if isinstance(template_hash, str)])
+        prefix_length = len(TEMPLATE_KEY % "")
+        unused = [key for key
+                  in self.db_conn.scan_iter(match=TEMPLATE_KEY % "*",
+                                            count=SCAN_COUNT)
+                  if key[prefix_length:] not in used]
+        pipe = self.db_conn.pipeline(transaction=False)
+        # One DEL per key: keys can be in different cluster slots
+        for key in unused:
+            pipe.delete(key)
+            self.written_templates.discard(key[prefix_length:])
+        pipe.execute()
+        return len(unused)
+
+    def fix_interval_sets(self, expected, ignored=None):
+        """ Make host:interval sets match the configuration
+        `expected' is a dict {host: {check_interval: set of services}},
+        services in `ignored' (set of (host, service)) are not removed
+        from their sets
+
+        Return
+        :query_result: number of fixed memberships
+        """
+        ignored = ignored or set()
+        hosts = list(expected)
+        interval_keys = self.get_host_interval_keys(hosts)
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            for key in interval_keys[host]:
+                pipe.smembers(key)
+        current = iter(pipe.execute())
+
+        nb_fixed = 0
+        pipe = self.pipeline(transaction=False)
+        for host in hosts:
+            expected_keys = dict([(self.build_key(host, interval), services)
+                                  for interval, services
+                                  in expected[host].items()])
+            for key in interval_keys[host]:
+                members = next(current)
+                extra = [service for service
+                         in members - expected_keys.get(key, set())
+                         if (host, service) not in ignored]
+                if extra:
+                    pipe.srem(key, *extra)
+                    nb_fixed += len(extra)
+                missing = expected_keys.get(key, set()) - members
+                if missing:
+                    pipe.sadd(key, *missing)
+                    nb_fixed += len(missing)
+            for interval, services in expected[host].items():
+                key = self.build_key(host, interval)
+                if key not in interval_keys[host]:
+                    pipe.sadd(key, *services)
+                    pipe.sadd(self.index_key("intervals", host), interval)
+                    nb_fixed += len(services)
+        pipe.execute()
+
+        # Forget empty interval sets
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            for key in interval_keys[host]:
+                pipe.scard(key)
+        counts = iter(pipe.execute())
+        pipe = self.pipeline(transaction=False)
+        for host in hosts:
+            for key in interval_keys[host]:
+                if next(counts) == 0:
+                    interval = self.split_key(key)[1]
+                    pipe.srem(self.index_key("intervals", host), interval)
+        pipe.execute()
+        return nb_fixed
+
+    def remove_empty_indexes(self, hosts, services):
+        """ Remove hosts and services without entry from the indexes """
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            pipe.scard(self.index_key("host", host))
+        for service in services:
+            pipe.scard(self.index_key("service", service))
+        counts = pipe.execute()
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host, count in zip(hosts, counts[:len(hosts)]):
+            if count == 0:
+                pipe.srem(self.index_key("hosts"), host)
+                pipe.delete(self.index_key("intervals", host))
+        for service, count in zip(services, counts[len(hosts):]):
+            if count == 0:
+                pipe.srem(self.index_key("services"), service)
+        pipe.execute()
 
     def delete_services(self, key_list):
         """ Delete services which match keys in key_list """
-        nb_del = self.db_conn.delete(*[self.build_key(host, service)
-                                       for host, service in key_list])
-        if nb_del > 0:
-            interval_key = self.get_all_interval_keys()
-            for host, service in key_list:
-                for key in [key for key in interval_key if key.startswith(host)]:
-                    self.db_conn.srem(key, service)
+        key_list = list(key_list)
+        if not key_list:
+            return 0
+        hosts = list(set([host for host, _ in key_list]))
+        services = list(set([service for _, service in key_list]))
+        interval_keys = self.get_host_interval_keys(hosts)
+        pipe = self.pipeline()
+        # One DEL per key: keys can be in different cluster slots
+        for host, service in key_list:
+            pipe.delete(self.build_key(host, service))
+        for host, service in key_list:
+            for key in interval_keys[host]:
+                pipe.srem(key, service)
+            pipe.srem(self.index_key("host", host), service)
+            pipe.srem(self.index_key("service", service), host)
+        nb_del = sum(pipe.execute()[:len(key_list)])
+        self.remove_empty_indexes(hosts, services)
         return nb_del
 
     def delete_host(self, host):
         """ Delete all services in the specified host """
+        hosts = self.get_index_members("hosts", host + "$")
+        if not hosts:
+            return 0
+        interval_keys = self.get_host_interval_keys(hosts)
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host_name in hosts:
+            pipe.smembers(self.index_key("host", host_name))
+        host_services = dict(zip(hosts, pipe.execute()))
+
+        pipe = self.pipeline()
         to_del = []
-        for key in self.db_conn.keys():
-            if re.search(host+":", key) is not None:
-                to_del.append(key)
-        if len(to_del) > 0:
-            return self.db_conn.delete(*to_del)
+        for host_name, services in host_services.items():
+            to_del.extend(self.build_key(host_name, service)
+                          for service in services)
+            to_del.extend(interval_keys[host_name])
+            for service in services:
+                pipe.srem(self.index_key("service", service), host_name)
+            pipe.delete(self.index_key("host", host_name))
+        for key in to_del:
+            pipe.delete(key)
+        results = pipe.execute()
+        nb_del = sum(results[len(results) - len(to_del):])
+        self.remove_empty_indexes(hosts,
+                                  list(set([service
+                                            for services in host_services.values()
+                                            for service in services])))
+        return nb_del
+
+    def rebuild_indexes(self):
+        """ Rebuild host, service name and interval indexes from all keys
+        Used to index a database filled by an older version
+
+        Return
+        :query_result: number of indexed services
+        """
+        nb_services = 0
+        pipe = self.db_conn.pipeline(transaction=False)
+        for key in self.db_conn.scan_iter(count=SCAN_COUNT):
+            if key.startswith(INTERNAL_PREFIX) or ":" not in key:
+                continue
+            host, service = self.split_key(key)
+            if REGEX_INTERVAL_KEY.search(key) is not None:
+                # host:interval key
+                pipe.sadd(self.index_key("intervals", host), service)
+            else:
+                pipe.sadd(self.index_key("hosts"), host)
+                pipe.sadd(self.index_key("services"), service)
+                pipe.sadd(self.index_key("host", host), service)
+                pipe.sadd(self.index_key("service", service), host)
+                nb_services += 1
+            if len(pipe) >= READ_BATCH_SIZE:
+                pipe.execute()
+        pipe.execute()
+        return nb_services
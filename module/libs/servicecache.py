@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the Poller local service cache """
+
+
+from collections import OrderedDict
+
+
+__all__ = ("ServiceCache",)
+
+
+class ServiceCache(object):
+    """ LRU cache of decoded services, by Redis key
+
+    Cached services are shared with the callers: they must not be
+    modified, except by the database client to keep them up to date
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.services = OrderedDict()
+        self.stats = {}
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.services)
+
+    def get(self, key):
+        """ Return the cached service or None
+        The service becomes the most recently used one
+        """
+        try:
+            data = self.services.pop(key)
+        except KeyError:
+            self.stats['misses'] += 1
+            return None
+        self.services[key] = data
+        self.stats['hits'] += 1
+        return data
+
+    def peek(self, key):
+        """ Return the cached service or None, without changing
+        the LRU order or the statistics
+        """
+        return self.services.get(key)
+
+    def set(self, key, data):
+        """ Add or replace a service, evicting the least recently used
+        services if the cache is full
+        """
+        self.services.pop(key, None)
+        self.services[key] = data
+        while len(self.services) > self.max_size:
+            self.services.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        """ Remove a service from the cache """
+        if self.services.pop(key, None) is not None:
+            self.stats['invalidations'] += 1
+
+    def clear(self):
+        """ Remove all services from the cache """
+        self.stats['invalidations'] += len(self.services)
+        self.services.clear()
+
+    def reset_stats(self):
+        """ Reset cache statistics """
+        self.stats = {'hits': 0,
+                      'misses': 0,
+                      'evictions': 0,
+                      'invalidations': 0,
+                      }
+
+    def get_stats(self):
+        """ Return cache statistics and reset them """
+        stats = self.stats
+        stats['size'] = len(self.services)
+        self.reset_stats()
+        return stats
@@ -26,8 +26,18 @@ and handle answers with callbacks
 """
 
 from threading import Thread
+from multiprocessing import Process
+from multiprocessing import Queue as ProcessQueue
+from Queue import Empty
+from collections import deque, OrderedDict
+import asyncore
+import errno
 import re
+import signal
+import socket
 import time
+import math
+import hashlib
 
 
 from shinken.log import logger
@@ -35,32 +45,988 @@ from shinken.log import logger
 
 try:
     from pysnmp.entity.rfc3413.oneliner import cmdgen
-    from pysnmp.smi.exval import noSuchInstance
+    from pysnmp.proto.rfc1905 import NoSuchObject, NoSuchInstance, \
+        EndOfMibView
+    from pysnmp.proto.errind import RequestTimedOut, requestTimedOut
+    from pyasn1.type.univ import Integer, OctetString
 except ImportError as exp:
     logger.error("[SnmpBooster] [code 0601] Import error. Pysnmp is missing")
     raise ImportError(exp)
 
+from ber import NO_SUCH_OBJECT, NO_SUCH_INSTANCE, END_OF_MIB_VIEW, \
+    encode_get_template, encode_request_id, random_request_id, \
+    decode_response, decode_var_binds, var_bind_size, MAX_REQUEST_ID, \
+    MIN_REQUEST_ID
+from deviceprofile import DeviceProfile, TOO_BIG
+
+
+# SNMPv3 protocols, by name (see utils.AUTH_PROTOCOLS and PRIV_PROTOCOLS)
+AUTH_PROTOCOLS = {'MD5': cmdgen.usmHMACMD5AuthProtocol,
+                  'SHA': cmdgen.usmHMACSHAAuthProtocol,
+                  }
+PRIV_PROTOCOLS = {'DES': cmdgen.usmDESPrivProtocol,
+                  '3DES': cmdgen.usm3DESEDEPrivProtocol,
+                  'AES': cmdgen.usmAesCfb128Protocol,
+                  'AES192': cmdgen.usmAesCfb192Protocol,
+                  'AES256': cmdgen.usmAesCfb256Protocol,
+                  }
+
+# Max time (seconds) the SNMP dispatcher waits for responses, before
+# taking new tasks
+DISPATCH_INTERVAL = 0.1
+# A SNMP engine with more targets uses new command generators
+ENGINE_MAX_TARGETS = 10000
+# Time (seconds) a resolved device address is used
+ADDRESS_TTL = 300
+# Transport tag of the SNMP Booster communities and targets
+ENGINE_TAG = "snmpbooster"
+# Adaptive timeouts are rounded up to the pysnmp timer resolution
+TIMEOUT_STEP = 0.5
+# Timeouts of the transport targets are rounded up to this step
+TARGET_TIMEOUT_STEP = 0.1
+# RTT smoothing factors (RFC 6298)
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+# Max factor applied to the timeout of a device after timeouts
+RTT_MAX_BACKOFF = 64
+# Number of consecutive timeouts after which a device gets no retry
+DEAD_DEVICE_TIMEOUTS = 3
+# Max number of encoded GET templates kept by a SNMP engine
+MAX_TEMPLATES = 10000
+# Max size of a SNMP response datagram
+MAX_MESSAGE_SIZE = 65535
+
+
+def normalize_value(value):
+    """ Convert a pysnmp value to a python value
+    Normalized values can be sent to other processes and are decoded once
+    """
+    if isinstance(value, NoSuchInstance):
+        return NO_SUCH_INSTANCE
+    elif isinstance(value, NoSuchObject):
+        return NO_SUCH_OBJECT
+    elif isinstance(value, EndOfMibView):
+        return END_OF_MIB_VIEW
+    elif isinstance(value, Integer):
+        # Counter32, Gauge32, Counter64, TimeTicks, ...
+        return int(value)
+    elif isinstance(value, OctetString):
+        # Strings, IpAddress, Opaque
+        return str(value)
+    return value.prettyPrint()
+
+
+def normalize_var_binds(var_binds):
+    """ Convert pysnmp var binds to a list of (oid, value)
+    Oids start with a dot, values are normalized
+    """
+    return [("." + oid.prettyPrint(), normalize_value(value))
+            for oid, value in var_binds]
+
+
+class GetTemplateTransport(asyncore.dispatcher):
+    """ UDP transport for SNMP v1/v2c GET requests, without pysnmp
+
+    The encoded request of each (version, community, oids) is kept as a
+    template: sending a request only patches its request id. Responses
+    are decoded with the minimal BER codec. Timeouts and retries are
+    checked by handle_timeouts
+
+    Requests which can not be handled here (unresolved address, values
+    unknown to the codec) are given to `fallback', the pysnmp path
+    """
+    def __init__(self, fallback):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.fallback = fallback
+        # {(version, community, oids): (message head, message tail)}
+        self.templates = {}
+        # {address: (ip address, resolution time)}
+        self.addresses = {}
+        # {request id: [task, cb_fun, cb_ctx, (ip, port), message,
+        #               deadline, retries]}
+        self.pending = {}
+        self.request_id = random_request_id()
+
+    def get_template(self, snmp_task):
+        """ Return the encoded request of a task, without request id """
+        key = (int(snmp_task['version']), snmp_task['community'],
+               tuple(snmp_task['oids']))
+        template = self.templates.get(key)
+        if template is None:
+            if len(self.templates) >= MAX_TEMPLATES:
+                self.templates = {}
+            template = encode_get_template(key[0] - 1, key[1], key[2])
+            self.templates[key] = template
+        return template
+
+    def get_address(self, snmp_task):
+        """ Return the (ip, port) of a task, or None if it is not resolved """
+        address = snmp_task['address']
+        resolved = self.addresses.get(address)
+        if resolved is None or resolved[1] + ADDRESS_TTL < time.time():
+            try:
+                resolved = (socket.gethostbyname(address), time.time())
+            except socket.error:
+                return None
+            if len(self.addresses) >= ENGINE_MAX_TARGETS:
+                self.addresses = {}
+            self.addresses[address] = resolved
+        return (resolved[0], int(snmp_task['port']))
+
+    def send_request(self, snmp_task, cb_fun, cb_ctx):
+        """ Send the GET request of a task
+
+        Return False if the task must use the pysnmp path
+        """
+        address = self.get_address(snmp_task)
+        if address is None:
+            return False
+        head, tail = self.get_template(snmp_task)
+        self.request_id += 1
+        if self.request_id > MAX_REQUEST_ID:
+            self.request_id = MIN_REQUEST_ID
+        message = head + encode_request_id(self.request_id) + tail
+        self.pending[self.request_id] = [snmp_task, cb_fun, cb_ctx, address,
+                                         message,
+                                         time.time() + snmp_task['timeout'],
+                                         snmp_task['retries']]
+        self.send_message(message, address)
+        return True
+
+    def send_message(self, message, address):
+        """ Send a datagram, a lost datagram is retried after a timeout """
+        try:
+            self.socket.sendto(message, address)
+        except socket.error as exp:
+            if exp.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.ENOBUFS):
+                raise
+
+    def handle_timeouts(self, now):
+        """ Retry or fail the requests whose timeout expired """
+        for request_id, request in self.pending.items():
+            if request[5] > now:
+                continue
+            snmp_task, cb_fun, cb_ctx = request[:3]
+            if request[6] > 0:
+                request[6] -= 1
+                request[5] = now + snmp_task['timeout']
+                self.send_message(request[4], request[3])
+            else:
+                del self.pending[request_id]
+                cb_fun(None, requestTimedOut, 0, 0, [], cb_ctx)
+
+    def handle_response(self, data, address):
+        """ Call the callback of the request answered by a datagram """
+        try:
+            (version, community, request_id, error_status, error_index,
+             var_binds) = decode_response(data)
+        except (ValueError, IndexError):
+            # Not a SNMP response
+            return
+        request = self.pending.get(request_id)
+        if (request is None or request[3][0] != address[0] or
+                version != int(request[0]['version']) - 1 or
+                community != request[0]['community']):
+            return
+        del self.pending[request_id]
+        snmp_task, cb_fun, cb_ctx = request[:3]
+        try:
+            var_binds = decode_var_binds(data, var_binds)
+        except (ValueError, IndexError):
+            # pysnmp makes the request again and decodes its response
+            self.fallback(snmp_task, cb_fun, cb_ctx)
+            return
+        cb_fun(None, None, error_status, error_index, var_binds, cb_ctx)
+
+    def handle_read(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(MAX_MESSAGE_SIZE)
+            except socket.error:
+                return
+            self.handle_response(data, address)
+
+    def writable(self):
+        return False
+
+    def handle_connect(self):
+        pass
+
+
+def callback_pysnmp(send_request_handle, error_indication, error_status,
+                    error_index, var_binds, cb_ctx):
+    """ pysnmp callback which calls the engine callback of a task with
+    normalized var binds, and counts the finished requests of the
+    command generators
+    """
+    snmp_task, cb_fun, cb_ctx, generation = cb_ctx
+    if snmp_task['type'] == 'get':
+        var_binds = normalize_var_binds(var_binds)
+    else:
+        var_binds = [normalize_var_binds(row) for row in var_binds]
+    next_rows = cb_fun(send_request_handle, error_indication,
+                       int(error_status), int(error_index), var_binds,
+                       cb_ctx)
+    if (not next_rows or snmp_task['type'] == 'get' or
+            walk_finished(error_indication, int(error_status), var_binds)):
+        generation['in_flight'] -= 1
+    return next_rows
+
+
+class SNMPEngine(object):
+    """ Long-lived pysnmp command generator
+
+    Authentication data and transport targets are built once and reused:
+    building them for each request is useless work (a transport target
+    resolves its address) and pysnmp configures each of them only once.
+    pysnmp keeps one target per address and tag list: each timeout and
+    retries of an address gets its own tag. Targets are resolved again
+    after ADDRESS_TTL seconds, and at most ENGINE_MAX_TARGETS of them
+    are kept, the least recently used ones are dropped.
+    SNMPv3 state is kept by pysnmp as long as the engine lives: keys of
+    each user are hashed once and localized once per device engine id,
+    and engine ids, boots and time discovered once per device (engine
+    ids are discovered again after 5 minutes).
+    pysnmp knows one set of keys and protocols by user name: the other
+    sets of a user name get their own command generators.
+    Targets are never removed from a running command generator: when
+    ENGINE_MAX_TARGETS targets were configured in the command generators,
+    new requests get new command generators. The old ones handle their
+    requests in flight and are stopped, so targets of removed devices
+    and old timeouts are freed
+
+    If `use_templates' is True, v1/v2c GET requests are sent by a
+    GetTemplateTransport instead of pysnmp
+    """
+    # Transport target class: it gives the transport and the dispatcher
+    # of the engine
+    target_class = cmdgen.UdpTransportTarget
+
+    def __init__(self, use_templates=False):
+        self.generation = None
+        self.retired = []
+        self.templates = None
+        self.use_templates = use_templates
+        self.auths = {}
+        self.usm_users = {}
+        self.targets = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        """ Replace the command generators with new ones """
+        self.stop()
+        if self.use_templates:
+            self.templates = GetTemplateTransport(self.send_pysnmp_request)
+        self.targets = OrderedDict()
+        self.new_generation()
+
+    def new_generation(self):
+        """ Use new command generators for the next requests
+        The current ones are retired until their requests in flight are
+        finished
+        """
+        if self.generation is not None:
+            self.retired.append(self.generation)
+        # cmd_gens: command generators, the n-th one has the n-th set of
+        # keys and protocols of the SNMPv3 user names
+        # in_flight: number of requests in flight
+        # targets: (target key, creation time) of the configured targets
+        self.generation = {'cmd_gens': [cmdgen.AsynCommandGenerator()],
+                           'in_flight': 0,
+                           'targets': set(),
+                           }
+        self.auths = {}
+        self.usm_users = {}
+
+    def recycle(self):
+        """ Stop the retired command generators without request in
+        flight, and use new command generators if the current ones have
+        too many targets
+        Can be called while requests are in flight
+        """
+        for generation in self.retired[:]:
+            if generation['in_flight'] <= 0:
+                self.retired.remove(generation)
+                self.stop_generation(generation)
+        if (len(self.generation['targets']) > ENGINE_MAX_TARGETS and
+                not self.retired):
+            self.new_generation()
+
+    @staticmethod
+    def stop_generation(generation):
+        """ Unconfigure command generators and close their transports """
+        for cmd_gen in generation['cmd_gens']:
+            cmd_gen.uncfgCmdGen()
+
+    def stop(self):
+        """ Unconfigure the command generators and close their transports """
+        for generation in self.retired + [self.generation]:
+            if generation is not None:
+                self.stop_generation(generation)
+        self.generation = None
+        self.retired = []
+        if self.templates is not None:
+            self.templates.close()
+            self.templates = None
+
+    def get_cmd_gens(self):
+        """ Return all the command generators of the engine, retired ones
+        included
+        """
+        return [cmd_gen
+                for generation in self.retired + [self.generation]
+                if generation is not None
+                for cmd_gen in generation['cmd_gens']]
+
+    def get_auth(self, snmp_task):
+        """ Return the authentication data of a task and the command
+        generator which knows it
+        """
+        usm = snmp_task.get('usm')
+        if usm is not None:
+            key = usm
+        else:
+            key = (snmp_task['community'], int(snmp_task['version']))
+        auth = self.auths.get(key)
+        if auth is None:
+            if usm is not None:
+                auth = self.get_usm_user(usm)
+            else:
+                auth = (cmdgen.CommunityData(communityIndex=snmp_task['community'],
+                                             communityName=snmp_task['community'],
+                                             mpModel=int(snmp_task['version']) - 1,
+                                             tag=ENGINE_TAG,
+                                             ),
+                        self.generation['cmd_gens'][0])
+            self.auths[key] = auth
+        return auth
+
+    def get_usm_user(self, usm):
+        """ Return the SNMPv3 authentication data of a user and its
+        command generator
+        `usm' is (user, auth protocol, auth key, priv protocol, priv key)
+        pysnmp stores the keys of a user by user name: the n-th set of
+        keys and protocols of a user name is configured in the n-th
+        command generator
+        """
+        user, auth_protocol, auth_key, priv_protocol, priv_key = usm
+        key_sets = self.usm_users.setdefault(user, [])
+        if usm not in key_sets:
+            key_sets.append(usm)
+            if len(key_sets) == 2:
+                logger.info("[SnmpBooster] [code 0609] SNMPv3 user %s is "
+                            "used with different keys or protocols: each "
+                            "set gets its own SNMP engine" % user)
+        index = key_sets.index(usm)
+        cmd_gens = self.generation['cmd_gens']
+        while len(cmd_gens) <= index:
+            cmd_gens.append(cmdgen.AsynCommandGenerator())
+        cmd_gen = cmd_gens[index]
+        if auth_key is None:
+            # noAuthNoPriv
+            return cmdgen.UsmUserData(user), cmd_gen
+        if priv_key is None:
+            # authNoPriv
+            return (cmdgen.UsmUserData(user, auth_key,
+                                       authProtocol=AUTH_PROTOCOLS[auth_protocol]),
+                    cmd_gen)
+        return (cmdgen.UsmUserData(user, auth_key, priv_key,
+                                   authProtocol=AUTH_PROTOCOLS[auth_protocol],
+                                   privProtocol=PRIV_PROTOCOLS[priv_protocol]),
+                cmd_gen)
+
+    def get_target(self, snmp_task):
+        """ Return the transport target of a task """
+        timeout = get_target_timeout(snmp_task)
+        key = (snmp_task['address'], snmp_task['port'], timeout,
+               snmp_task['retries'])
+        # Targets are put back at the end: the first one is the least
+        # recently used
+        target = self.targets.pop(key, None)
+        if target is None or target[1] + ADDRESS_TTL < time.time():
+            # Communities match targets with the common tag
+            tag_list = "%s t%sr%s" % (ENGINE_TAG, timeout,
+                                      snmp_task['retries'])
+            target = (self.target_class(key[:2],
+                                        timeout=timeout,
+                                        retries=snmp_task['retries'],
+                                        tagList=tag_list,
+                                        ),
+                      time.time())
+        self.targets[key] = target
+        if len(self.targets) > ENGINE_MAX_TARGETS:
+            self.targets.popitem(last=False)
+        self.generation['targets'].add((key, target[1]))
+        return target[0]
+
+    def send_request(self, snmp_task, cb_fun, cb_ctx):
+        """ Send the SNMP request of a task
+        pysnmp objects are built here: tasks only hold python values.
+        `cb_fun' gets normalized var binds (see normalize_var_binds): a
+        list of (oid, value) for get requests, a list of rows for next
+        and bulk requests
+        """
+        if (self.templates is not None and snmp_task['type'] == 'get' and
+                int(snmp_task['version']) in (1, 2)):
+            if self.templates.send_request(snmp_task, cb_fun, cb_ctx):
+                return
+        self.send_pysnmp_request(snmp_task, cb_fun, cb_ctx)
+
+    def send_pysnmp_request(self, snmp_task, cb_fun, cb_ctx):
+        """ Send the SNMP request of a task with pysnmp """
+        auth, cmd_gen = self.get_auth(snmp_task)
+        generation = self.generation
+        data = {"authData": auth,
+                "transportTarget": self.get_target(snmp_task),
+                "varNames": snmp_task['oids'],
+                "cbInfo": (callback_pysnmp, (snmp_task, cb_fun, cb_ctx,
+                                             generation)),
+                }
+        if snmp_task['type'] == 'bulk':
+            data["nonRepeaters"] = 0
+            data["maxRepetitions"] = snmp_task['max_repetitions']
+        snmp_command_name = ("async" +
+                             snmp_task['type'].capitalize() +
+                             "Cmd")
+        getattr(cmd_gen, snmp_command_name)(**data)
+        generation['in_flight'] += 1
+
+    def dispatch(self, timeout):
+        """ Wait at most `timeout' seconds for SNMP responses and handle
+        them, then handle the request timeouts
+        Unlike runDispatcher, it does not wait for all the requests: new
+        requests can be sent between two calls
+        """
+        dispatchers = [cmd_gen.snmpEngine.transportDispatcher
+                       for cmd_gen in self.get_cmd_gens()
+                       if cmd_gen.snmpEngine.transportDispatcher is not None]
+        socket_map = {}
+        for dispatcher in dispatchers:
+            socket_map.update(dispatcher.getSocketMap())
+        if self.templates is not None:
+            socket_map.update(self.templates.socket_map)
+        if not socket_map:
+            # No request sent yet
+            time.sleep(timeout)
+            return
+        asyncore.loop(timeout, use_poll=True, map=socket_map, count=1)
+        for dispatcher in dispatchers:
+            dispatcher.handleTimerTick(time.time())
+        if self.templates is not None:
+            self.templates.handle_timeouts(time.time())
+
+
+def learn_response(profile, snmp_task, success, error_status, size,
+                   timed_out):
+    """ Update the profile of a device from the response of a task
+    `size' is the size of the var binds of a successful GET response
+
+    Return True if the profile changed
+    """
+    changed = False
+    if snmp_task['type'] == 'get':
+        nb_oids = len(snmp_task['oids'])
+        if success:
+            changed = profile.request_ok(nb_oids, size,
+                                         snmp_task.get('max_oids', nb_oids))
+        elif timed_out and 0 < profile.ok_oids < nb_oids:
+            # The device may drop big requests
+            changed = profile.request_too_big(nb_oids,
+                                              snmp_task.get('size', 0))
+    elif snmp_task['type'] == 'bulk':
+        if success:
+            changed = profile.bulk_result(True)
+        elif error_status != 0 or (timed_out and profile.ok_oids > 0):
+            # The device answers GET requests
+            changed = profile.bulk_result(False)
+    return changed
+
+
+def get_target_timeout(snmp_task):
+    """ Return the timeout of the transport target of a task: its timeout
+    rounded up to TARGET_TIMEOUT_STEP, at most the configured timeout
+    Targets are cached by timeout: the rounding bounds their number
+    """
+    timeout = snmp_task['timeout']
+    steps = math.ceil(round(timeout / TARGET_TIMEOUT_STEP, 6))
+    timeout = round(max(steps, 1) * TARGET_TIMEOUT_STEP, 1)
+    return min(timeout, snmp_task.get('max_timeout', timeout))
+
+
+def get_rtt_sample(snmp_task, sent_time, error_indication):
+    """ Return the RTT of the first response of a task, or None
+    Responses received after a retry are ambiguous and give no sample
+    """
+    if error_indication is not None or sent_time is None:
+        return None
+    rtt = time.time() - sent_time
+    if rtt > snmp_task['timeout']:
+        return None
+    return rtt
+
+
+def walk_finished(error_indication, error_status, var_binds):
+    """ Return True if pysnmp will not continue a walk
+    after these normalized var binds
+    Walks have one column: pysnmp stops them on errors, empty responses
+    and at the end of the MIB view
+    """
+    return (error_indication is not None or error_status != 0 or
+            not var_binds or var_binds[-1][-1][1] == END_OF_MIB_VIEW)
+
+
+def call_callback(snmp_task, responses):
+    """ Call the callback of a task with its responses: a list of
+    (error_indication, error_status, error_index, var_binds)
+
+    Return True if the callback asks for the next rows
+    """
+    callback, callback_ctx = snmp_task['callback']
+    for error_indication, error_status, error_index, var_binds in responses:
+        try:
+            if not callback(None, error_indication, error_status,
+                            error_index, var_binds, callback_ctx):
+                return False
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 0608] [%s] Error "
+                         "while handling the SNMP response: "
+                         "%s" % (snmp_task['host'], str(exp)))
+            return False
+    return True
+
+
+def callback_thread(send_request_handle, error_indication, error_status,
+                    error_index, var_binds, cb_ctx):
+    """ SNMP engine callback which calls the task callback, in the SNMP
+    worker thread """
+    worker, snmp_task, sent_time = cb_ctx
+    # The first response gives the RTT, the next ones are walk steps
+    rtt = get_rtt_sample(snmp_task, sent_time.pop() if sent_time else None,
+                         error_indication)
+    timed_out = isinstance(error_indication, RequestTimedOut)
+    worker.update_rtt(snmp_task, rtt, timed_out)
+    if worker.split_too_big(snmp_task, error_status):
+        worker.task_finished(snmp_task)
+        return False
+    worker.update_profile(snmp_task, error_indication, error_status,
+                          var_binds, timed_out)
+    if error_indication is not None:
+        error_indication = str(error_indication)
+    next_rows = call_callback(snmp_task, [(error_indication, error_status,
+                                           error_index, var_binds)])
+    if (not next_rows or snmp_task['type'] == 'get' or
+            walk_finished(error_indication, error_status, var_binds)):
+        worker.task_finished(snmp_task)
+    return next_rows
+
+
+def callback_collect(send_request_handle, error_indication, error_status,
+                     error_index, var_binds, cb_ctx):
+    """ SNMP engine callback which stores the responses of a task, in the
+    SNMP engine process
+
+    Walks (next and bulk tasks) continue until the end of the subtree of
+    the requested oid, all rows are sent back in one response
+    """
+    task_id, snmp_task, pending, finished = cb_ctx
+    responses, sent_time = pending[task_id]
+    rtt = get_rtt_sample(snmp_task, sent_time, error_indication)
+    if rtt is not None:
+        # Only the first response gives the RTT
+        pending[task_id] = (responses, None)
+        snmp_task['rtt'] = rtt
+    snmp_task['timed_out'] = isinstance(error_indication, RequestTimedOut)
+    if error_indication is not None:
+        responses.append((str(error_indication), error_status,
+                          error_index, []))
+        done = True
+    elif snmp_task['type'] == 'get':
+        responses.append((None, error_status, error_index, var_binds))
+        done = True
+    elif error_status != 0:
+        # The rows received before the error are kept
+        responses.append((None, error_status, error_index, []))
+        done = True
+    else:
+        if not responses:
+            responses.append((None, 0, 0, []))
+        rows = responses[0][3]
+        root_oid = "." + snmp_task['oids'][0]
+        done = walk_finished(None, error_status, var_binds)
+        for row in var_binds:
+            rows.append(row)
+            if any(not oid.startswith(root_oid) or value == END_OF_MIB_VIEW
+                   for oid, value in row):
+                done = True
+                break
+    if done:
+        pending.pop(task_id)
+        finished.append((task_id, responses, snmp_task.get('rtt'),
+                         snmp_task['timed_out']))
+    return not done
+
+
+def engine_process_main(requests, responses, use_templates):
+    """ Main loop of a SNMP engine process
+    Requests are lists of (task id, task), sent while other tasks are in
+    flight. Responses are lists of (task id, task responses, RTT, timed
+    out), sent as soon as the tasks are finished
+    """
+    # The Poller handles the signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    engine = SNMPEngine(use_templates)
+    # Responses and send time of the tasks in flight
+    pending = {}
+    finished = []
+    while True:
+        # Wait for tasks only when idle
+        messages = [requests.get()] if not pending else []
+        while True:
+            try:
+                messages.append(requests.get_nowait())
+            except Empty:
+                break
+        if None in messages:
+            break
+        for message in messages:
+            for task_id, snmp_task in message:
+                pending[task_id] = ([], time.time())
+                try:
+                    engine.send_request(snmp_task, callback_collect,
+                                        (task_id, snmp_task, pending,
+                                         finished))
+                except Exception as exp:
+                    # The task gets an error: its check is not waiting
+                    # forever
+                    error = "SNMP engine error: %s" % str(exp)
+                    pending.pop(task_id)
+                    finished.append((task_id, [(error, 0, 0, [])], None,
+                                     False))
+        engine.recycle()
+        if pending:
+            engine.dispatch(DISPATCH_INTERVAL)
+        if finished:
+            # Callback contexts hold this list, the queue gets a copy
+            responses.put(finished[:])
+            del finished[:]
+    engine.stop()
+
+
+class SNMPEngineProcess(object):
+    """ SNMP engine running in a child process
+
+    pysnmp objects are only built and decoded in the child process: tasks
+    and responses only hold python values
+    """
+    def __init__(self, shard, use_templates=False):
+        self.requests = ProcessQueue()
+        self.responses = ProcessQueue()
+        self.process = Process(target=engine_process_main,
+                               args=(self.requests, self.responses,
+                                     use_templates),
+                               name="SNMPEngine-%d" % shard)
+        # The process must not survive the Poller
+        self.process.daemon = True
+
+    def start(self):
+        """ Start the engine process """
+        self.process.start()
+
+    def send_tasks(self, snmp_tasks):
+        """ Send a list of (task id, task) to the engine process """
+        # Callbacks stay in this process
+        self.requests.put([(task_id,
+                            dict([(name, value)
+                                  for name, value in snmp_task.iteritems()
+                                  if name != 'callback']))
+                           for task_id, snmp_task in snmp_tasks])
+
+    def get_responses(self, timeout):
+        """ Wait at most `timeout' seconds for finished tasks
+
+        Return
+        * list of (task id, list of (error_indication, error_status,
+          error_index, var_binds), RTT or None, timed out)
+        """
+        try:
+            return self.responses.get(timeout=timeout)
+        except Empty:
+            if not self.process.is_alive():
+                raise Exception("SNMP engine process exited with code "
+                                "%s" % self.process.exitcode)
+            return []
+
+    def stop(self):
+        """ Stop the engine process """
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class TaskRouter(object):
+    """ Send each SNMP task to the task queue of one SNMPWorker
+
+    The queue is chosen with the target address, so all requests to a
+    device are made by the same worker: the `no_concurrency' option
+    still works, and requests to a device keep their order
+    """
+    def __init__(self, queues):
+        self.queues = queues
+
+    def get_shard(self, address):
+        """ Return the shard (queue index) of a target address """
+        return int(hashlib.md5(str(address)).hexdigest()[:8], 16) % len(self.queues)
+
+    def put(self, snmp_task, block=True):
+        """ Add a task to the queue of its target address """
+        self.queues[self.get_shard(snmp_task['host'])].put(snmp_task, block)
+
+
+class DeviceScheduler(object):
+    """ Queues of SNMP tasks waiting for their device
+
+    Each device (task host) has a window: the max number of its tasks in
+    flight. `no_concurrency' tasks have a window of 1, so they are never
+    sent while another request is made to their device. Other tasks use
+    `max_in_flight', 0 means no limit.
+    Devices with a waiting task and a free window are in a ready queue,
+    served in turn: all operations are O(1)
+
+    The time tasks wait for their device is kept, to find devices which
+    throttle the requests
+    """
+    def __init__(self, max_in_flight=0):
+        self.max_in_flight = max_in_flight
+        # {host: deque of (task, queued time)}
+        self.waiting = {}
+        # {host: number of tasks in flight}
+        self.in_flight = {}
+        # Hosts which can send their next task
+        self.ready = deque()
+        self.ready_hosts = set()
+        self.nb_waiting = 0
+        # {host: [tasks, total wait time, max wait time]}
+        self.wait_stats = {}
+
+    def has_free_slot(self, snmp_task):
+        """ Return True if the task can be sent now """
+        window = 1 if snmp_task['no_concurrency'] else self.max_in_flight
+        return window <= 0 or self.in_flight.get(snmp_task['host'], 0) < window
+
+    def set_ready(self, host):
+        """ Add the host in the ready queue, if its next task can be sent """
+        if host not in self.ready_hosts and self.has_free_slot(self.waiting[host][0][0]):
+            self.ready.append(host)
+            self.ready_hosts.add(host)
+
+    def push(self, snmp_task):
+        """ Add a task in the queue of its device """
+        host = snmp_task['host']
+        self.waiting.setdefault(host, deque()).append((snmp_task, time.time()))
+        self.nb_waiting += 1
+        self.set_ready(host)
+
+    def pop(self):
+        """ Return the next task which can be sent, or None
+        The task is in flight until task_finished is called
+        """
+        if not self.ready:
+            return None
+        host = self.ready.popleft()
+        self.ready_hosts.discard(host)
+        queue = self.waiting[host]
+        snmp_task, queued_time = queue.popleft()
+        self.nb_waiting -= 1
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        # Save wait time
+        wait_time = time.time() - queued_time
+        stats = self.wait_stats.setdefault(host, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += wait_time
+        stats[2] = max(stats[2], wait_time)
+        if queue:
+            # Other devices are served before the next task of this one
+            self.set_ready(host)
+        else:
+            del self.waiting[host]
+        return snmp_task
+
+    def task_finished(self, snmp_task):
+        """ Free the window slot of a task """
+        host = snmp_task['host']
+        self.in_flight[host] -= 1
+        if self.in_flight[host] == 0:
+            del self.in_flight[host]
+        if host in self.waiting:
+            self.set_ready(host)
+
+    def get_wait_stats(self):
+        """ Return wait statistics of the devices since the last call
+        {host: [tasks, total wait time, max wait time]}
+        """
+        stats = self.wait_stats
+        self.wait_stats = {}
+        return stats
+
+
+class RttEstimator(object):
+    """ Round trip times of the devices, used to compute the timeout of
+    their requests (RFC 6298)
+
+    The timeout of a device is its smoothed RTT plus 4 times the RTT
+    variation, rounded up to the pysnmp timer resolution and bounded by
+    `min_timeout' and the configured timeout. Each timeout doubles it
+    until a new RTT is measured. Devices with DEAD_DEVICE_TIMEOUTS
+    consecutive timeouts get no retry, so requests to dead devices wait
+    for one timeout only.
+    If `adaptive' is False, RTTs are measured but the configured timeouts
+    and retries are used
+    """
+    def __init__(self, adaptive=False, min_timeout=TIMEOUT_STEP):
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        # {host: [smoothed RTT, RTT variation, backoff, consecutive timeouts]}
+        self.devices = {}
+
+    def update(self, host, rtt, timed_out):
+        """ Update the device with a response (RTT or None if it can not
+        be measured) or a timeout
+        """
+        device = self.devices.setdefault(host, [None, None, 1, 0])
+        if timed_out:
+            device[2] = min(device[2] * 2, RTT_MAX_BACKOFF)
+            device[3] += 1
+            return
+        # The device answers
+        device[3] = 0
+        if rtt is None:
+            return
+        device[2] = 1
+        if device[0] is None:
+            device[0] = rtt
+            device[1] = rtt / 2
+        else:
+            device[1] = (1 - RTT_BETA) * device[1] + RTT_BETA * abs(device[0] - rtt)
+            device[0] = (1 - RTT_ALPHA) * device[0] + RTT_ALPHA * rtt
+
+    def get_rto(self, device, max_timeout):
+        """ Return the timeout computed from the device RTT """
+        if device[0] is None:
+            return max_timeout
+        rto = (device[0] + 4 * device[1]) * device[2]
+        rto = math.ceil(rto / TIMEOUT_STEP) * TIMEOUT_STEP
+        return max(self.min_timeout, min(rto, max_timeout))
+
+    def get_timeout(self, snmp_task):
+        """ Return the timeout and retries of a task """
+        timeout = snmp_task.get('max_timeout', snmp_task['timeout'])
+        retries = snmp_task.get('max_retries', snmp_task['retries'])
+        device = self.devices.get(snmp_task['host'])
+        if not self.adaptive or device is None:
+            return timeout, retries
+        if device[3] >= DEAD_DEVICE_TIMEOUTS:
+            retries = 0
+        return self.get_rto(device, timeout), retries
+
+    def get_stats(self):
+        """ Return RTT statistics of the devices
+        {host: (smoothed RTT, RTT variation, consecutive timeouts)}
+        RTTs are None for devices which never answered
+        """
+        return dict([(host, (device[0], device[1], device[3]))
+                     for host, device in self.devices.items()])
+
 
 class SNMPWorker(Thread):
-    """ Thread which execute all SNMP tasks/requests """
-    def __init__(self, mapping_queue, max_prepared_tasks):
-        Thread.__init__(self)
-        self.cmdgen = None # will be cmdgen.AsynCommandGenerator()
+    """ Thread which execute all SNMP tasks/requests
+    `shard' is the worker number, when tasks are shared between several
+    workers by a TaskRouter
+    If `use_process' is True, the SNMP requests are made by a
+    SNMPEngineProcess and the task callbacks are called by this thread
+
+    The SNMP engine lives as long as the worker. Tasks are sent to it
+    while other tasks are in flight, up to `max_prepared_tasks' tasks,
+    and up to `max_device_in_flight' tasks for each device (see
+    DeviceScheduler)
+    If `adaptive_timeout' is True, timeouts and retries of the tasks are
+    computed from the RTT of their device (see RttEstimator)
+    If `use_templates' is True, v1/v2c GET requests are sent from encoded
+    templates (see GetTemplateTransport)
+    If `profiles' is a DeviceProfiles, the SNMP capabilities of the
+    devices are learned from the responses. GET requests which get tooBig
+    are split and sent again
+    """
+    def __init__(self, mapping_queue, max_prepared_tasks, shard=0,
+                 use_process=False, max_device_in_flight=0,
+                 adaptive_timeout=False, min_timeout=TIMEOUT_STEP,
+                 use_templates=False, profiles=None):
+        Thread.__init__(self, name="SNMPWorker-%d" % shard)
+        self.engine = None # will be SNMPEngine or SNMPEngineProcess
         self.mapping_queue = mapping_queue
         self.max_prepared_tasks = max_prepared_tasks
+        self.shard = shard
+        self.use_process = use_process
+        self.use_templates = use_templates
+        # Tasks prepared for the engine process: list of (task id, task)
+        self.prepared_tasks = []
+        # Tasks sent to the engine process: {task id: task}
+        self.pending_tasks = {}
+        self.last_task_id = 0
+        # Tasks waiting for their device
+        self.scheduler = DeviceScheduler(max_device_in_flight)
+        # RTT of the devices
+        self.rtt = RttEstimator(adaptive_timeout, min_timeout)
+        # SNMP capabilities of the devices
+        self.profiles = profiles
         self.must_run = False
         self.task_prepared = 0
+        # Number of tasks sent to the dispatcher and not finished yet
+        self.in_flight = 0
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Reset worker statistics """
+        self.stats = {'tasks': 0,
+                      'splits': 0,
+                      'dispatches': 0,
+                      'max_in_flight': 0,
+                      'busy': 0.0,
+                      'start': time.time(),
+                      }
+
+    def get_stats(self):
+        """ Return worker statistics since the last call, with the
+        current task queue size and number of tasks in flight
+        """
+        stats = self.stats
+        self.reset_stats()
+        stats['queue'] = self.mapping_queue.qsize() + self.scheduler.nb_waiting
+        stats['in_flight'] = self.in_flight
+        stats['devices'] = self.scheduler.get_wait_stats()
+        stats['rtt'] = self.rtt.get_stats()
+        stats['elapsed'] = self.stats['start'] - stats['start']
+        return stats
 
     def append_task_to_dispatcher(self, snmp_task):
         if snmp_task['type'] in ['bulk', 'next', 'get']:
-            # Append snmp requests
-            snmp_command_name = ("async" +
-                                 snmp_task['type'].capitalize() +
-                                 "Cmd")
-            getattr(self.cmdgen, snmp_command_name)(**snmp_task['data'])
-            # Mark task as done
-            self.mapping_queue.task_done()
+            self.in_flight += 1
             self.task_prepared += 1
+            # Configured values are bounds of the adaptive ones: a
+            # task sent again (split) keeps its configured timeout
+            # and retries
+            snmp_task.setdefault('max_timeout', snmp_task['timeout'])
+            snmp_task.setdefault('max_retries', snmp_task['retries'])
+            snmp_task['timeout'], snmp_task['retries'] = self.rtt.get_timeout(snmp_task)
+            # Append snmp requests
+            self.send_task(snmp_task)
         else:
             # If the request is not handled
             error_message = ("Bad SNMP requets type: '%s'. Must be "
@@ -68,93 +1034,182 @@ class SNMPWorker(Thread):
             logger.error("[SnmpBooster] [code 0603] [%s] "
                          "%s" % (snmp_task['host'],
                                  error_message))
+            self.scheduler.task_finished(snmp_task)
+
+    def send_task(self, snmp_task):
+        """ Send a task to the SNMP engine, or prepare it for the engine
+        process
+        """
+        if self.use_process:
+            self.last_task_id += 1
+            self.pending_tasks[self.last_task_id] = snmp_task
+            self.prepared_tasks.append((self.last_task_id, snmp_task))
+            return
+        try:
+            self.engine.send_request(snmp_task, callback_thread,
+                                     (self, snmp_task, [time.time()]))
+        except Exception as exp:
+            # The task gets an error: its check is not waiting
+            # forever
+            call_callback(snmp_task,
+                          [("SNMP engine error: %s" % str(exp),
+                            0, 0, [])])
+            self.task_finished(snmp_task)
+
+    def send_tasks(self):
+        """ Send tasks of devices with a free window, up to
+        `max_prepared_tasks' tasks in flight
+        """
+        self.task_prepared = 0
+        while self.in_flight < self.max_prepared_tasks:
+            snmp_task = self.scheduler.pop()
+            if snmp_task is None:
+                break
+            # Add task dispatcher
+            self.append_task_to_dispatcher(snmp_task)
+
+        if self.task_prepared > 0:
+            self.stats['tasks'] += self.task_prepared
+            self.stats['dispatches'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'],
+                                              self.in_flight)
+
+    def update_rtt(self, snmp_task, rtt, timed_out):
+        """ Update the RTT of the task device, see RttEstimator.update """
+        self.rtt.update(snmp_task['host'], rtt, timed_out)
+
+    def split_too_big(self, snmp_task, error_status):
+        """ Split a GET task which got tooBig in two tasks, which wait for
+        their device like new tasks
+
+        Return True if the task was split
+        """
+        oids = snmp_task['oids']
+        if (snmp_task['type'] != 'get' or error_status != TOO_BIG or
+                len(oids) < 2):
+            return False
+        if self.profiles is not None:
+            self.profiles.update(snmp_task['host'],
+                                 DeviceProfile.request_too_big,
+                                 len(oids), snmp_task.get('size', 0))
+        middle = len(oids) // 2
+        for part in (oids[:middle], oids[middle:]):
+            part_task = dict(snmp_task)
+            part_task['oids'] = part
+            part_task['size'] = snmp_task.get('size', 0) * len(part) // len(oids)
+            self.scheduler.push(part_task)
+        self.stats['splits'] += 1
+        return True
+
+    def update_profile(self, snmp_task, error_indication, error_status,
+                       var_binds, timed_out):
+        """ Learn the SNMP capabilities of the task device from a
+        response (see DeviceProfile)
+        """
+        if self.profiles is None:
+            return
+        success = error_indication is None and error_status == 0
+        size = 0
+        if success and snmp_task['type'] == 'get':
+            size = sum([var_bind_size(oid, value)
+                        for oid, value in var_binds])
+        self.profiles.update(snmp_task['host'], learn_response, snmp_task,
+                             success, error_status, size, timed_out)
+
+    def task_finished(self, snmp_task):
+        """ Called once for each task, when its last response is handled """
+        self.in_flight -= 1
+        self.scheduler.task_finished(snmp_task)
 
     def run(self):
         try:
+            if self.use_process:
+                self.engine = SNMPEngineProcess(self.shard,
+                                                self.use_templates)
+                self.engine.start()
+            else:
+                self.engine = SNMPEngine(self.use_templates)
             self.real_run()
         except Exception as err:
             logger.error('SNMPWorker got error: %s' % err)
+        finally:
+            if self.engine is not None:
+                self.engine.stop()
+
+    def dispatch(self):
+        """ Send the prepared tasks and handle the SNMP responses received
+        during DISPATCH_INTERVAL
+        """
+        if not self.use_process:
+            self.engine.dispatch(DISPATCH_INTERVAL)
+            return
+        if self.prepared_tasks:
+            self.engine.send_tasks(self.prepared_tasks)
+            self.prepared_tasks = []
+        for task_id, responses, rtt, timed_out in self.engine.get_responses(DISPATCH_INTERVAL):
+            snmp_task = self.pending_tasks.pop(task_id)
+            self.update_rtt(snmp_task, rtt, timed_out)
+            error_indication, error_status, _, var_binds = responses[-1]
+            if not self.split_too_big(snmp_task, error_status):
+                self.update_profile(snmp_task, error_indication,
+                                    error_status, var_binds, timed_out)
+                call_callback(snmp_task, responses)
+            self.task_finished(snmp_task)
 
     def real_run(self):
         """ Process SNMP tasks
-        SNMP task is a dict:
-        - For a bulk request ::
-
-            {"authData": cmdgen.CommunityData('public')
-             "transportTarget": cmdgen.UdpTransportTarget((transportTarget, 161))
-             "nonRepeaters": 0
-             "maxRepetitions": 64
-             "varNames": ['1.3.6.1.2.1.2.2.1.2.0', '...']
-             "cbInfo:: (cbFun, (arg1, arg2, ...))
-             }
-
-        - For a next request ::
+        SNMP task is a dict of python values (pysnmp objects are built by
+        the SNMP engine):
 
-            {"authData": cmdgen.CommunityData('public')
-             "transportTarget": cmdgen.UdpTransportTarget((transportTarget, 161))
-             "varNames": ['1.3.6.1.2.1.2.2.1.2.0', '...']
-             "cbInfo:: (cbFun, (arg1, arg2, ...))
-            }
-
-        - For a get request ::
+            {"type": "get", "next" or "bulk"
+             "host": "192.168.1.1" (target address, used for no_concurrency)
+             "no_concurrency": False
+             "community": "public"
+             "version": "2c"
+             "address": "192.168.1.1"
+             "port": 161
+             "timeout": 5
+             "retries": 1
+             "oids": ['1.3.6.1.2.1.2.2.1.2.0', '...']
+             "max_repetitions": 64 (bulk requests only)
+             "callback": (cbFun, (arg1, arg2, ...))
+             }
 
-            {"authData": cmdgen.CommunityData('public)
-             "transportTarget": cmdgen.UdpTransportTarget((transportTarget, 161))
-             "varNames": ['1.3.6.1.2.1.2.2.1.2.0', '...']
-             "cbInfo:: (cbFun, (arg1, arg2, ...))
-            }
+        Callbacks get normalized var binds (see normalize_var_binds): a
+        list of (oid, value) for get requests, a list of rows for next
+        and bulk requests. They return True to get the next rows
         """
         self.must_run = True
-        logger.info("[SnmpBooster] [code 0602] is starting")
-        slow_host_waiting = []
+        logger.info("[SnmpBooster] [code 0602] SNMP worker %d is "
+                    "starting" % self.shard)
         while self.must_run:
-            # Prevent memory leak
-            del self.cmdgen
-            self.cmdgen = cmdgen.AsynCommandGenerator()
-            # End prevent memory leak
-            self.task_prepared = 0
-            # slow host
-            slow_host_prepared = []
-            # Process slow hosts tasks
-            for index, snmp_task in enumerate(slow_host_waiting):
-                # Check if we have our max prepared tasks
-                if self.task_prepared > self.max_prepared_tasks:
-                    break
-                # Handle slow hosts
-                if snmp_task['no_concurrency']:
-                    if snmp_task['host'] in slow_host_prepared:
-                        continue
-                    else:
-                        slow_host_prepared.append(snmp_task['host'])
-                # Add task dispatcher
-                slow_host_waiting.pop(index)
-                self.append_task_to_dispatcher(snmp_task)
-            # Process normal tasks
-            while (not self.mapping_queue.empty()) and self.task_prepared <= self.max_prepared_tasks:
-                # Get task
-                snmp_task = self.mapping_queue.get()
-                # Handle slow hosts
-                if snmp_task['no_concurrency']:
-                    if snmp_task['host'] in slow_host_prepared:
-                        slow_host_waiting.append(snmp_task)
-                        continue
-                    else:
-                        slow_host_prepared.append(snmp_task['host'])
-                # Add task dispatcher
-                self.append_task_to_dispatcher(snmp_task)
-
-            if self.task_prepared > 0:
-                # Launch SNMP requests
-                self.cmdgen.snmpEngine.transportDispatcher.runDispatcher()
+            # Queue new tasks by device
+            while not self.mapping_queue.empty():
+                self.scheduler.push(self.mapping_queue.get())
+                self.mapping_queue.task_done()
+            if not self.use_process:
+                self.engine.recycle()
+            # Send tasks of devices with a free window
+            self.send_tasks()
+            if self.in_flight > 0:
+                dispatch_start = time.time()
+                # Handle SNMP responses, new tasks are taken after
+                # DISPATCH_INTERVAL at most
+                try:
+                    self.dispatch()
+                finally:
+                    self.stats['busy'] += time.time() - dispatch_start
             else:
                 # Sleep
                 time.sleep(0.1)
 
-        logger.info("[SnmpBooster] [code 0604] is stopped")
+        logger.info("[SnmpBooster] [code 0604] SNMP worker %d is "
+                    "stopped" % self.shard)
 
     def stop_worker(self):
         """ Stop SNMP worker thread """
-        logger.info("[SnmpBooster] [code 0605] will be stopped")
+        logger.info("[SnmpBooster] [code 0605] SNMP worker %d will be "
+                    "stopped" % self.shard)
         self.must_run = False
 
 
@@ -164,8 +1219,6 @@ def handle_snmp_error(error_indication, cb_ctx, request_type):
         # No error
         return False
 
-    # Get results
-    results = cb_ctx[0]
     # Current elected service result
     service_result = cb_ctx[1]
 
@@ -175,13 +1228,44 @@ def handle_snmp_error(error_indication, cb_ctx, request_type):
                          str(error_indication)))
     # If is a get request
     if request_type == "get":
-        # We set SNMP error in all oids
-        for result in results.values():
-            result['error'] = str(error_indication)
+        # The check fails: complete_results sets the error of its oids
+        cb_ctx[3]['error'] = str(error_indication)
 
     return True
 
 
+def new_completion(results, service_result):
+    """ Return the completion state of the results of a check, shared by
+    its SNMP tasks:
+
+    * pending: number of oids without value or error
+    * done: True when the results are sent to the saving queue
+    * error: SNMP error which ended the check, or None
+    * current: results of the checked service
+    """
+    return {'pending': len(results),
+            'done': False,
+            'error': None,
+            'current': [r for r in results.values()
+                        if r['key']['host'] == service_result['host']
+                        and r['key']['service'] == service_result['service']],
+            }
+
+
+def set_result(result, completion, value=None, error=None):
+    """ Save the value or the error of an oid
+    The first value or error of an oid counts it as received
+    """
+    pending = result.get('value') is None and result.get('error') is None
+    if error is not None:
+        result['error'] = error
+    else:
+        result['value'] = value
+    if pending and (result.get('value') is not None or
+                    result.get('error') is not None):
+        completion['pending'] -= 1
+
+
 def callback_get(send_request_handle, error_indication, error_status,
                  error_index, var_binds, cb_ctx):
     """ Callback function for GET SNMP requests """
@@ -192,83 +1276,150 @@ def callback_get(send_request_handle, error_indication, error_status,
     service_result = cb_ctx[1]
     # Get queue to submit result
     result_queue = cb_ctx[2]
+    # Completion state of the results
+    completion = cb_ctx[3]
 
     # Handle errors
     if handle_snmp_error(error_indication, cb_ctx, "get"):
-        # set as received
-        service_result['state'] = 'received'
-        result_queue.put(results)
+        complete_results(results, service_result, result_queue, completion)
         return False
 
     # browse reponses
     for oid, value in var_binds:
         # for each oid, value
-        # prepare the oid
-        oid = "." + oid.prettyPrint()
         # if we need this oid
-        if oid in results:
+        result = results.get(oid)
+        if result is not None:
             # Check if we have a nosuchinstance error
-            if value == noSuchInstance:
+            if value in (NO_SUCH_INSTANCE, NO_SUCH_OBJECT):
                 # Log NoSuchInstance SNMP error
                 message = "Oid not found on the device: %s" % oid
                 logger.error("[SnmpBooster] [code 0607] [%s, %s] SNMP Error: "
-                             "%s" % (results.values()[0]['key']['host'],
-                                     results[oid]['key']['service'],
+                             "%s" % (result['key']['host'],
+                                     result['key']['service'],
                                      message))
-                results[oid]['error'] = message
+                set_result(result, completion, error=message)
             else:
                 # save value
-                results[oid]['value'] = value
+                set_result(result, completion, value)
 
             # save check time
-            results[oid]['check_time'] = time.time()
-
-    # Check if we get all values
-    result_with_value_or_error = [oid['value'] for oid in results.values()
-                                  if oid.get('value') is None
-                                  and oid.get('error') is None]
-    if len(result_with_value_or_error) == 0:
-        # Add a saving task to the saving queue
-        # (processed by the function save_results)
-        result_queue.put(results)
+            result['check_time'] = time.time()
 
-        # Prepare datas for the current service
-        tmp_results = [r for r in results.values()
-                       if r['key']['host'] == service_result['host']
-                       and r['key']['service'] == service_result['service']]
-        for tmp_result in tmp_results:
-            key = tmp_result.get('key')
-            # ds name
-            ds_names = key.get('ds_names')
-            for ds_name in ds_names:
-                # Last value
-                last_value_key = ".".join(("ds",
-                                           ds_name,
-                                           key.get('oid_type') + "_value_last"
-                                           )
-                                          )
-                # New value
-                value_key = ".".join(("ds",
-                                      ds_name,
-                                      key.get('oid_type') + "_value"
-                                      )
-                                     )
-                # Set last value
-                service_result['db_data']['ds'][ds_name][last_value_key] = tmp_result.get('value_last')
-                # Set value
-                service_result['db_data']['ds'][ds_name][value_key] = tmp_result.get('value')
-        # Set last check time
-        service_result['db_data']['check_time_last'] = service_result['db_data'].get('check_time')
-        # Set check time
-        service_result['db_data']['check_time'] = time.time()
+    complete_results(results, service_result, result_queue, completion)
+
+
+def complete_results(results, service_result, result_queue, completion):
+    """ Send the results to the saving queue and prepare the current
+    service data, once all oids have a value or an error
+    Called at the end of each SNMP task of a check
+    """
+    if completion['done']:
+        return
+    if completion['error'] is not None:
+        # An SNMP error ends the check: its pending oids get the error
+        completion['done'] = True
+        for result in results.values():
+            if result.get('value') is None and result.get('error') is None:
+                result['error'] = completion['error']
         # set as received
         service_result['state'] = 'received'
-        # Calculate execution time
-        service_result['execution_time'] = time.time() - service_result['start_time']
-
-    else:
-        pass
+        result_queue.put(results)
+        return
+    if completion['pending'] > 0:
         # Not all data are received, we need to wait an other query
+        return
+    completion['done'] = True
+    # Add a saving task to the saving queue
+    # (processed by the function save_results)
+    result_queue.put(results)
+
+    # Prepare datas for the current service
+    for tmp_result in completion['current']:
+        key = tmp_result.get('key')
+        # ds name
+        ds_names = key.get('ds_names')
+        for ds_name in ds_names:
+            # Last value
+            last_value_key = ".".join(("ds",
+                                       ds_name,
+                                       key.get('oid_type') + "_value_last"
+                                       )
+                                      )
+            # New value
+            value_key = ".".join(("ds",
+                                  ds_name,
+                                  key.get('oid_type') + "_value"
+                                  )
+                                 )
+            # Set last value
+            service_result['db_data']['ds'][ds_name][last_value_key] = tmp_result.get('value_last')
+            # Set value
+            service_result['db_data']['ds'][ds_name][value_key] = tmp_result.get('value')
+    # Set last check time
+    service_result['db_data']['check_time_last'] = service_result['db_data'].get('check_time')
+    # Set check time
+    service_result['db_data']['check_time'] = time.time()
+    # set as received
+    service_result['state'] = 'received'
+    # Calculate execution time
+    service_result['execution_time'] = time.time() - service_result['start_time']
+
+
+def callback_walk(send_request_handle, error_indication, error_status,
+                  error_index, var_binds, cb_ctx):
+    """ Callback function for the BULK walks of table columns
+
+    Walked rows are dispatched to the needed oids, by instance. The
+    number of rows of the column is saved in the device profile
+    """
+    results = cb_ctx[0]
+    service_result = cb_ctx[1]
+    result_queue = cb_ctx[2]
+    completion = cb_ctx[3]
+    # column, needed oids, rows, device profiles and address
+    walk = cb_ctx[4]
+
+    error = None
+    finished = not var_binds
+    if handle_snmp_error(error_indication, cb_ctx, "bulk"):
+        error = str(error_indication)
+        finished = True
+    elif error_status != 0:
+        error = "SNMP error status: %d" % error_status
+        finished = True
+    prefix = walk['column'] + "."
+    for table_row in var_binds if error is None else []:
+        for oid, value in table_row:
+            if not oid.startswith(prefix) or value == END_OF_MIB_VIEW:
+                # End of the column
+                finished = True
+                break
+            walk['rows'] += 1
+            if oid in walk['needed']:
+                set_result(results[oid], completion, value)
+                results[oid]['check_time'] = time.time()
+                walk['needed'].discard(oid)
+        if finished:
+            break
+    if not finished:
+        return True
+
+    for oid in walk['needed']:
+        if error is not None:
+            set_result(results[oid], completion, error=error)
+            continue
+        message = "Oid not found on the device: %s" % oid
+        logger.error("[SnmpBooster] [code 0607] [%s, %s] SNMP Error: "
+                     "%s" % (results[oid]['key']['host'],
+                             results[oid]['key']['service'],
+                             message))
+        set_result(results[oid], completion, error=message)
+    if error is None and walk['profiles'] is not None:
+        walk['profiles'].update(walk['address'], DeviceProfile.table_walked,
+                                walk['column'], walk['rows'])
+    complete_results(results, service_result, result_queue, completion)
+    return False
 
 
 def callback_mapping_next(send_request_handle, error_indication,
@@ -287,7 +1438,6 @@ def callback_mapping_next(send_request_handle, error_indication,
     # Parse snmp results
     for table_row in var_binds:
         for oid, instance_name in table_row:
-            oid = "." + oid.prettyPrint()
             # Test if we are not in the mapping oid
             if not oid.startswith(mapping_oid):
                 # We are not in the mapping oid
@@ -334,7 +1484,6 @@ def callback_mapping_bulk(send_request_handle, error_indication,
     # Parse snmp results
     for table_row in var_binds:
         for oid, instance_name in table_row:
-            oid = "." + oid.prettyPrint()
             # Test if we are not in the mapping oid
             if not oid.startswith(mapping_oid):
                 # We are not in the mapping oid
@@ -24,14 +24,19 @@
 Usefull functions used everywhere in snmp booster
 """
 
-import re
 import sys
 import getopt
 import shlex
 import operator
-from collections import OrderedDict
 from shinken.log import logger
 
+from datasourceindex import DatasourceIndex
+
+
+# SNMPv3 authentication and privacy protocols
+AUTH_PROTOCOLS = ('MD5', 'SHA')
+PRIV_PROTOCOLS = ('DES', '3DES', 'AES', 'AES192', 'AES256')
+
 
 def flatten_dict(tree_dict):
     """ Convert unlimited tree dictionnary to a flat dictionnary
@@ -79,7 +84,7 @@ def merge_dicts(old_dict, new_dict):
 
     for t_key, t_value in new_dict.items():
         if isinstance(t_value, dict):
-            ret = merge_dicts(old_dict[t_key], t_value)
+            ret = merge_dicts(old_dict.get(t_key), t_value)
             old_dict[t_key] = ret
         else:
             old_dict[t_key] = t_value
@@ -261,6 +266,12 @@ def parse_args(cmd_args):
             "port": 161,
             "timeout": 5,
             "retry": 1,
+            # SNMPv3 options
+            "user": None,
+            "auth_protocol": 'MD5',
+            "auth_key": None,
+            "priv_protocol": 'DES',
+            "priv_key": None,
             # Datasource options
             "dstemplate": None,
             "instance": None,
@@ -283,10 +294,12 @@ def parse_args(cmd_args):
     # Handle options
     try:
         options, _ = getopt.getopt(cmd_args,
-                                   'H:A:S:C:V:P:s:e:t:i:n:m:N:T:b:M:R:g:c:d:v:r',
+                                   'H:A:S:C:V:P:s:e:u:a:k:x:X:t:i:n:m:N:T:b:M:R:g:c:d:v:r',
                                    ['host-name=', 'host-address=', 'service=',
                                     'community=', 'snmp-version=', 'port=',
                                     'timeout=', 'retry=',
+                                    'user=', 'auth-protocol=', 'auth-key=',
+                                    'priv-protocol=', 'priv-key=',
                                     'dstemplate=', 'instance=',
                                     'instance-name=',
                                     'mapping=', 'mapping-name=',
@@ -321,6 +334,25 @@ def parse_args(cmd_args):
             args['timeout'] = int(value)
         elif option_name in ("-e", "--retry"):
             args['retry'] = int(value)
+        # SNMPv3 options
+        elif option_name in ("-u", "--user"):
+            args['user'] = value
+        elif option_name in ("-a", "--auth-protocol"):
+            if value.upper() in AUTH_PROTOCOLS:
+                args['auth_protocol'] = value.upper()
+            else:
+                logger.warning('[SnmpBooster] [code 0805] Bad '
+                               'auth_protocol: setting to MD5')
+        elif option_name in ("-k", "--auth-key"):
+            args['auth_key'] = value
+        elif option_name in ("-x", "--priv-protocol"):
+            if value.upper() in PRIV_PROTOCOLS:
+                args['priv_protocol'] = value.upper()
+            else:
+                logger.warning('[SnmpBooster] [code 0806] Bad '
+                               'priv_protocol: setting to DES')
+        elif option_name in ("-X", "--priv-key"):
+            args['priv_key'] = value
         # Datasource options
         elif option_name in ("-t", "--dstemplate"):
             args['dstemplate'] = value
@@ -382,6 +414,7 @@ def parse_args(cmd_args):
                      'instance_name',
                      'dstemplate',
                      'triggergroup',
+                     'user',
                      ]
     for arg_name in nullable_args:
         if args[arg_name] and (args[arg_name].startswith('-') or args[arg_name].lower() == 'none'):
@@ -399,6 +432,11 @@ def parse_args(cmd_args):
                              "line" % arg_name)
             raise Exception(error_message)
 
+    # SNMPv3 needs a user
+    if args['version'] == 3 and args['user'] is None:
+        raise Exception("Argument user is missing in the command line "
+                        "(needed by SNMP version 3)")
+
     # Check if we have all arguments to map instance
     if args['instance_name'] != '' and args['instance_name'] is not None and (
                     args['mapping'] is None and args['mapping_name'] is None):
@@ -417,28 +455,68 @@ def parse_args(cmd_args):
     return args
 
 
-REGEX_OID = re.compile('\.\d+(\.\d+)*')
-REGEX_DS_ATTRIBUTE = re.compile('ds_*')
+# Datasource index used by the serialization processes, see init_serializer
+_SERIALIZER_INDEX = None
 
 
 def dict_serialize(serv, mac_resol, datasource):
-    """ Get serv, datasource
+    """ Get serv, datasource (or its DatasourceIndex)
         And return the service serialized
     """
-    tmp_dict = {}
+    if not isinstance(datasource, DatasourceIndex):
+        datasource = DatasourceIndex(datasource)
+    return build_service(resolve_service(serv, mac_resol), datasource)
+
 
-    # Comamnd processing
-    chk = serv.check_command.command
+def resolve_service(serv, mac_resol):
+    """ Get the service data needed by build_service
+    This part needs the Shinken objects, so it runs in the Arbiter process.
+    The result only contains strings and numbers, it can be sent to
+    other processes
+    """
     data = serv.get_data_for_checks()
-    command_line = mac_resol.resolve_command(serv.check_command,
-                                             data)
+    return {'host': serv.host.get_name(),
+            'address': serv.host.address,
+            'service': serv.get_name(),
+            'check_interval': serv.check_interval,
+            'command_name': serv.check_command.command.command,
+            'command_line': mac_resol.resolve_command(serv.check_command,
+                                                      data),
+            }
+
+
+def init_serializer(datasource_index):
+    """ Initialize a serialization process of the pool """
+    global _SERIALIZER_INDEX
+    _SERIALIZER_INDEX = datasource_index
+
+
+def serialize_resolved(resolved):
+    """ Serialize a service resolved by resolve_service, in a
+    serialization process
+
+    Return a tuple (serialized service, error message)
+    """
+    try:
+        return build_service(resolved, _SERIALIZER_INDEX), None
+    except Exception as exp:
+        return None, str(exp)
+
+
+def build_service(resolved, datasource_index):
+    """ Get the resolved service, the compiled datasource
+        And return the service serialized
+    """
+    tmp_dict = {}
 
     # Clean command
-    clean_command = shlex.split(command_line.encode('utf8',
-                                                    'ignore'))
+    command_line = resolved['command_line']
+    if isinstance(command_line, unicode):
+        command_line = command_line.encode('utf8', 'ignore')
+    clean_command = shlex.split(command_line)
     # If the command doesn't seem good
     if len(clean_command) <= 1:
-        raise Exception("Bad command detected: %s" % chk.command)
+        raise Exception("Bad command detected: %s" % resolved['command_name'])
 
     # we do not want the first member, check_snmp thing
     try:
@@ -449,145 +527,36 @@ def dict_serialize(serv, mac_resol, datasource):
     # Prepare dict
     tmp_dict.update(command_args)
     # hostname
-    tmp_dict['host'] = serv.host.get_name()
+    tmp_dict['host'] = resolved['host']
     # address
-    tmp_dict['address'] = serv.host.address
+    tmp_dict['address'] = resolved['address']
     # service
-    tmp_dict['service'] = serv.get_name()
+    tmp_dict['service'] = resolved['service']
     # check_interval
-    tmp_dict['check_interval'] = serv.check_interval
+    tmp_dict['check_interval'] = resolved['check_interval']
 
     #create a dict of maximise-datasources:maximise-datasources-value
     dict_max = {}
     if command_args['maximise-datasources'] and command_args ['maximise-datasources-value']:
         dict_max = dict(zip(command_args['maximise-datasources'], command_args ['maximise-datasources-value']))
 
+    datasource_index.check()
+
     # Get mapping table
-    if 'MAP' not in datasource:
-        raise Exception("MAP section is missing in the datasource files")
     if tmp_dict['mapping_name'] is not None:
-        tmp_dict['mapping'] = datasource.get('MAP').get(tmp_dict['mapping_name']).get('base_oid')
-        if tmp_dict['mapping'] is None:
-            raise Exception("mapping %s is not defined in the "
-                            "datasource" % tmp_dict['mapping_name'])
+        tmp_dict['mapping'] = datasource_index.get_mapping(tmp_dict['mapping_name'])
     else:
         tmp_dict['mapping'] = None
 
-    # Prepare datasources
-    if 'DSTEMPLATE' not in datasource:
-        raise Exception("DSTEMPLATE section is missing in the "
-                        "datasource files")
-    tmp_dict['ds'] = OrderedDict()
-
-    ds_list = datasource.get('DSTEMPLATE').get(tmp_dict['dstemplate'])
-    if ds_list is None:
-        raise Exception("DSTEMPLATE %s is empty" % tmp_dict['dstemplate'])
-
     # We don't want to lose the instance id collectd by old snmp requests
     # So we delete 'instance' entry in the data
     if tmp_dict.get('instance_name') is not None and tmp_dict.get('mapping') is not None:
         del tmp_dict['instance']
 
-    # Get DSs in the dstemplate
-    ds_list = ds_list.get('ds')
-    # The 2 following must be useless, but I will let it
-    # In case of the datasource files are not clean ...
-    if isinstance(ds_list, str):
-        # Handle if ds_list is a str and not a list.
-        ds_list = [ds_name.strip() for ds_name in ds_list.split(',')]
-    elif not isinstance(ds_list, list):
-        raise Exception("Bad format: DS %s in datasource files" % str(ds_list))
-
-    # Get default values from DATASOURCE root
-
-    the_datasource = datasource.get('DATASOURCE')
-
-    default_ds_type = the_datasource.get("ds_type", "TEXT")
-    default_ds_min_oid_value = the_datasource.get("ds_min_oid_value", None)
-
-    for key, value in the_datasource.items():
-        if isinstance(value, (str, unicode)):
-            if not REGEX_OID.match(value) and not REGEX_DS_ATTRIBUTE.match(key):
-                raise Exception("OID for %s isn't valid: %r" % (key, value))
-
-        if isinstance(value, dict):
-            if '-' in key:
-                raise Exception("Ds_name  %s isn't valid (contain -)" % key)
-
-    for ds_name in ds_list:
-        ds_data = the_datasource.get(ds_name)
-        if ds_data is None:
-            raise Exception("ds %s is missing in datasource filess" % ds_name)
-
-        # Set default values
-        # If no ds name set, we use the ds key as name
-        # ie: `dot3StatsExcessiveCollisions`
-        ds_data.setdefault("ds_name", ds_name)
-        ds_data.setdefault("ds_type", default_ds_type)
-        ds_data.setdefault("ds_min_oid_value", default_ds_min_oid_value)
-        for name in ["ds_unit", ]:
-            ds_data.setdefault(name, "")
-        # Set default ds datas
-        for name in ["ds_calc",
-                     "ds_max_oid",
-                     "ds_min_oid",
-                     ]:
-            ds_data.setdefault(name, None)
-
-        # If we have 'maximise-datasources-value' for the current ds_name, we set ds_max_oid to None
-        # And we set our max value to ds_max_oid_value
-        if dict_max.get(ds_name, None):
-            ds_data["ds_max_oid"] = None
-            ds_data['ds_max_oid_value'] = dict_max[ds_name]
-
-        # Add computed_value for max and min
-        for max_min in ['ds_max_oid_value', 'ds_min_oid_value']:
-            if ds_data.get(max_min) is not None:
-                try:
-                    ds_data[max_min + '_computed'] = float(ds_data.get(max_min))
-                except Exception as exp:
-                    raise Exception("Bad format: %s value "
-                                    "(must be a float/int)" % max_min)
-
-        # Check if ds_oid is set
-        if "ds_oid" not in ds_data:
-            raise Exception("ds_oid is not defined in %s" % ds_name)
-
-        # add ds in ds list
-        tmp_dict['ds'][ds_name] = ds_data
+    # Prepare datasources
+    tmp_dict['ds'] = datasource_index.get_ds(tmp_dict['dstemplate'], dict_max)
 
     # Prepare triggers
-    tmp_dict['triggers'] = {}
-    if 'TRIGGERGROUP' not in datasource:
-        raise Exception("TRIGGERGROUP section is missing in the datasource "
-                        "files")
-
-    trigger_list = datasource.get('TRIGGERGROUP').get(tmp_dict['triggergroup'])
-    if trigger_list is not None:
-        # Check if it's a string, if yes we transform it into a list
-        if isinstance(trigger_list, str):
-            trigger_list = [trigger_list]
-        # Browse all triggers in the triggergroup
-        for trigger_name in trigger_list:
-            if 'TRIGGER' not in datasource:
-                raise Exception("TRIGGER section is not define in the "
-                                "datasource")
-            # Get trigger data
-            trigger_data = datasource.get('TRIGGER').get(trigger_name)
-            if trigger_data is None:
-                raise Exception("TRIGGER %s is not define in the "
-                                "datasource" % trigger_name)
-            # Get critical trigger (list)
-            trigger_data.setdefault("critical", None)
-            # Get warning trigger (list)
-            trigger_data.setdefault("warning", None)
-            # Get default trigger (int)
-            try:
-                trigger_data.setdefault("default_status", int(datasource.get('TRIGGER').get("default_status", 3)))
-            except:
-                raise Exception("Bad format: default_status value "
-                                "(must be a float/int)")
-            # Add trigger in trigger list
-            tmp_dict['triggers'][trigger_name] = trigger_data
+    tmp_dict['triggers'] = datasource_index.get_triggers(tmp_dict['triggergroup'])
 
     return tmp_dict
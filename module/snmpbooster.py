@@ -47,7 +47,7 @@ of SNMP Booster loaded in the Arbiter
 
 from shinken.basemodule import BaseModule
 from shinken.log import logger
-from shinken.util import to_int
+from shinken.util import to_int, to_bool
 #from libs.dbclient import DBClient
 from libs.redisclient import DBClient
 
@@ -63,6 +63,29 @@ class SnmpBooster(BaseModule):
         self.db_host = getattr(mod_conf, 'db_host', "127.0.0.1")
         self.db_port = to_int(getattr(mod_conf, 'db_port', 6379))
         self.db_name = getattr(mod_conf, 'db_name', 'booster_snmp')
+        self.db_codec = getattr(mod_conf, 'db_codec', 'marshal')
+        # Unix socket path of a local Redis, replaces db_host/db_port
+        self.db_socket = getattr(mod_conf, 'db_socket', None)
+        self.db_max_connections = to_int(getattr(mod_conf, 'db_max_connections', 10))
+        # Timeouts (seconds): wait for a free connection in the pool,
+        # connection to Redis and Redis answers
+        self.db_pool_timeout = float(getattr(mod_conf, 'db_pool_timeout', 5))
+        self.db_connect_timeout = float(getattr(mod_conf, 'db_connect_timeout', 5))
+        self.db_socket_timeout = float(getattr(mod_conf, 'db_socket_timeout', 10))
+        self.db_keepalive = to_bool(getattr(mod_conf, 'db_keepalive', '1'))
+        # Reconnection attempts with exponential backoff (seconds)
+        self.db_connect_retries = to_int(getattr(mod_conf, 'db_connect_retries', 5))
+        self.db_retry_backoff = float(getattr(mod_conf, 'db_retry_backoff', 0.5))
+        self.db_retry_backoff_max = float(getattr(mod_conf, 'db_retry_backoff_max', 30))
+        # Redis Cluster nodes (host:port,host:port), replaces db_host/db_port
+        self.db_cluster_nodes = [node.strip() for node
+                                 in getattr(mod_conf, 'db_cluster_nodes', '').split(',')
+                                 if node.strip()]
+        # Read only replicas (host:port,host:port) and their max lag (seconds)
+        self.db_replicas = [node.strip() for node
+                            in getattr(mod_conf, 'db_replicas', '').split(',')
+                            if node.strip()]
+        self.db_max_replica_lag = float(getattr(mod_conf, 'db_max_replica_lag', 5))
         self.loaded_by = getattr(mod_conf, 'loaded_by', None)
         self.datasource = None
         self.db_client = None
@@ -84,7 +107,26 @@ class SnmpBooster(BaseModule):
 
         # Prepare database connection
         if self.loaded_by in ['arbiter', 'poller']:
-            self.db_client = DBClient(self.db_host, self.db_port, self.db_name)
+            try:
+                self.db_client = DBClient(self.db_host, self.db_port,
+                                          self.db_name, self.db_codec,
+                                          self.db_socket,
+                                          self.db_max_connections,
+                                          self.db_pool_timeout,
+                                          self.db_connect_timeout,
+                                          self.db_socket_timeout,
+                                          self.db_keepalive,
+                                          self.db_connect_retries,
+                                          self.db_retry_backoff,
+                                          self.db_retry_backoff_max,
+                                          self.db_cluster_nodes,
+                                          self.db_replicas,
+                                          self.db_max_replica_lag)
+            except Exception as exp:
+                logger.error("[SnmpBooster] [code 1103] Database client "
+                             "error: %s" % str(exp))
+                self.i_am_dying = True
+                return
             # Connecting
             if not self.db_client.connect():
                 self.i_am_dying = True
@@ -28,19 +28,26 @@ of SNMP Booster loaded in the Arbiter
 
 import os
 import glob
+import time
+from multiprocessing import Pool, cpu_count
 
 from shinken.macroresolver import MacroResolver
 from shinken.log import logger
-
-try:
-    from configobj import ConfigObj
-except ImportError, exp:
-    logger.error("[SnmpBooster] [code 0901] Import error. Maybe one of this "
-                 "module is missing: ConfigObj")
-    raise ImportError(exp)
+from shinken.util import to_int
 
 from snmpbooster import SnmpBooster
-from libs.utils import dict_serialize
+from libs.datasourcecache import DatasourceCache
+from libs.datasourceindex import DatasourceIndex
+from libs.utils import resolve_service, build_service, init_serializer, \
+    serialize_resolved
+
+
+# Default compiled datasource cache file
+DATASOURCE_CACHE = "/var/lib/shinken/snmpbooster_datasource.cache"
+# Time (seconds) between two progress logs
+PROGRESS_INTERVAL = 10
+# Number of services sent at once to a serialization process
+SERIALIZE_CHUNK_SIZE = 100
 
 
 class SnmpBoosterArbiter(SnmpBooster):
@@ -50,17 +57,23 @@ class SnmpBoosterArbiter(SnmpBooster):
     def __init__(self, mod_conf):
         SnmpBooster.__init__(self, mod_conf)
         self.nb_tick = 0
+        # Number of processes serializing services (0: number of CPUs)
+        self.serialize_processes = to_int(getattr(mod_conf, 'serialize_processes', 0))
+        # Number of services written in one pipelined request
+        self.init_batch_size = to_int(getattr(mod_conf, 'init_batch_size', 500))
+
+        # Compiled datasource cache file (empty: no cache)
+        self.datasource_cache = getattr(mod_conf, 'datasource_cache',
+                                        DATASOURCE_CACHE)
 
         # Read datasource files
         # Config validation
-        current_file = None
         if not isinstance(self.datasource, dict):
             try:
                 # Test if self.datasource_file, is file or directory
                 # if file
                 if os.path.isfile(self.datasource_file):
-                    self.datasource = ConfigObj(self.datasource_file,
-                                                interpolation='template')
+                    files = [self.datasource_file]
                     logger.info("[SnmpBooster] [code 0902] Reading input "
                                 "configuration file: "
                                 "%s" % self.datasource_file)
@@ -69,28 +82,27 @@ class SnmpBoosterArbiter(SnmpBooster):
                 elif os.path.isdir(self.datasource_file):
                     if not self.datasource_file.endswith("/"):
                         self.datasource_file += "/"
-                    files = glob.glob(os.path.join(self.datasource_file,
-                                                   'Default*.ini')
-                                      )
-                    for current_file in files:
-                        if self.datasource is None:
-                            self.datasource = ConfigObj(current_file,
-                                                        interpolation='template')
-                        else:
-                            ctemp = ConfigObj(current_file,
-                                              interpolation='template')
-                            self.datasource.merge(ctemp)
-                        logger.info("[SnmpBooster] [code 0903] Reading "
-                                    "input configuration file: "
-                                    "%s" % current_file)
+                    # Sorted: the merge order does not change between
+                    # restarts, nor the cache key
+                    files = sorted(glob.glob(
+                        os.path.join(self.datasource_file, 'Default*.ini')))
+                    logger.info("[SnmpBooster] [code 0903] Reading "
+                                "%d input configuration files in: "
+                                "%s" % (len(files), self.datasource_file))
                 else:
                     # Normal error with scheduler and poller module
                     # The configuration will be read in the database
                     raise IOError("[SnmpBooster] File or folder not "
                                   "found: %s" % self.datasource_file)
 
+                cache = DatasourceCache(self.datasource_cache,
+                                        self.serialize_processes or
+                                        cpu_count())
+                self.datasource = cache.load(files)
+
             # raise if reading error
             except Exception as exp:
+                current_file = getattr(exp, 'path', None)
                 if current_file is not None:
                     error_message = ("[SnmpBooster] [code 0904] Datasource "
                                      "error while reading or merging in %s: "
@@ -102,47 +114,191 @@ class SnmpBoosterArbiter(SnmpBooster):
                 logger.error(error_message)
                 raise Exception(error_message)
 
-        # Convert datasource to dict
-        if isinstance(self.datasource, ConfigObj):
-            try:
-                self.datasource = self.datasource.dict()
-            except Exception as exp:
-                error_message = ("[SnmpBooster] [code 0906] Error during the "
-                                 "config conversion: %s" % (str(exp)))
-                logger.error(error_message)
-                raise Exception(error_message)
-
     def hook_late_configuration(self, arb):
-        """ Read config and fill database """
+        """ Read config and fill database
+
+        * Commands are resolved in the Arbiter process
+        * Services are serialized by a process pool
+        * Only new and changed services are written, with pipelined
+          requests: their configuration hash is compared with the one
+          stored in the database
+        * Services removed from the configuration of this Arbiter are
+          deleted and host:interval sets are fixed. Services of other
+          Arbiters sharing the database are kept
+        """
+        start_time = time.time()
+        # Services written by an other Arbiter are not deleted
+        arbiter_name = arb.me.get_name()
         mac_resol = MacroResolver()
         mac_resol.init(arb.conf)
+        servs = []
+        resolved_list = []
+        # (host, service) of all SNMP Booster services, even in error
+        config_keys = set()
         for serv in arb.conf.services:
             if serv.check_command.command.module_type == 'snmp_booster':
+                config_keys.add((serv.host.get_name(), serv.get_name()))
                 try:
-                    # Serialize service
-                    dict_serv = dict_serialize(serv,
-                                               mac_resol,
-                                               self.datasource)
+                    resolved_list.append(resolve_service(serv, mac_resol))
                 except Exception as exp:
-                    msg = "[SnmpBooster] [code 0907] [%s,%s] %s" % (
-                        serv.host.get_name(), serv.get_name(), exp)
-                    logger.error(msg)
-                    serv.configuration_errors.append(msg)
+                    self.set_configuration_error(serv, exp)
                     continue
+                servs.append(serv)
+        logger.info("[SnmpBooster] [code 0910] %d services resolved "
+                    "in %.2fs" % (len(servs), time.time() - start_time))
 
-                # We want to make a diff between arbiter insert and poller insert. Some backend may need it.
-                try:
-                    self.db_client.update_service_init(dict_serv['host'],
-                                                       dict_serv['service'],
-                                                       dict_serv)
-                except Exception as exp:
-                    logger.error("[SnmpBooster] [code 0909] [%s,%s] "
-                                 "%s" % (dict_serv['host'],
-                                         dict_serv['service'],
-                                         str(exp)))
-                    continue
+        start_time = last_log = time.time()
+        batch = []
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+        nb_done = nb_errors = 0
+        # Expected host:interval sets {host: {check_interval: services}}
+        intervals = {}
+        for serv, (dict_serv, error) in zip(servs,
+                                            self.serialize(resolved_list)):
+            nb_done += 1
+            if error is not None:
+                self.set_configuration_error(serv, error)
+                continue
+            intervals.setdefault(dict_serv['host'], {}).setdefault(
+                dict_serv['check_interval'], set()).add(dict_serv['service'])
+            # We want to make a diff between arbiter insert and poller insert. Some backend may need it.
+            batch.append(dict_serv)
+            if len(batch) >= self.init_batch_size:
+                nb_errors += self.write_changed_services(batch, counts)
+                batch = []
+            if time.time() - last_log >= PROGRESS_INTERVAL:
+                last_log = time.time()
+                logger.info("[SnmpBooster] [code 0911] %d/%d services "
+                            "serialized, %d written" % (nb_done,
+                                                        len(servs),
+                                                        counts['added'] +
+                                                        counts['changed']))
+        if batch:
+            nb_errors += self.write_changed_services(batch, counts)
+        logger.info("[SnmpBooster] [code 0910] %d services serialized and "
+                    "%d written (%d database errors) in "
+                    "%.2fs" % (nb_done, counts['added'] + counts['changed'],
+                               nb_errors, time.time() - start_time))
+
+        # Services which are not serialized keep their host:interval sets
+        nb_removed = nb_fixed = nb_templates = 0
+        try:
+            if config_keys:
+                stored = set(self.db_client.get_owned_services(arbiter_name))
+                owned = stored
+                if not stored:
+                    # First startup with a set of services by Arbiter:
+                    # services of the configured hosts are its services
+                    hosts = set([host for host, _ in config_keys])
+                    owned = set([key for key
+                                 in self.db_client.get_indexed_services()
+                                 if key[0] in hosts])
+                removed = list(owned - config_keys)
+                for index in xrange(0, len(removed), self.init_batch_size):
+                    self.db_client.delete_services(
+                        removed[index:index + self.init_batch_size])
+                nb_removed = len(removed)
+                self.db_client.update_owned_services(arbiter_name,
+                                                     config_keys - stored,
+                                                     stored - config_keys)
+            else:
+                logger.warning("[SnmpBooster] [code 0913] No SNMP Booster "
+                               "service in the configuration, services "
+                               "in the database are kept")
+            serialized = set([(host, service)
+                              for host, host_intervals in intervals.items()
+                              for services in host_intervals.values()
+                              for service in services])
+            hosts = intervals.keys()
+            for index in xrange(0, len(hosts), self.init_batch_size):
+                nb_fixed += self.db_client.fix_interval_sets(
+                    dict([(host, intervals[host]) for host
+                          in hosts[index:index + self.init_batch_size]]),
+                    config_keys - serialized)
+            nb_templates = self.db_client.remove_unused_templates()
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 0913] Can not remove deleted "
+                         "services or templates, or fix host:interval "
+                         "sets: %s" % str(exp))
+        logger.info("[SnmpBooster] [code 0913] Services added: %d, "
+                    "changed: %d, removed: %d, unchanged: %d "
+                    "(%d host:interval memberships fixed, %d unused "
+                    "templates removed)" % (counts['added'],
+                                            counts['changed'], nb_removed,
+                                            counts['unchanged'], nb_fixed,
+                                            nb_templates))
 
         logger.info("[SnmpBooster] [code 0908] Done parsing")
 
         # Disconnect from database
         self.db_client.disconnect()
+
+    def write_changed_services(self, services, counts):
+        """ Write services which are new or whose configuration hash
+        changed, and update the added/changed/unchanged counts
+
+        Return
+        * nb_errors: int
+        """
+        hashes = [self.db_client.service_hash(data) for data in services]
+        try:
+            stored_hashes = self.db_client.get_config_hashes(
+                [self.db_client.build_key(data['host'], data['service'])
+                 for data in services])
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 0913] Can not read service "
+                         "hashes, all services are written: %s" % str(exp))
+            stored_hashes = [None] * len(services)
+        to_write = []
+        to_write_hashes = []
+        for data, config_hash, stored_hash in zip(services, hashes,
+                                                  stored_hashes):
+            if stored_hash == config_hash:
+                counts['unchanged'] += 1
+                continue
+            counts['added' if stored_hash is None else 'changed'] += 1
+            to_write.append(data)
+            to_write_hashes.append(config_hash)
+        if not to_write:
+            return 0
+        return self.db_client.update_services_init(to_write, to_write_hashes)
+
+    def serialize(self, resolved_list):
+        """ Serialize resolved services with a process pool
+        Yield (serialized service, error message) tuples, in the order
+        of resolved_list
+        """
+        nb_processes = self.serialize_processes or cpu_count()
+        # The datasource is validated and compiled once for all services
+        datasource_index = DatasourceIndex(self.datasource)
+        pool = None
+        if nb_processes > 1 and len(resolved_list) > SERIALIZE_CHUNK_SIZE:
+            try:
+                pool = Pool(nb_processes, init_serializer, (datasource_index,))
+            except Exception as exp:
+                logger.warning("[SnmpBooster] [code 0912] Can not start "
+                               "the serialization processes, services are "
+                               "serialized by the Arbiter: %s" % str(exp))
+        if pool is None:
+            for resolved in resolved_list:
+                try:
+                    yield build_service(resolved, datasource_index), None
+                except Exception as exp:
+                    yield None, str(exp)
+            return
+        try:
+            for result in pool.imap(serialize_resolved, resolved_list,
+                                    SERIALIZE_CHUNK_SIZE):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def set_configuration_error(serv, error):
+        """ Log a service serialization error and add it to the service
+        configuration errors """
+        msg = "[SnmpBooster] [code 0907] [%s,%s] %s" % (
+            serv.host.get_name(), serv.get_name(), error)
+        logger.error(msg)
+        serv.configuration_errors.append(msg)
@@ -37,27 +37,98 @@ import sys
 from datetime import datetime, timedelta
 
 from shinken.log import logger
-from shinken.util import to_int
-from pyasn1.type.univ import OctetString
+from shinken.util import to_int, to_bool
 
 from snmpbooster import SnmpBooster
-from libs.utils import parse_args, compute_value
+from libs.utils import parse_args, compute_value, merge_dicts
 from libs.result import set_output_and_status
 from libs.checks import check_snmp, check_cache
-from libs.snmpworker import SNMPWorker
+from libs.snmpworker import SNMPWorker, TaskRouter
+from libs.deviceprofile import DeviceProfiles
 
 
+# Number of devices in the device wait statistics log
+STATS_DEVICES = 5
+
 class SnmpBoosterPoller(SnmpBooster):
     """ SNMP Poller module class
         Improve SNMP checks
     """
     def __init__(self, mod_conf):
         SnmpBooster.__init__(self, mod_conf)
+        # Max number of SNMP tasks in flight in each SNMP worker
         self.max_prepared_tasks = to_int(getattr(mod_conf, 'max_prepared_tasks', 50))
+        # Max number of services written in one database request
+        self.write_batch_size = to_int(getattr(mod_conf, 'write_batch_size', 500))
+        # Max time (seconds) collected data wait before being written
+        self.write_flush_interval = float(getattr(mod_conf, 'write_flush_interval', 1))
+        # Max number of services in the local service cache (0 disables it)
+        self.cache_size = to_int(getattr(mod_conf, 'cache_size', 5000))
+        # Time (seconds) between two statistics logs
+        self.stats_interval = to_int(getattr(mod_conf, 'stats_interval', 60))
+        # Number of SNMP worker threads, tasks are shared by target address
+        self.snmp_workers = max(to_int(getattr(mod_conf, 'snmp_workers', 1)), 1)
+        # SNMP requests are made by a child process of each SNMP worker
+        self.snmp_worker_processes = to_bool(getattr(mod_conf, 'snmp_worker_processes', False))
+        # Max number of SNMP requests in flight for each device (0: no limit)
+        self.max_requests_per_device = to_int(getattr(mod_conf, 'max_requests_per_device', 0))
+        # SNMP timeouts are computed from the device RTT, the configured
+        # timeout is the max
+        self.adaptive_timeout = to_bool(getattr(mod_conf, 'adaptive_timeout', False))
+        self.min_timeout = float(getattr(mod_conf, 'min_timeout', 0.5))
+        # v1/v2c GET requests are sent from encoded templates, without
+        # pysnmp
+        self.request_templates = to_bool(getattr(mod_conf, 'request_templates', '1'))
+        # SNMP capabilities of the devices are learned and stored
+        self.learn_profiles = to_bool(getattr(mod_conf, 'device_profiles', '1'))
+        self.device_profiles = None
+        # Table columns whose needed rows are at least this fraction of
+        # their rows are walked with GETBULK (0: disabled)
+        self.table_walk_ratio = float(getattr(mod_conf, 'table_walk_ratio', 0))
+        # SNMP engine of the SNMP workers: asyncore or asyncio
+        # (experimental)
+        self.snmp_engine = getattr(mod_conf, 'snmp_engine', 'asyncore')
+        self.snmp_worker_class = SNMPWorker
+        if self.snmp_engine == 'asyncio':
+            # request_templates is enabled by default: only refuse it
+            # when it is set
+            unsupported = [name for name, enabled in
+                           (('snmp_worker_processes',
+                             self.snmp_worker_processes),
+                            ('request_templates',
+                             self.request_templates and
+                             hasattr(mod_conf, 'request_templates')))
+                           if enabled]
+            if unsupported:
+                error_message = ("[SnmpBooster] [code 1016] The asyncio "
+                                 "SNMP engine does not support %s: disable "
+                                 "them or use the asyncore "
+                                 "engine" % ", ".join(unsupported))
+                logger.error(error_message)
+                raise Exception(error_message)
+            self.request_templates = False
+            try:
+                from libs.asyncioworker import AsyncioSNMPWorker
+                self.snmp_worker_class = AsyncioSNMPWorker
+            except ImportError as exp:
+                logger.error("[SnmpBooster] [code 1015] The asyncio SNMP "
+                             "engine needs trollius and pysnmp >= 4.3 (%s), "
+                             "the asyncore engine is used" % str(exp))
+            else:
+                logger.warning("[SnmpBooster] [code 1017] The asyncio SNMP "
+                               "engine is experimental")
         self.checks_done = 0
-        self.task_queue = Queue()
+        self.task_queues = [Queue() for _ in range(self.snmp_workers)]
+        self.task_queue = TaskRouter(self.task_queues)
+        self.snmpworkers = []
         self.result_queue = Queue()
         self.last_checks_counted = 0
+        # Collected data waiting to be written, by (host, service)
+        self.pending_writes = {}
+        self.last_flush = time.time()
+        self.last_stats = time.time()
+        self.write_stats = {}
+        self.reset_write_stats()
 
     def get_new_checks(self):
         """ Get new checks if less than nb_checks_max
@@ -123,11 +194,14 @@ class SnmpBoosterPoller(SnmpBooster):
                 if args.get('real_check', False):
                     # Make a SNMP check
                     check_snmp(chk, args, self.db_client,
-                               self.task_queue, self.result_queue)
+                               self.task_queue, self.result_queue,
+                               self.device_profiles, self.table_walk_ratio,
+                               self.pending_writes)
                     #logger.debug("CHECK SNMP %(host)s:%(service)s" % args)
                 else:
                     # Make fake check (get datas from DB)
-                    check_cache(chk, args, self.db_client)
+                    check_cache(chk, args, self.db_client,
+                                self.pending_writes)
                     #logger.debug("CHECK cache %(host)s:%(service)s" % args)
 
     # Check the status of checks
@@ -226,11 +300,10 @@ class SnmpBoosterPoller(SnmpBooster):
                 if snmp_error is None:
                     # We don't got a SNMP error
                     # Clean raw_value:
+                    # Values are normalized by the SNMP worker:
+                    # strings and integers
                     if result.get('type') in ['DERIVE', 'GAUGE', 'COUNTER']:
-                        if isinstance(result.get('value'), OctetString):
-                            result['value'] = raw_value = float(str(result.get('value')))
-                        else:
-                            result['value'] = raw_value = float(result.get('value'))
+                        result['value'] = raw_value = float(result.get('value'))
                     elif result.get('type') in ['DERIVE64', 'COUNTER64']:
                         result['value'] = raw_value = float(result.get('value'))
                     elif result.get('type') in ['TEXT', 'STRING']:
@@ -275,20 +348,173 @@ class SnmpBoosterPoller(SnmpBooster):
                 new_data = {"ds": {} }
                 for ds_name in key.get('ds_names'):
 
-                    new_data["ds"][ds_name] = {}
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value_last"] = result.get('value_last')
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value"] = raw_value
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value_computed"] = value
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value_computed_last"] = result.get('value_last_computed')
-                    new_data["ds"][ds_name]["error"] = snmp_error
+                    ds_values = {}
+                    ds_values[key.get('oid_type') + "_value_last"] = result.get('value_last')
+                    ds_values[key.get('oid_type') + "_value"] = raw_value
+                    ds_values[key.get('oid_type') + "_value_computed"] = value
+                    ds_values[key.get('oid_type') + "_value_computed_last"] = result.get('value_last_computed')
+                    ds_values["error"] = snmp_error
+                    # Only save values which changed
+                    db_values = result.get('db_values', {}).get(ds_name, {})
+                    new_data["ds"][ds_name] = dict([(name, ds_value)
+                                                    for name, ds_value in ds_values.items()
+                                                    if db_values.get(name) != ds_value])
 
                 new_data["check_time"] = result.get('check_time')
                 new_data["check_time_last"] = result.get('check_time_last')
 
-                self.db_client.update_service(key.get('host'), key.get('service'), new_data)
+                self.queue_write(key.get('host'), key.get('service'), new_data)
             # Remove task from queue
             self.result_queue.task_done()
 
+        # Write collected data if they wait for too long
+        if time.time() - self.last_flush >= self.write_flush_interval:
+            self.flush_writes()
+
+    def queue_write(self, host, service, data):
+        """ Merge data with the data waiting to be written
+        for the same service """
+        key = (host, service)
+        self.pending_writes[key] = merge_dicts(self.pending_writes.get(key),
+                                               data)
+        if len(self.pending_writes) >= self.write_batch_size:
+            self.flush_writes()
+
+    def flush_writes(self):
+        """ Write all waiting data in one pipelined database request """
+        start_time = self.last_flush = time.time()
+        if self.device_profiles is not None:
+            self.device_profiles.flush()
+        if len(self.pending_writes) == 0:
+            return
+        batch = [(host, service, data)
+                 for (host, service), data in self.pending_writes.items()]
+        self.pending_writes = {}
+        nb_errors = self.db_client.update_services(batch)
+        latency = time.time() - start_time
+        # Update statistics
+        self.write_stats['batches'] += 1
+        self.write_stats['services'] += len(batch)
+        self.write_stats['errors'] += nb_errors
+        self.write_stats['latency'] += latency
+        self.write_stats['max_latency'] = max(self.write_stats['max_latency'],
+                                              latency)
+        self.write_stats['max_size'] = max(self.write_stats['max_size'],
+                                           len(batch))
+
+    def reset_write_stats(self):
+        """ Reset database write statistics """
+        self.write_stats = {'batches': 0,
+                            'services': 0,
+                            'errors': 0,
+                            'latency': 0.0,
+                            'max_latency': 0.0,
+                            'max_size': 0,
+                            }
+
+    def log_stats(self):
+        """ Log statistics collected since the last call """
+        self.last_stats = time.time()
+        stats = self.write_stats
+        batches = max(stats['batches'], 1)
+        logger.info("[SnmpBooster] [code 1008] Database writes: "
+                    "%d batches, %d services, %d errors, "
+                    "size avg %.1f max %d, "
+                    "latency avg %.4fs max %.4fs" % (stats['batches'],
+                                                     stats['services'],
+                                                     stats['errors'],
+                                                     stats['services'] / float(batches),
+                                                     stats['max_size'],
+                                                     stats['latency'] / batches,
+                                                     stats['max_latency'],
+                                                     ))
+        self.reset_write_stats()
+        pool_stats = self.db_client.get_pool_stats()
+        if pool_stats is not None:
+            count = max(pool_stats['count'], 1)
+            logger.info("[SnmpBooster] [code 1009] Database connection pool: "
+                        "%d/%d connections used, %d created, "
+                        "wait avg %.4fs max %.4fs, "
+                        "%d timeouts" % (pool_stats['in_use'],
+                                         self.db_max_connections,
+                                         pool_stats['created'],
+                                         pool_stats['total'] / count,
+                                         pool_stats['max'],
+                                         pool_stats['timeouts'],
+                                         ))
+        cache_stats = self.db_client.get_cache_stats()
+        if cache_stats is not None:
+            lookups = max(cache_stats['hits'] + cache_stats['misses'], 1)
+            logger.info("[SnmpBooster] [code 1010] Service cache: "
+                        "%d hits, %d misses (hit ratio %.1f%%), "
+                        "%d evictions, %d invalidations, "
+                        "size %d/%d, %d templates" % (
+                            cache_stats['hits'],
+                            cache_stats['misses'],
+                            cache_stats['hits'] * 100.0 / lookups,
+                            cache_stats['evictions'],
+                            cache_stats['invalidations'],
+                            cache_stats['size'],
+                            self.cache_size,
+                            cache_stats['templates'],
+                            ))
+        for snmpworker in self.snmpworkers:
+            worker_stats = snmpworker.get_stats()
+            logger.info("[SnmpBooster] [code 1012] SNMP worker %d: "
+                        "queue %d, in flight %d (max %d), "
+                        "%d tasks in %d dispatches, %d split, "
+                        "busy %.1f%%" % (snmpworker.shard,
+                                         worker_stats['queue'],
+                                         worker_stats['in_flight'],
+                                         worker_stats['max_in_flight'],
+                                         worker_stats['tasks'],
+                                         worker_stats['dispatches'],
+                                         worker_stats['splits'],
+                                         worker_stats['busy'] * 100.0 /
+                                         max(worker_stats['elapsed'], 1),
+                                         ))
+            # Devices with the longest waits for a free request slot
+            devices = sorted(worker_stats['devices'].items(),
+                             key=lambda item: item[1][2],
+                             reverse=True)[:STATS_DEVICES]
+            if devices and devices[0][1][2] > 0:
+                logger.info("[SnmpBooster] [code 1013] SNMP worker %d: "
+                            "device waits (avg/max): %s" % (
+                                snmpworker.shard,
+                                ", ".join(["%s %.3fs/%.3fs" % (host,
+                                                               total / nb_waits,
+                                                               max_wait)
+                                           for host, (nb_waits, total, max_wait)
+                                           in devices])))
+            # Slowest and dead devices
+            devices = sorted(worker_stats['rtt'].items(),
+                             key=lambda item: (item[1][2], item[1][0]),
+                             reverse=True)[:STATS_DEVICES]
+            if devices:
+                logger.info("[SnmpBooster] [code 1014] SNMP worker %d: "
+                            "device RTTs (avg/var, timeouts): %s" % (
+                                snmpworker.shard,
+                                ", ".join(["%s %s, %d" % (host,
+                                                          "-" if srtt is None
+                                                          else "%.3fs/%.3fs" % (srtt, rttvar),
+                                                          timeouts)
+                                           for host, (srtt, rttvar, timeouts)
+                                           in devices])))
+        replica_stats = self.db_client.get_replica_stats()
+        if replica_stats is not None:
+            lags = ", ".join(["%s %s" % (name, "down" if lag is None
+                                         else "%.1fs" % lag)
+                              for name, lag in sorted(replica_stats['lags'].items())])
+            logger.info("[SnmpBooster] [code 1011] Database reads: "
+                        "%d from replicas, %d from primary "
+                        "(%d stale, %d replica errors), "
+                        "replica lags: %s" % (replica_stats['replica'],
+                                              replica_stats['primary'],
+                                              replica_stats['stale'],
+                                              replica_stats['errors'],
+                                              lags,
+                                              ))
+
     # id = id of the worker
     # master_slave_queue = Global Queue Master->Slave
     # m = Queue Slave->Master
@@ -305,8 +531,24 @@ class SnmpBoosterPoller(SnmpBooster):
         self.returns_queue = returns_queue
         self.master_slave_queue = master_slave_queue
         self.t_each_loop = time.time()
-        self.snmpworker = SNMPWorker(self.task_queue, self.max_prepared_tasks)
-        self.snmpworker.start()
+        if self.learn_profiles:
+            self.device_profiles = DeviceProfiles(self.db_client)
+        self.snmpworkers = [self.snmp_worker_class(task_queue,
+                                                   self.max_prepared_tasks,
+                                                   shard,
+                                                   self.snmp_worker_processes,
+                                                   self.max_requests_per_device,
+                                                   self.adaptive_timeout,
+                                                   self.min_timeout,
+                                                   self.request_templates,
+                                                   self.device_profiles)
+                            for shard, task_queue
+                            in enumerate(self.task_queues)]
+        for snmpworker in self.snmpworkers:
+            snmpworker.start()
+        # The service cache must be created in the worker process
+        if self.cache_size > 0:
+            self.db_client.enable_cache(self.cache_size)
 
         dt_start = datetime.now()
         dt_mid = dt_start.replace(hour=12, minute=0, second=0, microsecond=0)
@@ -318,14 +560,21 @@ class SnmpBoosterPoller(SnmpBooster):
                 logger.info('worker leaving..')
                 break
             cmsg = None
-            # Check snmp worker status
-            if not self.snmpworker.is_alive():
-                # The snmpworker seems down ...
-                # We respawn one
-                self.snmpworker.join()
-                self.snmpworker = SNMPWorker(self.task_queue, self.max_prepared_tasks)
-                # and start it
-                self.snmpworker.start()
+            # Check snmp workers status
+            for shard, snmpworker in enumerate(self.snmpworkers):
+                if not snmpworker.is_alive():
+                    # The snmpworker seems down ...
+                    # We respawn one
+                    snmpworker.join()
+                    snmpworker = self.snmp_worker_class(
+                        self.task_queues[shard], self.max_prepared_tasks,
+                        shard, self.snmp_worker_processes,
+                        self.max_requests_per_device, self.adaptive_timeout,
+                        self.min_timeout, self.request_templates,
+                        self.device_profiles)
+                    self.snmpworkers[shard] = snmpworker
+                    # and start it
+                    snmpworker.start()
 
             # If we are diyin (big problem!) we do not
             # take new jobs, we just finished the current one
@@ -338,6 +587,9 @@ class SnmpBoosterPoller(SnmpBooster):
             self.save_results()
             # Prepare checks output
             self.manage_finished_checks()
+            # Log statistics
+            if time.time() - self.last_stats >= self.stats_interval:
+                self.log_stats()
 
             # Now get order from master
             try:
@@ -348,6 +600,8 @@ class SnmpBoosterPoller(SnmpBooster):
                     # Dad say we are dying..." % self.id)
                     logger.info("[SnmpBooster] [code 1007] FIX-ME-ID Parent "
                                 "requests termination.")
+                    # Write collected data before leaving
+                    self.flush_writes()
                     break
             except Empty:
                 pass
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+""" SNMP Booster codec benchmark
+
+Compare encode/decode time and stored bytes of the service codecs
+against the legacy repr/eval format
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from collections import OrderedDict
+
+try:
+    from shinken.modules.snmp_booster.libs import codec
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "..", "libs"))
+    import codec
+
+
+def build_service(nb_ds):
+    """ Build a service like the ones written by the arbiter and the poller
+    (standard-interface dstemplate) """
+    service = {'host': 'switch-01.example.net',
+               'address': '192.168.2.63',
+               'service': 'if.GigabitEthernet1_0_12',
+               'community': 'public',
+               'version': 2,
+               'port': 161,
+               'timeout': 5,
+               'retry': 1,
+               'dstemplate': 'standard-interface',
+               'instance_name': 'GigabitEthernet1_0_12',
+               'instance': '10112',
+               'mapping_name': 'interface-name',
+               'mapping': '.1.3.6.1.2.1.2.2.1.2',
+               'triggergroup': 'interface-hc',
+               'use_getbulk': False,
+               'max_rep_map': 64,
+               'request_group_size': 64,
+               'no_concurrency': False,
+               'maximise-datasources': None,
+               'maximise-datasources-value': None,
+               'real_check': False,
+               'check_interval': 5,
+               'check_time': 1412776670.123456,
+               'check_time_last': 1412776370.654321,
+               'ds': OrderedDict(),
+               'triggers': {},
+               }
+    for index in range(nb_ds):
+        ds_name = 'ifHCInOctets%d' % index
+        service['ds'][ds_name] = {
+            'ds_name': ds_name,
+            'ds_type': 'DERIVE64',
+            'ds_oid': '.1.3.6.1.2.1.31.1.1.1.6.%(instance)s',
+            'ds_calc': ['8', 'mul'],
+            'ds_unit': 'bps',
+            'ds_max_oid': '.1.3.6.1.2.1.31.1.1.1.15.%(instance)s',
+            'ds_min_oid': None,
+            'ds_min_oid_value': '0',
+            'ds_min_oid_value_computed': 0.0,
+            'ds_oid_value': 123456789012.0,
+            'ds_oid_value_last': 123456700000.0,
+            'ds_oid_value_computed': 2373.3653,
+            'ds_oid_value_computed_last': 2100.12,
+            'ds_max_oid_value': 1000.0,
+            'ds_max_oid_value_computed': 1000000000.0,
+            'error': None,
+            }
+    for name in ('interface_in_octets', 'interface_out_octets',
+                 'interface_in_errors', 'interface_out_errors'):
+        service['triggers'][name] = {
+            'warning': ['ifHCInOctets0.prct', '80', 'gt'],
+            'critical': ['ifHCInOctets0.prct', '90', 'gt'],
+            'default_status': 3,
+            }
+    return service
+
+
+def bench(name, encode, decode, service, number):
+    """ Time encode and decode functions and print one result line """
+    raw = encode(service)
+    enc_time = timeit.timeit(lambda: encode(service), number=number)
+    dec_time = timeit.timeit(lambda: decode(raw), number=number)
+    print "%-10s %10d %14.2f %14.2f" % (name, len(raw),
+                                        enc_time * 1e6 / number,
+                                        dec_time * 1e6 / number)
+    return raw
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SNMP Booster codec '
+                                                 'benchmark')
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='Number of encode/decode per codec. '
+                             'Default=2000')
+    parser.add_argument('-d', '--ds', type=int, default=8,
+                        help='Number of datasources in the service. '
+                             'Default=8')
+    args = parser.parse_args()
+
+    service = build_service(args.ds)
+
+    print "%-10s %10s %14s %14s" % ("codec", "bytes",
+                                    "encode (us)", "decode (us)")
+    bench("repr", codec.ReprCodec.encode, codec.ReprCodec.decode,
+          service, args.number)
+    for name in sorted(codec.CODECS):
+        try:
+            current = codec.get_codec(name)
+        except codec.CodecError as exp:
+            print "%-10s skipped: %s" % (name, exp)
+            continue
+        raw = bench(name, current.encode,
+                    lambda raw: codec.decode(raw)[0],
+                    service, args.number)
+        # Check round trip
+        if codec.decode(raw)[0] != service:
+            print "%-10s ERROR: decoded data differs from input" % name
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ def dump_redis():
         if re.search(":[0-9]*$", key) is not None:
             out[key] = conn.smembers(key)
             #print '"%s":%s' % (key, conn.smembers(key))
+        elif conn.type(key) == "hash":
+            out[key] = conn.hgetall(key)
         else:
             out[key] = conn.get(key)
             #print '"%s":%s' % (key, conn.get(key))
@@ -27,7 +29,9 @@ def load_redis():
     from dump import data
     for key in data:
         if re.search(":[0-9]*$", key) is not None:
-            conn.sadd(key, data[key])
+            conn.sadd(key, *data[key])
+        elif isinstance(data[key], dict):
+            conn.hmset(key, data[key])
         else:
             conn.set(key, data[key])
             
@@ -47,13 +47,14 @@ def search(db_client, host=None, service=None, show_ds=False, show_triggers=Fals
 def clear(db_client, host=None, service=None):
     """ Clear service instances"""
     if host is not None and service is not None:
-        results = [db_client.get_service(host, service)]
+        # Services are rewritten: never read them from a replica
+        results = [db_client.get_service(host, service, use_replica=False)]
 
     elif service is not None:
-        results = db_client.get_hosts_from_service(service)
+        results = db_client.get_hosts_from_service(service, use_replica=False)
     # Prepare columns
     elif host is not None:
-        results = db_client.get_services_from_host(host)
+        results = db_client.get_services_from_host(host, use_replica=False)
     # Both none, show keys
     else:
         results = db_client.get_all_services()
@@ -100,6 +101,12 @@ def delete(db_client, host=None, service=None):
     print "%d key(s) deleted in database" % nb_del
 
 
+def reindex(db_client):
+    """ Rebuild database indexes """
+    nb_services = db_client.rebuild_indexes()
+    print "%d service(s) indexed" % nb_services
+
+
 def main():
 
     # Argument parsing
@@ -112,6 +119,12 @@ def main():
                         help='Redis server address.')
     parser.add_argument('-p', '--redis-port', type=int, default=6379,
                         help='Redis server port.')
+    parser.add_argument('-c', '--cluster-nodes', type=str, default=None,
+                        help='Redis Cluster nodes (host:port,host:port). '
+                             'Replaces --redis-address and --redis-port')
+    parser.add_argument('-R', '--replicas', type=str, default=None,
+                        help='Redis replicas used for searches '
+                             '(host:port,host:port)')
     # Search
     subparsers = parser.add_subparsers(help='sub-command help')
     search_parser = subparsers.add_parser('search', help='search help')
@@ -163,6 +176,14 @@ def main():
     clearold_parser.add_argument('-P', '--pending', default=False, action='store_true',
                                  help='Clear also pending check (check_time None in database)')
 
+    # Rebuild indexes
+    reindex_parser = subparsers.add_parser('reindex',
+                                           help='Rebuild host, service and '
+                                                'interval indexes (needed for '
+                                                'databases filled by older '
+                                                'versions)')
+    reindex_parser.set_defaults(command='reindex')
+
     # Parse arguments
     args = parser.parse_args()
     # Import snmpbooster db backend
@@ -173,7 +194,14 @@ def main():
         sys.exit(1)
 
     # Check database connection
-    db_client = dbmodule.DBClient(args.redis_address, args.redis_port)
+    if args.cluster_nodes:
+        db_client = dbmodule.DBClient(args.redis_address, args.redis_port,
+                                      cluster_nodes=args.cluster_nodes.split(","))
+    elif args.replicas:
+        db_client = dbmodule.DBClient(args.redis_address, args.redis_port,
+                                      replicas=args.replicas.split(","))
+    else:
+        db_client = dbmodule.DBClient(args.redis_address, args.redis_port)
     db_client.connect()
 
     try:
@@ -190,6 +218,9 @@ def main():
         # Remove all keys not in host:interval set (members)
         elif args.command == "clear-old":
             clear_old(db_client, args.hour, args.pending)
+        # Rebuild indexes
+        elif args.command == "reindex":
+            reindex(db_client)
         # Delete host/service
         elif args.command.startswith("delete"):
             # Remove host:* key